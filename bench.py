@@ -0,0 +1,445 @@
+#! python3
+""" Pycraft benchmarks - times the Model's hot paths without a window in sight """
+
+# Every benchmark builds its own seeded world, so two runs on the same machine are doing exactly the
+# same work. Results go out as JSON; hand an older results file to --compare and anything that got
+# slower than --threshold allows is called out (and the exit status says so, for scripts).
+#
+#   python bench.py --out before.json
+#   ... change things ...
+#   python bench.py --out after.json --compare before.json
+from __future__ import division
+
+import argparse
+
+import json
+
+import math
+
+import platform
+
+import random
+
+import shutil
+
+import subprocess
+
+import sys
+
+import tempfile
+
+import time
+
+import pyglet
+
+# No display needed - and don't go making a hidden GL window on import either
+pyglet.options['shadow_window'] = False
+
+import numpy as np
+
+import main
+from main import BRICK, NullRenderer, PLAYER_HEIGHT, Model, player_box, sectorize, texture_coordinates
+
+LAMP = texture_coordinates((3, 0), (3, 0), (3, 0))
+# There's no lamp in the texture atlas, so this borrows an empty cell of it just to have something that glows
+
+
+def make_model(seed):
+    """ A headless Model with the spawn area shown and meshed """
+    model = Model(seed=seed, renderer=NullRenderer())
+    model.change_sector(None, (0, 0, 0))
+    model.process_entire_queue()
+    return model
+
+
+def random_rays(rng, count, spread=60):
+    """ count rays from random spots above the ground, looking in random directions """
+    positions = []
+    vectors = []
+    for _ in main.xrange(count):
+        positions.append((rng.uniform(-spread, spread), rng.uniform(-1, 4), rng.uniform(-spread, spread)))
+        a = rng.uniform(0, 2 * math.pi)
+        b = rng.uniform(-math.pi / 2, math.pi / 4)
+        vectors.append((math.cos(a) * math.cos(b), math.sin(b), math.sin(a) * math.cos(b)))
+    return positions, vectors
+
+
+def bench_initialize(seed, scale):
+    """ Model construction, _initialize() included """
+    count = 5 * scale
+    start = time.perf_counter()
+    for i in main.xrange(count):
+        Model(seed=seed + i, renderer=NullRenderer()).executor.shutdown()
+    return time.perf_counter() - start, count
+
+
+def bench_cold_start(seed, scale):
+    """ Everything before the spawn area is fully meshed, with no startup snapshot to help """
+    count = 2 * scale
+    start = time.perf_counter()
+    for i in main.xrange(count):
+        make_model(seed + i).executor.shutdown()
+    return time.perf_counter() - start, count
+
+
+def bench_warm_start(seed, scale):
+    """ The same as bench_cold_start, straight out of a startup snapshot """
+    count = 2 * scale
+    cache = tempfile.mkdtemp()
+    try:
+        for i in main.xrange(count):
+            model = Model(seed=seed + i, renderer=NullRenderer(), cache_path=cache)
+            model.change_sector(None, main.SPAWN_SECTOR)
+            model.process_entire_queue()
+            model.executor.shutdown()
+        start = time.perf_counter()
+        for i in main.xrange(count):
+            model = Model(seed=seed + i, renderer=NullRenderer(), cache_path=cache)
+            assert model.focus is not None, 'the snapshot was not used'
+            model.executor.shutdown()
+        seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(cache)
+    return seconds, count
+
+
+def bench_generate(seed, scale):
+    """ Generating sectors from scratch """
+    model = Model(seed=seed, renderer=NullRenderer())
+    side = 4 * scale
+    start = time.perf_counter()
+    model.load_around((100, 0, 100), side)
+    seconds = time.perf_counter() - start
+    model.executor.shutdown()
+    return seconds, (2 * side + 1) ** 2
+
+
+def bench_edit_storm(seed, scale):
+    """ add_block()/remove_block() pairs in shown sectors, each one re-meshing straight away """
+    model = make_model(seed)
+    rng = random.Random(seed)
+    count = 500 * scale
+    positions = set((rng.randint(-30, 30), rng.randint(0, 8), rng.randint(-30, 30)) for _ in main.xrange(count))
+    positions = sorted(p for p in positions if p not in model.world)
+    brick = model.world.palette_id(BRICK)
+    start = time.perf_counter()
+    for position in positions:
+        model.add_block(position, brick)
+    for position in positions:
+        model.remove_block(position)
+    seconds = time.perf_counter() - start
+    model.executor.shutdown()
+    return seconds, 2 * len(positions)
+
+
+def bench_bulk_edit(seed, scale):
+    """ The same kind of edits as bench_edit_storm, through add_blocks()/remove_blocks() """
+    model = make_model(seed)
+    rng = random.Random(seed)
+    count = 500 * scale
+    positions = set((rng.randint(-30, 30), rng.randint(0, 8), rng.randint(-30, 30)) for _ in main.xrange(count))
+    positions = sorted(p for p in positions if p not in model.world)
+    start = time.perf_counter()
+    model.add_blocks((position, BRICK) for position in positions)
+    model.remove_blocks(positions)
+    seconds = time.perf_counter() - start
+    model.executor.shutdown()
+    return seconds, 2 * len(positions)
+
+
+def bench_light_source(seed, scale):
+    """ Putting down and taking away lamps in the open, so the block light has to spread out and come back in full """
+    model = make_model(seed)
+    model.world.set_emission(LAMP, main.MAX_LIGHT)
+    rng = random.Random(seed)
+    count = 100 * scale
+    positions = set((rng.randint(-30, 30), rng.randint(4, 10), rng.randint(-30, 30)) for _ in main.xrange(count))
+    positions = sorted(p for p in positions if p not in model.world)
+    lamp = model.world.palette_id(LAMP)
+    start = time.perf_counter()
+    for position in positions:
+        model.add_block(position, lamp)
+        model.remove_block(position)
+    seconds = time.perf_counter() - start
+    model.executor.shutdown()
+    return seconds, 2 * len(positions)
+
+
+def bench_light_shadow(seed, scale):
+    """ Putting down and taking away blocks high in the sky - each one casts a shadow all the way down to the ground """
+    model = make_model(seed)
+    rng = random.Random(seed)
+    count = 100 * scale
+    positions = set((rng.randint(-30, 30), 14, rng.randint(-30, 30)) for _ in main.xrange(count))
+    positions = sorted(p for p in positions if p not in model.world)
+    brick = model.world.palette_id(BRICK)
+    start = time.perf_counter()
+    for position in positions:
+        model.add_block(position, brick)
+        model.remove_block(position)
+    seconds = time.perf_counter() - start
+    model.executor.shutdown()
+    return seconds, 2 * len(positions)
+
+
+def bench_scattered_light(seed, scale):
+    """ Bulk edits of a few blocks a long way apart, each casting a shadow - every lot is relit a cluster at a time,
+    not as one box stretching between them
+    """
+    model = make_model(seed)
+    rng = random.Random(seed)
+    count = 50 * scale
+    start = time.perf_counter()
+    for _ in main.xrange(count):
+        positions = [(rng.randint(-120, 120), rng.randint(5, 12), rng.randint(-120, 120)) for _ in main.xrange(4)]
+        model.add_blocks([(p, BRICK) for p in positions])
+        model.remove_blocks(positions)
+    seconds = time.perf_counter() - start
+    model.executor.shutdown()
+    return seconds, 2 * count
+
+
+def bench_falling_sand(seed, scale):
+    """ Columns of sand dropped from high up, ticked until every block has landed - one bulk edit per tick """
+    model = make_model(seed)
+    rng = random.Random(seed)
+    columns = set((rng.randint(-30, 30), rng.randint(-30, 30)) for _ in main.xrange(4 * scale))
+    model.add_blocks(((x, y, z), main.SAND) for x, z in columns for y in main.xrange(20, 120))
+    ticks = 0
+    start = time.perf_counter()
+    while model._updates:
+        model.update_blocks()
+        ticks += 1
+    seconds = time.perf_counter() - start
+    model.executor.shutdown()
+    return seconds, ticks
+
+
+def bench_occlusion(seed, scale):
+    """ Working out the face links of every shown sector from scratch, and searching them for what's in sight """
+    model = make_model(seed)
+    count = 0
+    start = time.perf_counter()
+    for _ in main.xrange(scale):
+        model._links = {}
+        model.visible_sectors((0.0, 0.0, 0.0), budget=len(model._shown))
+        count += len(model._shown)
+    seconds = time.perf_counter() - start
+    model.executor.shutdown()
+    return seconds, count
+
+
+def bench_change_sector(seed, scale):
+    """ Walking in a straight line, streaming sectors in and out and meshing them as we go """
+    model = make_model(seed)
+    steps = 10 * scale
+    sector = (0, 0, 0)
+    start = time.perf_counter()
+    for i in main.xrange(1, steps + 1):
+        after = sectorize((i * main.SECTOR_SIZE, 0, i * main.SECTOR_SIZE // 2))
+        model.change_sector(sector, after)
+        model.process_entire_queue()
+        sector = after
+    seconds = time.perf_counter() - start
+    model.executor.shutdown()
+    return seconds, steps
+
+
+def bench_pace(seed, scale):
+    """ Pacing back and forth over a few sectors, so the same ones keep getting hidden and shown again """
+    model = make_model(seed)
+    steps = 20 * scale
+    sector = (0, 0, 0)
+    start = time.perf_counter()
+    for i in main.xrange(steps):
+        after = (0 if i % 2 else 4, 0, 0)
+        model.change_sector(sector, after)
+        model.process_entire_queue()
+        sector = after
+    seconds = time.perf_counter() - start
+    model.executor.shutdown()
+    return seconds, steps
+
+
+def bench_hit_test(seed, scale):
+    """ hit_test() from different spots every time, so the cache never helps """
+    model = make_model(seed)
+    positions, vectors = random_rays(random.Random(seed), 2000 * scale, spread=40)
+    start = time.perf_counter()
+    for position, vector in zip(positions, vectors):
+        model.hit_test(position, vector)
+    seconds = time.perf_counter() - start
+    model.executor.shutdown()
+    return seconds, len(positions)
+
+
+def bench_hit_test_many(seed, scale):
+    """ The same rays as bench_hit_test, cast all at once """
+    model = make_model(seed)
+    positions, vectors = random_rays(random.Random(seed), 2000 * scale, spread=40)
+    start = time.perf_counter()
+    model.hit_test_many(np.array(positions), np.array(vectors))
+    seconds = time.perf_counter() - start
+    model.executor.shutdown()
+    return seconds, len(positions)
+
+
+def bench_sweep(seed, scale):
+    """ sweep() for a player-sized box from random spots near the ground, falling and walking at once """
+    model = make_model(seed)
+    rng = random.Random(seed)
+    moves = []
+    for _ in main.xrange(5000 * scale):
+        position = (rng.uniform(-40, 40), rng.uniform(-1, 3), rng.uniform(-40, 40))
+        motion = (rng.uniform(-0.1, 0.1), -main.TERMINAL_VELOCITY / main.PHYSICS_TICKS_PER_SEC, rng.uniform(-0.1, 0.1))
+        moves.append(player_box(position, PLAYER_HEIGHT) + (motion,))
+    start = time.perf_counter()
+    for lo, hi, motion in moves:
+        model.sweep(lo, hi, motion)
+    seconds = time.perf_counter() - start
+    model.executor.shutdown()
+    return seconds, len(moves)
+
+
+def bench_entities(seed, scale):
+    """ A second of game ticks for thousands of little boxes flung about the spawn area, drawing them every tick """
+    model = make_model(seed)
+    rng = np.random.RandomState(seed)
+    count = 2000 * scale
+    positions = rng.uniform((-40, 5, -40), (40, 30, 40), (count, 3))
+    velocities = rng.uniform((-5, -5, -5), (5, 10, 5), (count, 3))
+    model.entities.spawn(positions, velocities, (0.6, 0.9, 0.6), model.world.palette_id(BRICK))
+    ticks = main.PHYSICS_TICKS_PER_SEC
+    start = time.perf_counter()
+    for _ in main.xrange(ticks):
+        model.update_entities(1.0 / main.PHYSICS_TICKS_PER_SEC)
+        model.draw_entities(1.0)
+    seconds = time.perf_counter() - start
+    model.executor.shutdown()
+    return seconds, ticks
+
+
+def bench_queries(seed, scale):
+    """ A mix of the World's spatial queries about the spawn area - column heights, box scans, nearest blocks, and
+    counts over boxes
+    """
+    model = make_model(seed)
+    world = model.world
+    rng = random.Random(seed)
+    count = 200 * scale
+    start = time.perf_counter()
+    for _ in main.xrange(count):
+        x, y, z = rng.randint(-50, 50), rng.randint(-3, 6), rng.randint(-50, 50)
+        world.highest_block(x, z)
+        world.blocks_in_box((x - 8, y - 8, z - 8), (x + 8, y + 8, z + 8))
+        world.nearest((x, y, z), lambda block_type: block_type.falls, radius=16)
+        world.count_by_type((x - 24, -3, z - 24), (x + 24, 12, z + 24))
+    seconds = time.perf_counter() - start
+    model.executor.shutdown()
+    return seconds, count
+
+
+BENCHMARKS = [
+    ('initialize', bench_initialize),
+    ('cold_start', bench_cold_start),
+    ('warm_start', bench_warm_start),
+    ('generate', bench_generate),
+    ('edit_storm', bench_edit_storm),
+    ('bulk_edit', bench_bulk_edit),
+    ('light_source', bench_light_source),
+    ('light_shadow', bench_light_shadow),
+    ('scattered_light', bench_scattered_light),
+    ('falling_sand', bench_falling_sand),
+    ('occlusion', bench_occlusion),
+    ('change_sector', bench_change_sector),
+    ('pace', bench_pace),
+    ('hit_test', bench_hit_test),
+    ('hit_test_many', bench_hit_test_many),
+    ('sweep', bench_sweep),
+    ('entities', bench_entities),
+    ('queries', bench_queries),
+]
+
+
+def git_revision():
+    """ The commit being measured, if there is one """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names, seed, scale, repeat):
+    """ Run the named benchmarks, keeping the best of repeat runs of each """
+    results = {}
+    for name, func in BENCHMARKS:
+        if names and name not in names:
+            continue
+        best = None
+        for _ in main.xrange(repeat):
+            seconds, ops = func(seed, scale)
+            if best is None or seconds < best[0]:
+                best = (seconds, ops)
+        seconds, ops = best
+        results[name] = {
+            'seconds': seconds,
+            'ops': ops,
+            'ops_per_sec': ops / seconds if seconds else None,
+            'doc': func.__doc__.strip(),
+        }
+        print('%-16s %10.4f s %10d ops %14.1f ops/s' % (name, seconds, ops, results[name]['ops_per_sec'] or 0))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Print how results stack up against an older run. Returns the names that regressed. """
+    regressed = []
+    for name, result in sorted(results.items()):
+        old = baseline.get('results', {}).get(name)
+        if not old or not old.get('ops_per_sec') or not result['ops_per_sec']:
+            continue
+        ratio = result['ops_per_sec'] / old['ops_per_sec']
+        flag = ''
+        if ratio < 1 - threshold:
+            flag = '  <-- REGRESSION'
+            regressed.append(name)
+        print('%-16s %7.2fx%s' % (name, ratio, flag))
+    return regressed
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all of them)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--scale', type=int, default=1, help='multiply the work in every benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark - the best one counts')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='a JSON file from an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='how much slower (as a fraction) counts as a regression')
+    args = parser.parse_args()
+
+    results = run(args.names, args.seed, args.scale, args.repeat)
+    report = {
+        'revision': git_revision(),
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'scale': args.scale,
+        'results': results,
+    }
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
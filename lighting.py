@@ -0,0 +1,161 @@
+""" Pycraft lighting - flood fill light through the air, a wave at a time """
+
+# There are two kinds of light, and every cell of a Chunk keeps both in one byte: sky light in the high nibble,
+# block light in the low one. Each goes from 0 (pitch black) to MAX_LIGHT, drops by one for every step it takes
+# through the air, and stops dead at a block. Sky light has one more rule - full sky light shines straight down
+# without fading, so anything with nothing but air above it is fully lit.
+#
+# Everything here works on one channel of a window: a box of the world, as flat arrays, along with which of
+# its cells are solid and which are fixed. Fixed cells are ones the window doesn't own - its outer layer, and
+# anything outside of a loaded Chunk's arrays - so their light is taken as given and never changed. The window's
+# outer layer must be fixed, which is also what stops a step off the edge of the box wrapping round.
+#
+# Light spreads breadth first, but a whole wave of cells at a time as array operations, rather than a cell at a
+# time off a queue - there are never more than a few dozen waves, and the waves are where all the work is.
+from __future__ import division
+
+import numpy as np
+
+MAX_LIGHT = 15
+
+SKY_SHIFT = 4
+# Sky light sits above block light in each byte
+
+FULL_SKY = MAX_LIGHT << SKY_SHIFT
+
+
+def split_light(light):
+    """ Return the (sky, block) light levels out of packed light bytes """
+    return light >> SKY_SHIFT, light & MAX_LIGHT
+
+
+def pack_light(sky, block):
+    """ The opposite of split_light() """
+    return (sky << SKY_SHIFT) | block
+
+
+def face_steps(shape, faces):
+    """ Return how far apart in a flat array of the given shape the cells either side of each face are, in faces order,
+    and which of the faces is the bottom one (the way full sky light goes without fading)
+    """
+    _, height, depth = shape
+    return [(dx * height + dy) * depth + dz for dx, dy, dz in faces], faces.index((0, -1, 0))
+
+
+def _neighbours(cells, step, size):
+    """ The cells one step from cells, and which of them are still in the window """
+    cells = cells + step
+    return cells, (cells >= 0) & (cells < size)
+
+
+def _unique(cells, owner):
+    """ cells without the repeats, in no particular order. owner is a scratch int array as big as the window - this
+    is np.unique() without the sort, which is most of what a wave would cost otherwise.
+    """
+    order = np.arange(len(cells))
+    owner[cells] = order
+    return cells[owner[cells] == order]
+
+
+def spread_light(level, solid, fixed, frontier, steps, down=None):
+    """ Flood light out from the frontier cells, raising any air it reaches that's darker than it ought to be.
+    level, solid and fixed are flat views of the window, and level is changed in place. steps and down come from
+    face_steps() - pass down=None for block light, which fades the same way in every direction.
+    """
+    size = len(level)
+    owner = np.empty(size, dtype=np.intp)
+    frontier = _unique(np.asarray(frontier, dtype=np.intp), owner)
+    while len(frontier):
+        source = level[frontier].astype(np.int16)
+        reached = []
+        for face, step in enumerate(steps):
+            cells, inside = _neighbours(frontier, step, size)
+            value = source - 1
+            if face == down:
+                value = np.where(source == MAX_LIGHT, MAX_LIGHT, value)
+            cells, value = cells[inside], value[inside]
+            keep = ~fixed[cells] & ~solid[cells] & (level[cells] < value)
+            cells = cells[keep]
+            if len(cells):
+                # Two sources can reach the same cell in one wave - the brighter wins
+                np.maximum.at(level, cells, value[keep].astype(np.uint8))
+                reached.append(cells)
+        frontier = _unique(np.concatenate(reached), owner) if reached else ()
+
+
+def unspread_light(level, fixed, frontier, old, steps, down=None):
+    """ Take back the light the frontier cells gave out, back when they had the old levels. Any lit cell that's darker
+    than the cell it's next to might have got its light from there, so it goes dark too and passes it on. Brighter
+    cells have a light of their own, and are where spread_light() needs to start from to fill the gaps back in.
+
+    The frontier cells should already be dark. Returns (the cells to spread from, the cells that went dark).
+    """
+    size = len(level)
+    seeds = []
+    darkened = [frontier]
+    old = old.astype(np.int16)
+    while len(frontier):
+        reached = []
+        values = []
+        for face, step in enumerate(steps):
+            cells, inside = _neighbours(frontier, step, size)
+            cells, source = cells[inside], old[inside]
+            current = level[cells].astype(np.int16)
+            lit = current > 0
+            dependent = current < source
+            if face == down:
+                dependent |= (source == MAX_LIGHT) & (current == MAX_LIGHT)
+            dependent &= lit & ~fixed[cells]
+            seeds.append(cells[lit & ~dependent])
+            cells = cells[dependent]
+            level[cells] = 0
+            reached.append(cells)
+            values.append(current[dependent])
+        frontier = np.concatenate(reached)
+        old = np.concatenate(values)
+        darkened.append(frontier)
+    seeds = _unique(np.concatenate(seeds), np.empty(size, dtype=np.intp))
+    # A seed may have gone dark itself after it was picked
+    return seeds[level[seeds] > 0], np.concatenate(darkened)
+
+
+def relight(level, solid, fixed, changed, steps, down=None, emission=None):
+    """ Bring the light in the window up to date after the blocks in the changed cells did. All the light that
+    went through them is taken away and then let back in, which only ever touches the cells that light reached.
+    emission is each cell's own block light, for the block light channel.
+    """
+    old = level[changed]
+    level[changed] = 0
+    seeds, darkened = unspread_light(level, fixed, changed, old, steps, down)
+    if emission is not None:
+        # Light sources caught up in it (or just placed) shine again
+        glowing = darkened[emission[darkened] > 0]
+        level[glowing] = np.maximum(level[glowing], emission[glowing])
+        seeds = np.concatenate((seeds, glowing))
+    spread_light(level, solid, fixed, seeds, steps, down)
+
+
+def light_sources(level, solid, fixed, faces, down=None):
+    """ Return (as flat indices) the cells of a 3D window lighting up any neighbour that's darker than it should be -
+    everywhere spread_light() needs to start from, after light has been filled in without regard for the neighbours
+    """
+    source = level.astype(np.int16)
+    found = np.zeros(level.shape, dtype=bool)
+    open_ = ~solid & ~fixed
+    for face, delta in enumerate(faces):
+        # Pair each cell up with the one across the face from it
+        src = tuple(slice(max(0, -k), n - max(0, k)) for k, n in zip(delta, level.shape))
+        dst = tuple(slice(max(0, k), n + min(0, k)) for k, n in zip(delta, level.shape))
+        value = source[src] - 1
+        if face == down:
+            value[value == MAX_LIGHT - 1] = MAX_LIGHT
+        found[src] |= open_[dst] & (source[dst] < value)
+    return np.flatnonzero(found)
+
+
+def fix_edges(fixed):
+    """ Mark the outer layer of a 3D window as fixed, as it has to be. Returns fixed. """
+    fixed[[0, -1], :, :] = True
+    fixed[:, [0, -1], :] = True
+    fixed[:, :, [0, -1]] = True
+    return fixed
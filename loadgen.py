@@ -0,0 +1,254 @@
+#! python3
+""" Pycraft load generator - a crowd of pretend players for server.py """
+
+# Starts a server (unless pointed at one that's already running), connects --clients players to it and has
+# each of them wander about and build for --seconds. Every player keeps its own copy of the sectors it's sent
+# and applies the deltas to it, the way a real client would. At the end you get how steadily the ticks came,
+# how late they were, how much went over the wire, and how long an edit took to come back round as a delta.
+#
+#   python loadgen.py --clients 200 --seconds 20
+#   python loadgen.py --connect 127.0.0.1:7777 --clients 50
+from __future__ import division
+
+import argparse
+
+import asyncio
+
+import json
+
+import math
+
+import os
+
+import random
+
+import signal
+
+import socket
+
+import subprocess
+
+import sys
+
+import time
+
+import numpy as np
+
+from server import (BLOCK, DELTA, EDIT, FORGET, INTEREST_PAD, MOVE, PALETTE, POSITION, SECTOR, SECTOR_HEADER,
+                    SERVER_TICKS_PER_SEC, TICK, WELCOME, decode_sector, pack, read_message)
+
+MOVES_PER_SEC = 10
+
+EDITS_PER_SEC = 2
+# Edit messages each player sends a second - each one a handful of blocks
+
+
+class Bot(object):
+    """ One pretend player """
+
+    def __init__(self, rng, spread):
+        self.rng = rng
+        # Somewhere near spawn, then a random walk from there
+        self.position = [rng.uniform(-spread, spread), 0.0, rng.uniform(-spread, spread)]
+        self.heading = rng.uniform(0, 2 * math.pi)
+        self.sector_size = None
+        # ObjRelMap from sector to [y0, blocks] - this player's copy of the world
+        self.sectors = {}
+        self.palette = []
+        # ObjRelMap from position to when we asked for it to change
+        self.pending = {}
+        self.edit_latency = []
+        # Seconds from a tick leaving the server to it arriving here
+        self.tick_latency = []
+        # Seconds between ticks arriving
+        self.tick_gaps = []
+        self.last_tick = None
+        self.bytes = 0
+        self.messages = 0
+        self.started = None
+        # Seconds from connecting until every sector in range had arrived
+        self.join_time = None
+        self.interest = INTEREST_PAD
+
+    async def run(self, host, port, seconds):
+        reader, writer = await asyncio.open_connection(host, port)
+        self.started = time.perf_counter()
+        receiving = asyncio.ensure_future(self.receive(reader))
+        try:
+            await self.drive(writer, seconds)
+        finally:
+            receiving.cancel()
+            writer.close()
+
+    async def drive(self, writer, seconds):
+        """ Walk about and build, until the time's up """
+        step = 1.0 / MOVES_PER_SEC
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            self.heading += self.rng.uniform(-0.3, 0.3)
+            self.position[0] += math.cos(self.heading) * 5 * step
+            self.position[2] += math.sin(self.heading) * 5 * step
+            writer.write(pack(MOVE, POSITION.pack(*self.position)))
+            if self.sectors and self.palette and self.rng.random() < EDITS_PER_SEC * step:
+                writer.write(pack(EDIT, self.edits()))
+            await asyncio.sleep(step)
+
+    def edits(self):
+        """ An EDIT payload placing (or digging out) a few blocks somewhere near us, in sectors we've been sent """
+        x, _, z = [int(round(v)) for v in self.position]
+        n = self.sector_size
+        now = time.perf_counter()
+        blocks = []
+        for _ in range(4):
+            position = (x + self.rng.randint(-8, 8), self.rng.randint(0, 6), z + self.rng.randint(-8, 8))
+            if (position[0] // n, 0, position[2] // n) not in self.sectors:
+                continue
+            blocks.append(position + (self.rng.randrange(len(self.palette)),))
+            self.pending.setdefault(position, now)
+        return np.array(blocks, dtype=BLOCK).tobytes()
+
+    async def receive(self, reader):
+        while True:
+            kind, payload = await read_message(reader)
+            self.bytes += len(payload)
+            self.messages += 1
+            if kind == WELCOME:
+                welcome = json.loads(payload.decode('utf-8'))
+                self.sector_size = welcome['sector_size']
+                self.interest = welcome['interest']
+            elif kind == PALETTE:
+                self.palette = json.loads(payload.decode('utf-8'))
+            elif kind == SECTOR:
+                sector, y0, blocks = decode_sector(payload, self.sector_size)
+                self.sectors[sector] = [y0, None if blocks is None else blocks.copy()]
+                if self.join_time is None and len(self.sectors) >= (2 * self.interest + 1) ** 2:
+                    self.join_time = time.perf_counter() - self.started
+            elif kind == FORGET:
+                x, z = SECTOR_HEADER.unpack(payload)
+                self.sectors.pop((x, 0, z), None)
+            elif kind == DELTA:
+                self.delta(payload)
+
+    def delta(self, payload):
+        now = time.perf_counter()
+        _, sent = TICK.unpack_from(payload)
+        self.tick_latency.append(max(0.0, time.time() - sent))
+        if self.last_tick is not None:
+            self.tick_gaps.append(now - self.last_tick)
+        self.last_tick = now
+        n = self.sector_size
+        for x, y, z, block_id in np.frombuffer(payload, dtype=BLOCK, offset=TICK.size).tolist():
+            asked = self.pending.pop((x, y, z), None)
+            if asked is not None:
+                self.edit_latency.append(now - asked)
+            held = self.sectors.get((x // n, 0, z // n))
+            if held is None or held[1] is None:
+                continue
+            y0, blocks = held
+            if 0 <= y - y0 < blocks.shape[1]:
+                blocks[x % n, y - y0, z % n] = block_id
+
+
+def percentiles(values, *points):
+    if not values:
+        return [float('nan')] * len(points)
+    values = sorted(values)
+    return [values[min(len(values) - 1, int(len(values) * point / 100.0))] for point in points]
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(port, seed, ticks, interest):
+    """ Run server.py in a process of its own, and wait for it to be listening """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    process = subprocess.Popen([sys.executable, path, '--port', str(port), '--seed', str(seed),
+                                '--ticks', str(ticks), '--interest', str(interest)],
+                               stdout=subprocess.PIPE, universal_newlines=True)
+    process.stdout.readline()
+    return process
+
+
+async def swarm(host, port, clients, seconds, seed, ramp):
+    rng = random.Random(seed)
+    bots = [Bot(random.Random(rng.getrandbits(32)), 32) for _ in range(clients)]
+    tasks = []
+    for bot in bots:
+        tasks.append(asyncio.ensure_future(bot.run(host, port, seconds)))
+        # Don't have everyone walk through the door at the same moment
+        await asyncio.sleep(ramp / max(1, clients))
+    await asyncio.gather(*tasks)
+    return bots
+
+
+def report(bots, seconds, ticks):
+    gaps = [gap for bot in bots for gap in bot.tick_gaps]
+    lag = [lag for bot in bots for lag in bot.tick_latency]
+    edits = [latency for bot in bots for latency in bot.edit_latency]
+    joins = [bot.join_time for bot in bots if bot.join_time is not None]
+    received = sum(bot.bytes for bot in bots)
+    result = {
+        'clients': len(bots),
+        'seconds': seconds,
+        'ticks_per_sec': len(gaps) / sum(gaps) if gaps else 0.0,
+        'target_ticks_per_sec': ticks,
+        'tick_gap_p50_p99_ms': [v * 1000 for v in percentiles(gaps, 50, 99)],
+        'tick_latency_p50_p95_p99_ms': [v * 1000 for v in percentiles(lag, 50, 95, 99)],
+        'edit_latency_p50_p95_p99_ms': [v * 1000 for v in percentiles(edits, 50, 95, 99)],
+        'edits_confirmed': len(edits),
+        'join_p50_max_s': [percentiles(joins, 50)[0], max(joins) if joins else float('nan')],
+        'joined': len(joins),
+        'received_kb_per_sec': received / seconds / 1024,
+        'messages_per_sec': sum(bot.messages for bot in bots) / seconds,
+    }
+    print('%d clients, %.0f s' % (result['clients'], seconds))
+    print('  ticks          %.1f/s per client (target %d), gap p50 %.1f ms  p99 %.1f ms' % (
+        (result['ticks_per_sec'], ticks) + tuple(result['tick_gap_p50_p99_ms'])))
+    print('  tick latency   p50 %.1f ms  p95 %.1f ms  p99 %.1f ms' % tuple(result['tick_latency_p50_p95_p99_ms']))
+    print('  edit latency   p50 %.1f ms  p95 %.1f ms  p99 %.1f ms  (%d edits)' % (
+        tuple(result['edit_latency_p50_p95_p99_ms']) + (len(edits),)))
+    print('  join           p50 %.2f s  max %.2f s  (%d of %d joined)' % (
+        tuple(result['join_p50_max_s']) + (len(joins), len(bots))))
+    print('  received       %.1f KB/s, %.0f messages/s in total' % (
+        result['received_kb_per_sec'], result['messages_per_sec']))
+    return result
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--ramp', type=float, default=1.0, help='seconds over which the clients connect')
+    parser.add_argument('--connect', help='host:port of a running server (default: start one)')
+    parser.add_argument('--ticks', type=int, default=SERVER_TICKS_PER_SEC, help='tick rate for the server we start')
+    parser.add_argument('--interest', type=int, default=INTEREST_PAD, help='interest radius for the server we start')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    process = None
+    if args.connect:
+        host, port = args.connect.rsplit(':', 1)
+        port = int(port)
+    else:
+        host, port = '127.0.0.1', free_port()
+        process = start_server(port, args.seed, args.ticks, args.interest)
+    try:
+        bots = asyncio.run(swarm(host, port, args.clients, args.seconds, args.seed, args.ramp))
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGINT)
+            process.wait()
+    result = report(bots, args.seconds, args.ticks)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    cli()
@@ -2,6 +2,7 @@
 
 # This program is heavily dependent on the Pyglet module.
 ## Please ensure you're using Pyglet v1.3
+## NumPy holds the block storage, so you'll want that installed too.
 # TODO:  Ensure the Code eventually adheres to PEP-8 guidelines.
 """ Pycraft - the Pythonic version of Minecraft """
 
@@ -9,24 +10,58 @@
 #               You believed in me, when even I did not.
 from __future__ import division
 
+import argparse
+
+import ctypes
+
+import functools
+
+import hashlib
+
+import heapq
+
+import json
+
 import math
 
+import os
+
 import random
 
 import sys
 
+import threading
+
 import time
 
-from collections import deque
+import traceback
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+import pyglet
 from pyglet import image
 from pyglet.gl import *
 from pyglet.graphics import TextureGroup
 from pyglet.window import key, mouse
 
+from lighting import (FULL_SKY, MAX_LIGHT, face_steps, fix_edges, light_sources, pack_light, relight, split_light,
+                      spread_light)
+from occlusion import ALL_FACES, connectivity, face_links, visible_sectors
+from region import EMPTY_SECTOR, RegionStore
+from snapshot import SnapshotSector, read_snapshot, write_snapshot
+
 TICKS_PER_SEC = 60
 
 SECTOR_SIZE = 16
 
+CHUNK_HEIGHT = 16
+# Sector block arrays grow up and down in slabs of this many layers.
+
+NO_HEIGHT = -2 ** 31
+# What a Chunk's heightmap says for a column with no blocks in it
+
 WALKING_SPEED = 5
 
 FLYING_SPEED = 15
@@ -44,11 +79,247 @@ TERMINAL_VELOCITY = 50
 PLAYER_HEIGHT = 2
 # Because we don't need Yao Ming running around.
 
+PLAYER_PAD = 0.25
+# Half the player's width - and how far the top of their head sits above their eyes.
+
+COLLISION_EPSILON = 1e-6
+# Boxes closer than this to a block are touching it, not overlapping it.
+
+PHYSICS_TICKS_PER_SEC = 60
+# Physics steps at this fixed rate however often update() gets called. Drawing interpolates between steps.
+
+MAX_FRAME_TIME = 0.25
+# Longest stretch of real time update() will try to catch up on in one go.
+
+FIELD_OF_VIEW = 65.0
+# Vertical, in degrees
+
+NEAR_PLANE = 0.1
+
+SHOW_PAD = 4
+# Sectors within this many of the player are drawn in full
+
+LOD_PAD = 8
+# ... and out to this many, as low detail stand-ins (see mesh_far())
+
+LOD_SCALE = 4
+# Width and depth, in blocks, of each column of a low detail mesh. Has to divide SECTOR_SIZE.
+
+LOD_HYSTERESIS = 1
+# How many sectors past the line a sector has to get before it switches detail, so pacing up and down doesn't thrash
+
+FAR_PLANE = float((LOD_PAD + 1) * SECTOR_SIZE)
+# Nothing past this gets drawn. Lines up with where the fog ends.
+
+FOG_START = float(SHOW_PAD * SECTOR_SIZE)
+# The fog starts about where the detail drops off
+
+QUEUE_MIN_BUDGET = 0.002
+# Seconds per tick the sector queue always gets, even when drawing eats the whole tick.
+
+MESH_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+# Threads meshing sectors in the background. 0 meshes everything on the main thread instead.
+
+MESH_BACKLOG = 2 * MESH_WORKERS
+# Most sectors handed to the workers at once, so the queue can still re-prioritise as the player moves.
+
+TRACE_SECONDS = 10
+# How much history a trace dump covers.
+
+TRACE_CAPACITY = 200000
+# Most spans the tracer remembers, however busy those seconds were.
+
+FRAME_SAMPLES = 300
+# Frame times kept for the percentiles in the overlay.
+
+TARGET_FPS = 60
+# The frame rate the view distance gets adjusted to hold.
+
+MIN_VIEW_PAD = 2
+
+MAX_VIEW_PAD = 16
+# How far (in sectors) the view distance can shrink and grow.
+
+VIEW_SAMPLES = 120
+# Frames the view distance controller looks at before making up its mind.
+
+VIEW_BACKLOG = 24
+# Queued sectors past which the view distance won't grow - the queue isn't keeping up as it is.
+
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+# Where the game keeps its startup snapshots, unless told otherwise
+
+SPAWN_SECTOR = (0, 0, 0)
+# The sector the player starts in, and the one the startup snapshot is taken around
+
+SNAPSHOT_SOURCES = ('main.py', 'lighting.py', 'snapshot.py')
+# The code that goes into what a startup snapshot holds - terrain, meshes, light and the file itself. A change to any of
+# them makes the snapshots taken before it stale.
+
+LIGHT_RADIUS = MAX_LIGHT
+# How far (in blocks, sideways) an edit can change the light
+
+LIGHT_FALLOFF = 0.8
+# Every level of light below the brightest is this much darker than the one above it...
+MIN_BRIGHTNESS = 0.1
+# ... down to this, so the darkest caves are dark rather than black
+
+AMBIENT_OCCLUSION = True
+# Shade the corners where blocks meet (see mesh_blocks())
+AO_SHADE = (1.0, 0.8, 0.65, 0.5)
+# How much of the light a vertex keeps with 0, 1, 2 or 3 blocks crowding it
+
+MESH_CACHE_VERTICES = 500000
+# Most vertices the meshes of hidden sectors get to keep between them (about 23 bytes apiece), in case they're shown
+# again before anything about them changes
+
+FALL_TICKS = 3
+# Game ticks (physics steps) between each block a falling block falls - 20 blocks a second
+
+BLOCK_UPDATES_PER_TICK = 512
+# Most block updates a game tick works through. Any more than that wait for the next one.
+
+LINKS_PER_FRAME = 4
+# Sectors a frame works out the face links of for occlusion culling (see occlusion.py). The ones still waiting
+# can't hide anything yet.
+
+ENTITY_CAPACITY = 256
+# Entities the arrays have room for to begin with. They double whenever they fill up.
+
+ENTITY_LIFETIME = 300.0
+# Seconds an entity sticks around for unless told otherwise
+
+ENTITY_FLOOR = -64
+# Anything that falls out of the bottom of the world is gone once it gets this far down
+
+ENTITY_FRICTION = 8.0
+# How fast (per second) an entity on the ground slows down sideways
+
+THROW_SPEED = 15.0
+
+THROWN_SIZE = 0.25
+# Thrown blocks are little cubes this wide
+
 if sys.version_info[0] >= 3:
     # version_info[0] is the equivalent to sys.version_info.major
     xrange = range
 
 
+class Span(object):
+    """ One timed section of a trace - use it as a context manager """
+    __slots__ = ('tracer', 'name', 'start')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        self.tracer.events.append(('X', self.name, self.start, end - self.start, threading.current_thread().ident))
+
+
+class NullSpan(object):
+    """ What Tracer.span() gives you while tracing is off. Does nothing, quickly. """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer(object):
+    """ Remembers where the time went. Spans and counters go into a ring buffer, so it never grows past
+    TRACE_CAPACITY, and the last few seconds can be dumped as Chrome trace_event JSON (chrome://tracing,
+    or ui.perfetto.dev). While it's off, span() hands back a shared do-nothing object and that's it.
+    """
+
+    def __init__(self, seconds=TRACE_SECONDS, capacity=TRACE_CAPACITY):
+        self.enabled = False
+        # How far back dump() goes
+        self.seconds = seconds
+        # ('X', name, start, duration, thread) spans and ('C', name, time, value, thread) counters
+        self.events = deque(maxlen=capacity)
+        # Seconds between the last FRAME_SAMPLES frames
+        self.frames = deque(maxlen=FRAME_SAMPLES)
+        self._last_frame = None
+
+    def span(self, name):
+        """ Return a context manager timing everything inside it as name """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def counter(self, name, value):
+        """ Record the current value of something worth graphing, like the queue depth """
+        if self.enabled:
+            self.events.append(('C', name, time.perf_counter(), value, threading.current_thread().ident))
+
+    def frame(self):
+        """ Mark the start of a frame """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self._last_frame is not None:
+            self.frames.append(now - self._last_frame)
+        self._last_frame = now
+
+    def percentiles(self, *points):
+        """ Return the given percentiles of recent frame times, in seconds """
+        if not self.frames:
+            return [0.0] * len(points)
+        frames = sorted(self.frames)
+        return [frames[min(len(frames) - 1, int(len(frames) * point / 100.0))] for point in points]
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self._last_frame = None
+        self.frames.clear()
+
+    def dump(self, path, seconds=None):
+        """ Write the last seconds (default: self.seconds) of events to path as Chrome trace_event JSON """
+        since = time.perf_counter() - (self.seconds if seconds is None else seconds)
+        trace = []
+        for kind, name, start, value, thread in list(self.events):
+            if start < since:
+                continue
+            event = {'name': name, 'ph': kind, 'ts': start * 1e6, 'pid': os.getpid(), 'tid': thread}
+            if kind == 'X':
+                event['dur'] = value * 1e6
+            else:
+                event['args'] = {name: value}
+            trace.append(event)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+        return len(trace)
+
+
+# Everybody shares the one tracer, so there's nothing to pass around
+TRACER = Tracer()
+
+
+def traced(func):
+    """ Decorator putting a trace span around every call to func. Costs an attribute check while tracing is off. """
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not TRACER.enabled:
+            return func(*args, **kwargs)
+        with Span(TRACER, name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
 # You're going to see dy, dx, and dz appear a LOT.
 # These are the cube faces on each axis of a coordinate plane
 # dx - X axis
@@ -122,6 +393,213 @@ FACES = [
     (0, 0, -1),
 ]
 
+# The four corners of each face of a block centred on the origin, in FACES order.
+# Meshing a face is then just adding the block position on.
+FACE_VERTICES = np.array(cube_vertices(0, 0, 0, 0.5), dtype=np.float32).reshape(6, 4, 3)
+
+
+def face_corners():
+    """ For each corner of each face, the three blocks out in front of the face that can crowd that corner - the two
+    alongside it and the one diagonally across. Returns their offsets from the block, shaped (6, 4, 3, 3).
+    """
+    result = np.zeros((6, 4, 3, 3), dtype=np.int64)
+    for face, normal in enumerate(FACES):
+        u, v = [axis for axis in xrange(3) if not normal[axis]]
+        for corner, vertex in enumerate(FACE_VERTICES[face]):
+            side_u = np.array(normal)
+            side_u[u] += int(np.sign(vertex[u]))
+            side_v = np.array(normal)
+            side_v[v] += int(np.sign(vertex[v]))
+            result[face, corner] = side_u, side_v, side_u + side_v - normal
+    return result
+
+
+FACE_CORNERS = face_corners()
+
+# Vertex colour for each light level - it multiplies the texture, so 255 leaves it as it is
+BRIGHTNESS = 255 * np.maximum(MIN_BRIGHTNESS, LIGHT_FALLOFF ** (MAX_LIGHT - np.arange(MAX_LIGHT + 1)))
+
+# ... and with the ambient occlusion on top, by [light level, blocks crowding the corner]
+SHADES = (BRIGHTNESS[:, None] * np.asarray(AO_SHADE)[None, :]).astype(np.uint8)
+
+
+def empty_mesh():
+    """ A mesh with nothing in it """
+    return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.uint8)
+
+
+@traced
+def mesh_blocks(blocks, masks, light, origin, uvs, ambient_occlusion=False):
+    """ Build the geometry for a sector - only the faces that touch air make the cut. Each face is as bright as
+    the air in front of it, which gets baked into the vertex colours.
+
+    Params
+    -------
+    blocks: the sector's palette id array, with a one block border all round (see World.padded_blocks())
+    masks: the exposure masks of the blocks inside the border - bit i is set when face FACES[i] touches air
+    light: the packed light levels to go with blocks (see World.padded_light()), or None for full brightness
+    origin: world position of masks[0, 0, 0]
+    uvs: per-face texture coordinates for each palette id, shaped (palette size, 6, 8)
+    ambient_occlusion: darken each corner of a face by how many blocks are crowding it
+
+    then Returns:
+    -------
+    (vertex_data, texture_data, colour_data): flat float32 arrays, four vertices per face, ready for GL_QUADS, and a
+    flat uint8 array of their RGB colours
+    """
+    vertex_data = []
+    texture_data = []
+    colour_data = []
+    if blocks is None:
+        return empty_mesh()
+    if light is not None:
+        level = np.maximum(*split_light(light)).ravel()
+    # Everything from here on goes by flat index into the padded arrays, which saves a lot of fancy indexing
+    _, height, depth = blocks.shape
+    strides = np.array([height * depth, depth, 1])
+    solid = (blocks != 0).ravel()
+    corners = FACE_CORNERS.dot(strides)
+    for face, normal in enumerate(FACES):
+        xs, ys, zs = np.nonzero(masks & (1 << face))
+        if not len(xs):
+            continue
+        centres = np.stack((xs, ys, zs), axis=1).astype(np.float32)
+        centres += np.asarray(origin, dtype=np.float32)
+        vertex_data.append((centres[:, None, :] + FACE_VERTICES[face]).ravel())
+        cells = ((xs + 1) * height + ys + 1) * depth + zs + 1
+        texture_data.append(uvs[blocks.ravel()[cells], face].ravel())
+        if light is None:
+            levels = np.full((len(cells), 1), MAX_LIGHT)
+        else:
+            levels = level[cells + strides.dot(normal)][:, None]
+        if ambient_occlusion:
+            # (faces, 4 corners, 3 neighbours) - Minecraft's trick: two sides crowd a corner as much as three blocks do
+            crowd = solid[cells[:, None, None] + corners[face]]
+            count = np.where(crowd[..., 0] & crowd[..., 1], 3, crowd.sum(axis=2))
+        else:
+            count = np.zeros((1, 4), dtype=np.int64)
+        colour_data.append(np.repeat(SHADES[levels, count].ravel(), 3))
+    if not vertex_data:
+        return empty_mesh()
+    return np.concatenate(vertex_data), np.concatenate(texture_data), np.concatenate(colour_data)
+
+
+@traced
+def mesh_far(blocks, origin, uvs, scale=LOD_SCALE):
+    """ Build the low detail stand-in for a far away sector - just the surface, in columns scale blocks across.
+    Each column is a box as tall as the highest block in it, wearing that block's texture: a lid, plus walls
+    where it stands above the column next door. The walls around the edge of the sector run down past the
+    lowest column, as a skirt to hide the cracks between sectors.
+
+    Takes the sector's blocks (without a border), their origin and the uvs, and gives back the same kind of arrays as
+    mesh_blocks() - with everything as bright as open sky. Nobody can see shadows from way out there.
+    """
+    if blocks is None:
+        return empty_mesh()
+    n, height, _ = blocks.shape
+    c = n // scale
+    solid = blocks != 0
+    # Local y of the highest block in every x, z column - -1 where there isn't one
+    tops = np.where(solid.any(axis=1), height - 1 - np.argmax(solid[:, ::-1, :], axis=1), -1)
+    ids = np.take_along_axis(blocks, np.maximum(tops, 0)[:, None, :], axis=1)[:, 0, :]
+    # Gather each column's scale x scale tops together, and pick the highest
+    cells = tops.reshape(c, scale, c, scale).transpose(0, 2, 1, 3).reshape(c, c, -1)
+    pick = np.argmax(cells, axis=2)[..., None]
+    cell_tops = np.take_along_axis(cells, pick, axis=2)[..., 0]
+    cell_ids = np.take_along_axis(ids.reshape(c, scale, c, scale).transpose(0, 2, 1, 3).reshape(c, c, -1),
+                                  pick, axis=2)[..., 0]
+    full = cell_tops >= 0
+    if not full.any():
+        return empty_mesh()
+    skirt = cell_tops[full].min() - 1
+    padded = np.pad(np.where(full, cell_tops, skirt), 1, 'constant', constant_values=skirt)
+    ox, oy, oz = origin
+    i, j = np.nonzero(full)
+    los = []
+    his = []
+    faces = []
+    block_ids = []
+    for face, (dx, _, dz) in enumerate(FACES):
+        if face == 1:
+            continue  # Nobody's looking at the bottom from way out here
+        if face == 0:
+            keep = np.ones(len(i), dtype=bool)
+            bottom = cell_tops[i, j]
+        else:
+            bottom = padded[i + 1 + dx, j + 1 + dz]
+            keep = bottom < cell_tops[i, j]
+        ki, kj = i[keep], j[keep]
+        lo = np.stack((ox + ki * scale - 0.5, oy + bottom[keep] + 0.5, oz + kj * scale - 0.5), axis=1)
+        hi = np.stack((lo[:, 0] + scale, oy + cell_tops[ki, kj] + 0.5, lo[:, 2] + scale), axis=1)
+        los.append(lo)
+        his.append(hi)
+        faces.append(np.full(len(ki), face))
+        block_ids.append(cell_ids[ki, kj])
+    lo = np.concatenate(los).astype(np.float32)
+    hi = np.concatenate(his).astype(np.float32)
+    faces = np.concatenate(faces)
+    # Each quad is one face of its box - FACE_VERTICES is a unit cube, so stretch it to the box
+    vertex_data = ((lo + hi)[:, None, :] / 2 + FACE_VERTICES[faces] * (hi - lo)[:, None, :]).ravel()
+    texture_data = uvs[np.concatenate(block_ids), faces].ravel()
+    colour_data = np.full(len(vertex_data), int(BRIGHTNESS[MAX_LIGHT]), dtype=np.uint8)
+    return vertex_data, texture_data, colour_data
+
+
+def gl_rotation(angle, x, y, z):
+    """ The 3x3 matrix glRotatef(angle, x, y, z) would multiply in """
+    x, y, z = np.array([x, y, z], dtype=np.float64) / math.sqrt(x * x + y * y + z * z)
+    c = math.cos(math.radians(angle))
+    s = math.sin(math.radians(angle))
+    t = 1 - c
+    return np.array([
+        [x * x * t + c, x * y * t - z * s, x * z * t + y * s],
+        [y * x * t + z * s, y * y * t + c, y * z * t - x * s],
+        [x * z * t - y * s, y * z * t + x * s, z * z * t + c],
+    ])
+
+
+def frustum_planes(position, rotation, aspect, fov=FIELD_OF_VIEW, near=NEAR_PLANE, far=FAR_PLANE):
+    """ Return the six planes (a, b, c, d) of the view frustum Window.set_3d() sets up, facing inwards - so a point
+    is inside when a * x + b * y + c * z + d >= 0 for all of them
+    """
+    f = 1.0 / math.tan(math.radians(fov) / 2)
+    projection = np.array([
+        [f / aspect, 0, 0, 0],
+        [0, f, 0, 0],
+        [0, 0, (far + near) / (near - far), 2 * far * near / (near - far)],
+        [0, 0, -1, 0],
+    ])
+    x, y = rotation
+    modelview = np.identity(4)
+    modelview[:3, :3] = gl_rotation(x, 0, 1, 0).dot(
+        gl_rotation(-y, math.cos(math.radians(x)), 0, math.sin(math.radians(x))))
+    modelview[:3, 3] = modelview[:3, :3].dot(-np.asarray(position, dtype=np.float64))
+    clip = projection.dot(modelview)
+    # Gribb & Hartmann - the planes fall straight out of the rows of the clip matrix
+    return np.array([
+        clip[3] + clip[0], clip[3] - clip[0],  # left, right
+        clip[3] + clip[1], clip[3] - clip[1],  # bottom, top
+        clip[3] + clip[2], clip[3] - clip[2],  # near, far
+    ])
+
+
+def boxes_in_frustum(lo, hi, planes):
+    """ Return which of the (n, 3) boxes from lo to hi are at least partly inside the frustum planes """
+    normals = planes[:, :3]
+    # For each plane, the corner of each box furthest along the plane's normal
+    corners = np.where(normals[None, :, :] >= 0, hi[:, None, :], lo[:, None, :])
+    distance = (corners * normals[None, :, :]).sum(axis=2) + planes[None, :, 3]
+    return (distance >= 0).all(axis=1)
+
+
+def player_box(position, height):
+    """ Return the (lo, hi) corners of the box the player at the given (eye) position takes up. It's PLAYER_PAD either
+    side of the eyes on x and z, PLAYER_PAD above them, and down to half a block short of height below the top
+    """
+    x, y, z = position
+    return ((x - PLAYER_PAD, y + PLAYER_PAD - height + 0.5, z - PLAYER_PAD),
+            (x + PLAYER_PAD, y + PLAYER_PAD, z + PLAYER_PAD))
+
 
 def normalize(position):
     """ Accepts the 'position' of random precision, and returns the block
@@ -148,241 +626,2358 @@ def sectorize(position):
     return (x, 0, z)
 
 
-class Model(object):
+class BlockType(object):
+    """ What a kind of block is, beyond what it looks like. Solid blocks get in the way of anything moving, the
+    unbreakable ones can't be dug out by the player, emission is the block light (0 to MAX_LIGHT) it gives out, and
+    blocks that fall don't stay up with nothing under them (see Model.update_blocks()).
+    """
+    __slots__ = ('name', 'texture', 'solid', 'breakable', 'emission', 'falls')
+
+    def __init__(self, name, texture, solid=True, breakable=True, emission=0, falls=False):
+        self.name = name
+        self.texture = texture
+        self.solid = solid
+        self.breakable = breakable
+        self.emission = emission
+        self.falls = falls
+
+    def __repr__(self):
+        return 'BlockType(%r)' % self.name
+
+
+BLOCK_TYPES = [
+    BlockType('grass', GRASS),
+    BlockType('sand', SAND, falls=True),
+    BlockType('brick', BRICK),
+    # The floor of the world and the walls round it - dig through that and you're falling forever
+    BlockType('stone', STONE, breakable=False),
+]
+# The blocks we know about. A texture that isn't here (out of someone else's save, say) is a plain solid block.
 
-    def __init__(self):
 
-        # Collection of vertex lists to render in batches
-        self.batch = pyglet.graphics.Batch()
+class BlockRegistry(object):
+    """ Every kind of block a World has come across, under a small integer id - the palette id the Chunks store.
+    Ids are handed out in the order the textures turn up, which is what saves and snapshots go by, and 0 is air.
+
+    Along with the BlockTypes, it keeps each of their properties as an array indexed by id, so whole Chunks' worth of
+    ids can be looked up in one go: solid, breakable, emission, falls, and uvs - the texture coordinates of every face,
+    shaped (len(registry), 6, 8). The arrays get replaced as the registry grows, so don't hang on to them.
+    """
+
+    def __init__(self, known=BLOCK_TYPES):
+        # ObjRelMap from tuple(texture) to the BlockType to use when that texture turns up
+        self._known = dict((tuple(block_type.texture), block_type) for block_type in known)
+        # Id -> BlockType
+        self.types = [None]
+        # Id -> texture - the palette, as saved and sent to clients
+        self.textures = [None]
+        # tuple(texture) -> id
+        self._ids = {}
+        self.solid = np.zeros(1, dtype=bool)
+        self.breakable = np.zeros(1, dtype=bool)
+        self.emission = np.zeros(1, dtype=np.uint8)
+        self.falls = np.zeros(1, dtype=bool)
+        self.uvs = np.zeros((1, 6, 8), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, block_id):
+        return self.types[block_id]
+
+    def id(self, texture):
+        """ Return the id for the texture, registering it if it's new """
+        k = tuple(texture)
+        block_id = self._ids.get(k)
+        if block_id is None:
+            block_id = len(self.types)
+            if block_id > np.iinfo(np.uint8).max:
+                raise ValueError('Too many block textures for the palette')
+            # A copy, so set_emission() on one world doesn't change every other one
+            known = self._known.get(k, BlockType('block %d' % block_id, texture))
+            block_type = BlockType(known.name, texture, known.solid, known.breakable, known.emission, known.falls)
+            self._ids[k] = block_id
+            self.types.append(block_type)
+            self.textures.append(texture)
+            self.solid = np.append(self.solid, block_type.solid)
+            self.breakable = np.append(self.breakable, block_type.breakable)
+            self.emission = np.append(self.emission, np.uint8(block_type.emission))
+            self.falls = np.append(self.falls, block_type.falls)
+            self.uvs = np.concatenate((self.uvs, np.reshape(texture, (1, 6, 8)).astype(np.float32)))
+        return block_id
+
+    def set_emission(self, block_id, level):
+        """ Have the blocks with the id give out block light, of level up to MAX_LIGHT """
+        self.types[block_id].emission = level
+        self.emission[block_id] = level
+
+
+class Chunk(object):
+    """ Dense block storage for a single sector. Every sector is a full column of the world, so the
+    array is SECTOR_SIZE wide on x and z, and grows on y as blocks get placed above or below it.
+    Each cell holds a palette id - 0 is air - a 6 bit mask of which of its faces touch air, and its light.
+
+    Alongside the arrays it keeps a couple of indexes for the World's queries, so they can answer for a whole chunk
+    without a scan: the height of each column, and how many of each kind of block there are. The World keeps them
+    up to date - see index().
+    """
+    __slots__ = ('sector', 'y0', 'blocks', 'masks', 'light', 'count', 'heights', 'type_counts')
+
+    def __init__(self, sector):
+        self.sector = sector
+        # World y of blocks[:, 0, :]
+        self.y0 = 0
+        self.blocks = np.zeros((SECTOR_SIZE, 0, SECTOR_SIZE), dtype=np.uint8)
+        # Bit i is set when face FACES[i] of the block is exposed. Always 0 for air.
+        self.masks = np.zeros((SECTOR_SIZE, 0, SECTOR_SIZE), dtype=np.uint8)
+        # Sky light in the high nibble, block light in the low one (see lighting.py). Above the array there's nothing
+        # but sky, and below it there's nothing but dark, so that's what the array grows into.
+        self.light = np.zeros((SECTOR_SIZE, 0, SECTOR_SIZE), dtype=np.uint8)
+        # Number of non-air cells, so empty chunks can be dropped without a scan
+        self.count = 0
+        # World y of the highest block in each (x, z) column, NO_HEIGHT where there isn't one
+        self.heights = np.full((SECTOR_SIZE, SECTOR_SIZE), NO_HEIGHT, dtype=np.int32)
+        # Number of blocks of each palette id. Air isn't counted.
+        self.type_counts = np.zeros(np.iinfo(np.uint8).max + 1, dtype=np.int64)
+
+    @property
+    def origin(self):
+        """ World position of blocks[0, 0, 0] """
+        x, _, z = self.sector
+        return (x * SECTOR_SIZE, self.y0, z * SECTOR_SIZE)
+
+    def reserve(self, y):
+        """ Grow the array (in CHUNK_HEIGHT slabs) until it covers world height y """
+        height = self.blocks.shape[1]
+        if not height:
+            self.y0 = (y // CHUNK_HEIGHT) * CHUNK_HEIGHT
+            self.blocks = np.zeros((SECTOR_SIZE, CHUNK_HEIGHT, SECTOR_SIZE), dtype=np.uint8)
+            self.masks = np.zeros_like(self.blocks)
+            self.light = np.full_like(self.blocks, FULL_SKY)
+            return
+        below = max(0, self.y0 - (y // CHUNK_HEIGHT) * CHUNK_HEIGHT)
+        above = max(0, (y // CHUNK_HEIGHT + 1) * CHUNK_HEIGHT - (self.y0 + height))
+        if below or above:
+            self.blocks = np.pad(self.blocks, ((0, 0), (below, above), (0, 0)), 'constant')
+            self.masks = np.pad(self.masks, ((0, 0), (below, above), (0, 0)), 'constant')
+            self.light = np.pad(self.light, ((0, 0), (below, above), (0, 0)), 'constant',
+                                constant_values=((0, 0), (0, FULL_SKY), (0, 0)))
+            self.y0 -= below
+
+    def index(self):
+        """ Work out count, heights and type_counts from scratch, after the blocks changed wholesale """
+        self.type_counts = np.bincount(self.blocks.ravel(), minlength=len(self.type_counts)).astype(np.int64)
+        self.type_counts[0] = 0
+        self.count = int(self.type_counts.sum())
+        filled = self.blocks != 0
+        top = self.blocks.shape[1] - 1 - np.argmax(filled[:, ::-1, :], axis=1)
+        self.heights = np.where(filled.any(axis=1), self.y0 + top, NO_HEIGHT).astype(np.int32)
+
+    def reindex(self, index, old):
+        """ Bring heights and type_counts up to date after the one block at the (local) index changed from the old
+        palette id. count is up to the World.
+        """
+        x, ly, z = index
+        new = self.blocks[index]
+        self.type_counts[old] -= 1
+        self.type_counts[new] += 1
+        self.type_counts[0] = 0
+        y = self.y0 + ly
+        if new and y > self.heights[x, z]:
+            self.heights[x, z] = y
+        elif not new and y == self.heights[x, z]:
+            below = np.flatnonzero(self.blocks[x, :ly, z])
+            self.heights[x, z] = self.y0 + below[-1] if len(below) else NO_HEIGHT
+
+    def positions(self):
+        """ World positions of every block in the chunk """
+        ox, oy, oz = self.origin
+        xs, ys, zs = np.nonzero(self.blocks)
+        return list(zip((xs + ox).tolist(), (ys + oy).tolist(), (zs + oz).tolist()))
+
+
+class World(object):
+    """ Chunked replacement for the old position -> texture dict. Blocks live in a dense per-sector
+    Chunk array of palette ids, which is a fraction of the size of a tuple-keyed dict. It still
+    quacks like a dict - world[position] gives you the texture back - so nothing above it has to care.
+
+    It also keeps the light in every chunk up to date as blocks come and go (pass lighting=False if nobody's going to
+    look at it). See lighting.py for how.
+    """
+
+    def __init__(self, lighting=True):
+        # ObjRelMap from sector to the Chunk holding its blocks
+        self.chunks = {}
+        # Every kind of block, by the palette id the chunks store. Id 0 is reserved for air.
+        self.registry = BlockRegistry()
+        # Palette id -> texture - the registry's list, so it stays up to date
+        self.palette = self.registry.textures
+        self.lighting = lighting
+        # ObjRelMap from sector to a counter bumped by every edit that could change the sector's mesh
+        self.versions = {}
+        # Bumped by every edit anywhere, for caches that depend on the whole world
+        self.edits = 0
+        self._count = 0
+
+    def version(self, sector):
+        """ Return the edit version of the sector - if it moved, any mesh built before then is stale """
+        return self.versions.get(sector, 0)
+
+    def _touch(self, position):
+        """ Bump the version of the block's sector, plus the sector next door when the block sits on the edge
+        (it's part of that sector's padded_blocks() border). Returns the sectors.
+        """
+        x, _, z = position
+        sx, sz = x // SECTOR_SIZE, z // SECTOR_SIZE
+        sectors = set([(sx, 0, sz)])
+        lx, lz = x % SECTOR_SIZE, z % SECTOR_SIZE
+        ox = -1 if lx == 0 else 1 if lx == SECTOR_SIZE - 1 else 0
+        oz = -1 if lz == 0 else 1 if lz == SECTOR_SIZE - 1 else 0
+        # ... and in a corner, the one diagonally across too, whose meshes' ambient occlusion can see it
+        sectors.update([(sx + ox, 0, sz), (sx, 0, sz + oz), (sx + ox, 0, sz + oz)])
+        for sector in sectors:
+            self.versions[sector] = self.versions.get(sector, 0) + 1
+        self.edits += 1
+        return sectors
+
+    def palette_id(self, texture):
+        """ Return the palette id for the texture, registering it if it's new """
+        return self.registry.id(texture)
+
+    def set_emission(self, texture, level):
+        """ Have blocks with the texture give out block light, of level up to MAX_LIGHT. Blocks already in the world
+        aren't relit, so this is one for before they're placed.
+        """
+        self.registry.set_emission(self.palette_id(texture), level)
+
+    def block_type(self, position):
+        """ Return the BlockType of the block at position, None if there isn't one """
+        return self.registry[self.block_id(position)]
+
+    def _locate(self, position):
+        """ Return (chunk, local index) for the position. The chunk is None if the sector has no storage,
+        and the index is None if the position is outside of the chunk's array.
+        """
+        x, y, z = position
+        chunk = self.chunks.get((x // SECTOR_SIZE, 0, z // SECTOR_SIZE))
+        if chunk is None:
+            return None, None
+        ly = y - chunk.y0
+        if not 0 <= ly < chunk.blocks.shape[1]:
+            return chunk, None
+        return chunk, (x % SECTOR_SIZE, ly, z % SECTOR_SIZE)
+
+    def block_id(self, position):
+        """ Return the palette id of the block at position, 0 if there isn't one """
+        chunk, index = self._locate(position)
+        if index is None:
+            return 0
+        return int(chunk.blocks[index])
+
+    @staticmethod
+    def group_by_sector(positions):
+        """ Yield (sector, rows) for an (n, 3) integer array of positions, rows being the indices of the positions
+        that fall in the sector
+        """
+        if not len(positions):
+            return
+        x = positions[:, 0] // SECTOR_SIZE
+        z = positions[:, 2] // SECTOR_SIZE
+        # One sort on a single number per sector, ordered the same as (x, z) - np.unique(axis=0) sorts twice as much
+        x0, z0 = x.min(), z.min()
+        keys = (x - x0) * (z.max() - z0 + 1) + (z - z0)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        bounds = np.append(np.flatnonzero(keys[1:] != keys[:-1]) + 1, len(keys))
+        start = 0
+        for end in bounds.tolist():
+            first = order[start]
+            yield (int(x[first]), 0, int(z[first])), order[start:end]
+            start = end
+
+    def block_ids(self, positions):
+        """ Vectorised block_id() - return the palette ids of an (n, 3) integer array of positions """
+        return self._lookup(positions, 'blocks', 0)
+
+    def light_levels(self, positions):
+        """ Return the packed light (see lighting.py) of an (n, 3) integer array of positions. Where there's no chunk,
+        or above its array, it's open sky.
+        """
+        return self._lookup(positions, 'light', FULL_SKY)
+
+    def _lookup(self, positions, name, above):
+        """ Private implementation of block_ids() and light_levels() - name is the Chunk array to read, and above is
+        what's taken to be past the top of it, or where there's no chunk at all. Below the arrays it's all zeros.
+        """
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+        result = np.full(len(positions), above, dtype=np.uint8)
+        for sector, rows in self.group_by_sector(positions):
+            chunk = self.chunks.get(sector)
+            if chunk is None:
+                continue
+            p = positions[rows]
+            ly = p[:, 1] - chunk.y0
+            result[rows[ly < 0]] = 0
+            inside = (ly >= 0) & (ly < chunk.blocks.shape[1])
+            rows, p, ly = rows[inside], p[inside], ly[inside]
+            result[rows] = getattr(chunk, name)[p[:, 0] % SECTOR_SIZE, ly, p[:, 2] % SECTOR_SIZE]
+        return result
+
+    def chunk(self, sector):
+        """ Return the Chunk for the sector, or None """
+        return self.chunks.get(sector)
+
+    def face_uvs(self):
+        """ Return the texture coordinates of every face of every palette id, shaped (palette size, 6, 8) """
+        return self.registry.uvs
+
+    def set_blocks(self, positions, block_ids):
+        """ Set a whole lot of blocks at once - (n, 3) integer positions to palette ids (0 removes). All the blocks go
+        in first, then each touched sector's exposure masks are worked out once, rather than fixing up six neighbours
+        per block. If a position turns up more than once, which id wins isn't defined.
+
+        Returns the sectors whose meshes might have changed.
+        """
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+        block_ids = np.broadcast_to(np.asarray(block_ids, dtype=np.uint8), (len(positions),))
+        changed = set()
+        # Sectors that are only in the mesh of ambient occlusion corners
+        corners = set()
+        # Chunks that didn't exist until now, and the rows of the positions in the ones that did
+        created = []
+        edited = []
+        for sector, rows in self.group_by_sector(positions):
+            p = positions[rows]
+            ids = block_ids[rows]
+            chunk = self.chunks.get(sector)
+            if chunk is None:
+                if not ids.any():
+                    continue
+                chunk = self.chunks[sector] = Chunk(sector)
+                created.append(sector)
+            adding = ids != 0
+            if adding.any():
+                chunk.reserve(int(p[adding, 1].min()))
+                chunk.reserve(int(p[adding, 1].max()))
+            ly = p[:, 1] - chunk.y0
+            # Removing what's outside the array is removing air - nothing to do
+            inside = (ly >= 0) & (ly < chunk.blocks.shape[1])
+            chunk.blocks[p[inside, 0] % SECTOR_SIZE, ly[inside], p[inside, 2] % SECTOR_SIZE] = ids[inside]
+            self._count -= chunk.count
+            chunk.index()
+            self._count += chunk.count
+            if not chunk.count:
+                del self.chunks[sector]
+            elif sector not in created:
+                edited.append(rows)
+            x, _, z = sector
+            changed.update([sector, (x - 1, 0, z), (x + 1, 0, z), (x, 0, z - 1), (x, 0, z + 1)])
+            edge = p[:, [0, 2]] % SECTOR_SIZE
+            edge = np.where(edge == 0, -1, np.where(edge == SECTOR_SIZE - 1, 1, 0))
+            for dx, dz in set(map(tuple, edge[(edge != 0).all(axis=1)].tolist())):
+                corners.add((x + dx, 0, z + dz))
+        for sector in changed:
+            self._compute_masks(sector)
+        for sector in changed | corners:
+            self.versions[sector] = self.versions.get(sector, 0) + 1
+        self.edits += 1
+        changed |= corners
+        if self.lighting:
+            # New chunks first - relighting the rest takes their light as read. Each one takes the light of the
+            # others next to it as read too, so they all start out dark: lighting only ever brightens, and a new
+            # chunk's array starts out as full sky, which would leak into the ones lit before it.
+            created = [sector for sector in created if sector in self.chunks]
+            for sector in created:
+                self.chunks[sector].light[:] = 0
+            for sector in created:
+                changed |= self._light_chunk(sector)
+            if edited:
+                changed |= self._relight(positions[np.concatenate(edited)])
+        return changed
+
+    def set_chunk(self, sector, chunk, compute_masks=True):
+        """ Swap in a whole Chunk for the sector in one go (None empties it). Much cheaper than setting a block at a time.
+        Pass compute_masks=False when the chunk's masks and light are already right and so are the neighbours' - i.e.
+        the sectors are coming back exactly as they were, all together.
+
+        When a chunk goes, the light it let into the chunks around it stays put. It only ever goes when it's far away.
+        """
+        old = self.chunks.pop(sector, None)
+        if old is not None:
+            self._count -= old.count
+        if chunk is not None:
+            chunk.index()
+            if chunk.count:
+                self.chunks[sector] = chunk
+                self._count += chunk.count
+        x, _, z = sector
+        for dx, dz in ((0, 0), (-1, 0), (1, 0), (0, -1), (0, 1)):
+            key = (x + dx, 0, z + dz)
+            # The neighbours' edge faces may have been covered or uncovered too
+            if compute_masks:
+                self._compute_masks(key)
+            self.versions[key] = self.versions.get(key, 0) + 1
+        self.edits += 1
+        # Coming back as it was means coming back lit, too
+        if compute_masks and self.lighting and sector in self.chunks:
+            self._light_chunk(sector)
+
+    def origin(self, sector):
+        """ World position of the first block in the sector's array """
+        chunk = self.chunks.get(sector)
+        if chunk is None:
+            x, _, z = sector
+            return (x * SECTOR_SIZE, 0, z * SECTOR_SIZE)
+        return chunk.origin
+
+    def padded_blocks(self, sector):
+        """ Return a copy of the sector's block array with a one block border borrowed from the eight
+        sectors around it (and air above and below), which is everything needed to tell which faces
+        are exposed from scratch. None if the sector is empty.
+        """
+        return self._padded(sector, 'blocks', 0)
+
+    def padded_light(self, sector):
+        """ The light to go with padded_blocks(). Where there's no chunk to borrow from, it's open sky. """
+        return self._padded(sector, 'light', FULL_SKY)
+
+    def _padded(self, sector, name, above):
+        """ Private implementation of padded_blocks() and padded_light() - name is the Chunk array to pad, and above
+        is what's taken to be past the top of the arrays. Below them it's all zeros.
+        """
+        chunk = self.chunks.get(sector)
+        if chunk is None:
+            return None
+        n = SECTOR_SIZE
+        height = chunk.blocks.shape[1]
+        result = np.full((n + 2, height + 2, n + 2), above, dtype=np.uint8)
+        result[:, 0, :] = 0
+        result[1:-1, 1:-1, 1:-1] = getattr(chunk, name)
+        x, _, z = sector
+        borders = [
+            # (dx, dz, destination x/z slices, source x/z slices)
+            (-1, 0, (0, slice(1, -1)), (n - 1, slice(None))),
+            (1, 0, (n + 1, slice(1, -1)), (0, slice(None))),
+            (0, -1, (slice(1, -1), 0), (slice(None), n - 1)),
+            (0, 1, (slice(1, -1), n + 1), (slice(None), 0)),
+            # The corners only matter to ambient occlusion
+            (-1, -1, (0, 0), (n - 1, n - 1)),
+            (-1, 1, (0, n + 1), (n - 1, 0)),
+            (1, -1, (n + 1, 0), (0, n - 1)),
+            (1, 1, (n + 1, n + 1), (0, 0)),
+        ]
+        for dx, dz, (dst_x, dst_z), (src_x, src_z) in borders:
+            other = self.chunks.get((x + dx, 0, z + dz))
+            if other is None:
+                continue
+            # Rows below the other chunk's array
+            below = min(height + 2, other.y0 - chunk.y0 + 1)
+            if below > 0:
+                result[dst_x, :below, dst_z] = 0
+            # Overlap of the two chunks' heights, in world y
+            lo = max(chunk.y0 - 1, other.y0)
+            hi = min(chunk.y0 + height + 1, other.y0 + other.blocks.shape[1])
+            if lo >= hi:
+                continue
+            dst_y = slice(lo - chunk.y0 + 1, hi - chunk.y0 + 1)
+            src_y = slice(lo - other.y0, hi - other.y0)
+            result[dst_x, dst_y, dst_z] = getattr(other, name)[src_x, src_y, src_z]
+        return result
+
+    def positions(self, sector):
+        """ Return the positions of every block within the sector """
+        chunk = self.chunks.get(sector)
+        if chunk is None:
+            return []
+        return chunk.positions()
+
+    def __contains__(self, position):
+        return self.block_id(position) != 0
+
+    def __getitem__(self, position):
+        block_id = self.block_id(position)
+        if not block_id:
+            raise KeyError(position)
+        return self.palette[block_id]
+
+    def get(self, position, default=None):
+        block_id = self.block_id(position)
+        if not block_id:
+            return default
+        return self.palette[block_id]
+
+    def __setitem__(self, position, texture):
+        self.set_block(position, self.palette_id(texture))
+
+    def __delitem__(self, position):
+        if not self.block_id(position):
+            raise KeyError(position)
+        self.set_block(position, 0)
+
+    def set_block(self, position, block_id):
+        """ Put the block with the palette id at position - or with 0, take away whatever's there. Just the one block,
+        so rather than working out whole sectors again, only the faces right next to it get fixed up, and only the
+        light it could have reached.
+
+        Returns the sectors whose meshes might have changed.
+        """
+        x, y, z = position
+        sector = (x // SECTOR_SIZE, 0, z // SECTOR_SIZE)
+        chunk = self.chunks.get(sector)
+        created = chunk is None
+        if created:
+            if not block_id:
+                return set()
+            chunk = self.chunks[sector] = Chunk(sector)
+        if block_id:
+            chunk.reserve(y)
+        elif not 0 <= y - chunk.y0 < chunk.blocks.shape[1]:
+            return set()
+        index = (x % SECTOR_SIZE, y - chunk.y0, z % SECTOR_SIZE)
+        old = int(chunk.blocks[index])
+        if bool(old) != bool(block_id):
+            count = 1 if block_id else -1
+            chunk.count += count
+            self._count += count
+            mask = self._update_neighbours(position, bool(block_id))
+            chunk.masks[index] = mask if block_id else 0
+        chunk.blocks[index] = block_id
+        chunk.reindex(index, old)
+        changed = self._touch(position)
+        if not chunk.count:
+            del self.chunks[sector]
+        elif self.lighting:
+            if created:
+                changed |= self._light_chunk(sector)
+            else:
+                changed |= self._relight(np.array([position], dtype=np.int64))
+        return changed
 
+    def _update_neighbours(self, position, added):
+        """ A block just appeared at (or vanished from) position - flip the face of each neighbouring block that
+        points at it, and return the exposure mask the block itself would have
+        """
+        x, y, z = position
+        mask = 0
+        for face, (dx, dy, dz) in enumerate(FACES):
+            chunk, index = self._locate((x + dx, y + dy, z + dz))
+            if index is None or not chunk.blocks[index]:
+                mask |= 1 << face
+            elif added:
+                # FACES come in opposite pairs, so face ^ 1 is the neighbour's face looking back at us
+                chunk.masks[index] &= 0x3f ^ (1 << (face ^ 1))
+            else:
+                chunk.masks[index] |= 1 << (face ^ 1)
+        return mask
+
+    def _compute_masks(self, sector):
+        """ Work out every exposure mask in the sector from scratch """
+        chunk = self.chunks.get(sector)
+        if chunk is None:
+            return
+        blocks = self.padded_blocks(sector)
+        core = blocks[1:-1, 1:-1, 1:-1]
+        solid = core != 0
+        w, h, d = core.shape
+        masks = np.zeros(core.shape, dtype=np.uint8)
+        for face, (dx, dy, dz) in enumerate(FACES):
+            neighbour = blocks[1 + dx:1 + dx + w, 1 + dy:1 + dy + h, 1 + dz:1 + dz + d]
+            masks |= (solid & (neighbour == 0)).astype(np.uint8) << face
+        chunk.masks = masks
+
+    def exposure(self, position):
+        """ Return the exposure mask of the block at position (0 for air, or a block buried on all sides) """
+        chunk, index = self._locate(position)
+        if index is None:
+            return 0
+        return int(chunk.masks[index])
+
+    def snapshot(self, sector):
+        """ Return (padded blocks, masks, padded light, origin) for the sector - everything mesh_blocks() needs, copied
+        so it's safe to hand to another thread. The arrays are None when the sector is empty, and the light is None
+        when the world isn't keeping any.
+        """
+        chunk = self.chunks.get(sector)
+        if chunk is None:
+            return None, None, None, self.origin(sector)
+        light = self.padded_light(sector) if self.lighting else None
+        return self.padded_blocks(sector), chunk.masks.copy(), light, chunk.origin
+
+    def highest_block(self, x, z):
+        """ Return the y of the highest block in the column at x, z - None if there's nothing there at all.
+        Straight off the chunk's heightmap.
+        """
+        chunk = self.chunks.get((x // SECTOR_SIZE, 0, z // SECTOR_SIZE))
+        if chunk is None:
+            return None
+        y = int(chunk.heights[x % SECTOR_SIZE, z % SECTOR_SIZE])
+        return None if y == NO_HEIGHT else y
+
+    def blocks_in_box(self, lo, hi):
+        """ Return the (n, 3) positions and (n,) palette ids of every block in the box from block lo to block hi (both
+        included). Only the chunks the box reaches into get looked at, and only the parts of them it covers.
+        """
+        positions = [np.zeros((0, 3), dtype=np.int64)]
+        block_ids = [np.zeros(0, dtype=np.uint8)]
+        for chunk, corner, blocks in self._boxes(lo, hi):
+            found = np.nonzero(blocks)
+            positions.append(np.stack(found, axis=1) + corner)
+            block_ids.append(blocks[found])
+        return np.concatenate(positions), np.concatenate(block_ids)
+
+    def count_by_type(self, lo=None, hi=None):
+        """ Return an ObjRelMap from palette id to how many of those blocks there are in the box from block lo to block
+        hi (both included) - or in the whole world, if there's no box. Chunks the box takes in whole are answered off
+        their type_counts, without looking at a block.
+        """
+        if lo is None:
+            parts = [chunk.type_counts for chunk in self.chunks.values()]
+        else:
+            parts = [chunk.type_counts if blocks.shape == chunk.blocks.shape else
+                     np.bincount(blocks.ravel(), minlength=len(chunk.type_counts))
+                     for chunk, _, blocks in self._boxes(lo, hi)]
+        counts = np.sum(parts, axis=0) if parts else np.zeros(1, dtype=np.int64)
+        return dict((int(block_id), int(counts[block_id])) for block_id in np.flatnonzero(counts[1:]) + 1)
+
+    def nearest(self, position, predicate=None, radius=SECTOR_SIZE):
+        """ Return the block nearest to position (going by block centres, within radius) whose BlockType predicate
+        says yes to - any block at all, without a predicate. None if there isn't one that close.
+
+        Chunks get searched nearest first, and the search stops at the first one further off than the best block so
+        far. Chunks without a single block of a kind that passes (going by their type_counts) are skipped outright.
+        """
+        wanted = np.zeros(np.iinfo(np.uint8).max + 1, dtype=bool)
+        for block_id in xrange(1, len(self.registry)):
+            wanted[block_id] = predicate is None or bool(predicate(self.registry[block_id]))
+        p = np.asarray(position, dtype=np.float64)
+        lo = np.ceil(p - radius).astype(np.int64)
+        hi = np.floor(p + radius).astype(np.int64)
+        boxes = []
+        for chunk, corner, blocks in self._boxes(lo, hi):
+            if not chunk.type_counts[wanted].any():
+                continue
+            # How close the box could possibly come
+            gap = np.maximum(0, np.maximum(corner - p, p - (corner + blocks.shape - 1)))
+            boxes.append((float(gap.dot(gap)), corner, blocks))
+        boxes.sort(key=lambda box: box[0])
+        best, best_distance = None, radius * radius
+        for distance, corner, blocks in boxes:
+            if distance > best_distance:
+                break
+            found = np.nonzero(wanted[blocks])
+            if not len(found[0]):
+                continue
+            cells = np.stack(found, axis=1) + corner
+            distances = ((cells - p) ** 2).sum(axis=1)
+            i = int(np.argmin(distances))
+            if distances[i] <= best_distance:
+                best, best_distance = tuple(cells[i].tolist()), float(distances[i])
+        return best
+
+    def _boxes(self, lo, hi):
+        """ Yield (chunk, world position of the corner, blocks) for every chunk with blocks in the box from block lo to
+        block hi (both included), blocks being a view of the part of the chunk's array inside the box. Columns that
+        the heightmap says top out below the box are skipped without a look.
+        """
+        lo, hi = np.minimum(lo, hi).tolist(), (np.maximum(lo, hi) + 1).tolist()
+        for sector, _, (cx, cz) in self._window_columns(lo, hi):
+            chunk = self.chunks.get(sector)
+            if chunk is None or chunk.heights[cx, cz].max() < lo[1]:
+                continue
+            y0, y1 = max(lo[1], chunk.y0), min(hi[1], chunk.y0 + chunk.blocks.shape[1])
+            if y0 < y1:
+                x, _, z = sector
+                yield (chunk, np.array((x * SECTOR_SIZE + cx.start, y0, z * SECTOR_SIZE + cz.start)),
+                       chunk.blocks[cx, y0 - chunk.y0:y1 - chunk.y0, cz])
+
+    def _window_columns(self, lo, hi):
+        """ Yield (sector, window x/z slices, chunk x/z slices) for every sector the box from lo to hi (world positions,
+        hi not included) reaches into
+        """
+        n = SECTOR_SIZE
+        for sx in xrange(lo[0] // n, (hi[0] - 1) // n + 1):
+            x0, x1 = max(lo[0], sx * n), min(hi[0], sx * n + n)
+            for sz in xrange(lo[2] // n, (hi[2] - 1) // n + 1):
+                z0, z1 = max(lo[2], sz * n), min(hi[2], sz * n + n)
+                yield ((sx, 0, sz), (slice(x0 - lo[0], x1 - lo[0]), slice(z0 - lo[2], z1 - lo[2])),
+                       (slice(x0 - sx * n, x1 - sx * n), slice(z0 - sz * n, z1 - sz * n)))
+
+    def _light_window(self, lo, hi):
+        """ Gather the box from lo to hi for the lighting engine - (blocks, light, fixed) arrays. Fixed cells are the
+        ones no chunk holds: open sky above a chunk's array, and the dark below it or where there isn't a chunk at all.
+        The light can't go through those, and it can't change them. (Fixing the box's outer layer is up to you.)
+        """
+        shape = tuple(b - a for a, b in zip(lo, hi))
+        blocks = np.zeros(shape, dtype=np.uint8)
+        light = np.zeros(shape, dtype=np.uint8)
+        fixed = np.ones(shape, dtype=bool)
+        for sector, (wx, wz), (cx, cz) in self._window_columns(lo, hi):
+            chunk = self.chunks.get(sector)
+            if chunk is None:
+                continue
+            top = chunk.y0 + chunk.blocks.shape[1]
+            light[wx, max(0, top - lo[1]):, wz] = FULL_SKY
+            y0, y1 = max(lo[1], chunk.y0), min(hi[1], top)
+            if y0 < y1:
+                wy, cy = slice(y0 - lo[1], y1 - lo[1]), slice(y0 - chunk.y0, y1 - chunk.y0)
+                blocks[wx, wy, wz] = chunk.blocks[cx, cy, cz]
+                light[wx, wy, wz] = chunk.light[cx, cy, cz]
+                fixed[wx, wy, wz] = False
+        return blocks, light, fixed
+
+    def _store_light(self, lo, hi, light):
+        """ Put the light from a _light_window() back into the chunks """
+        for sector, (wx, wz), (cx, cz) in self._window_columns(lo, hi):
+            chunk = self.chunks.get(sector)
+            if chunk is None:
+                continue
+            y0, y1 = max(lo[1], chunk.y0), min(hi[1], chunk.y0 + chunk.blocks.shape[1])
+            if y0 < y1:
+                chunk.light[cx, slice(y0 - chunk.y0, y1 - chunk.y0), cz] = light[wx, slice(y0 - lo[1], y1 - lo[1]), wz]
+
+    def _light_box(self, lo, hi):
+        """ Widen the box from lo to hi to take in every column it touches from top to bottom (plus a layer either
+        side) - full sky light can come down from as high as any chunk goes. Returns the new (lo, hi).
+        """
+        bottom, top = lo[1], hi[1]
+        for sector, _, _ in self._window_columns(lo, hi):
+            chunk = self.chunks.get(sector)
+            if chunk is not None:
+                bottom = min(bottom, chunk.y0)
+                top = max(top, chunk.y0 + chunk.blocks.shape[1])
+        return (lo[0], bottom - 1, lo[2]), (hi[0], top + 1, hi[2])
+
+    def _relit(self, lo, before, after):
+        """ Bump the version of every sector with a cell whose light changed in it, or right next to it - the meshes
+        that face the cell are out of date. Returns the sectors.
+        """
+        columns = np.pad((before != after).any(axis=1), 1, 'constant')
+        if not columns.any():
+            return set()
+        # Every column next to one that changed, and then the sectors all those columns are in
+        near = columns.copy()
+        near[1:] |= columns[:-1]
+        near[:-1] |= columns[1:]
+        near[:, 1:] |= near[:, :-1].copy()
+        near[:, :-1] |= near[:, 1:].copy()
+        xs, zs = np.nonzero(near)
+        x0, z0 = (lo[0] - 1) // SECTOR_SIZE, (lo[2] - 1) // SECTOR_SIZE
+        hit = np.zeros(tuple((k - 1) // SECTOR_SIZE + 2 for k in near.shape), dtype=bool)
+        hit[(xs + lo[0] - 1) // SECTOR_SIZE - x0, (zs + lo[2] - 1) // SECTOR_SIZE - z0] = True
+        keys = np.transpose(np.nonzero(hit)) + (x0, z0)
+        sectors = set((x, 0, z) for x, z in keys.tolist())
+        for sector in sectors:
+            self.versions[sector] = self.versions.get(sector, 0) + 1
+        return sectors
+
+    @traced
+    def _relight(self, positions):
+        """ Bring the light up to date around the (n, 3) positions, whose blocks just changed. Only the boxes light
+        could reach from them get looked at - one per cluster of positions (see _light_clusters()), so two edits at
+        opposite ends of the world don't relight everything in between. Returns the sectors whose meshes the light
+        changed.
+        """
+        changed = set()
+        for rows in self._light_clusters(positions):
+            changed |= self._relight_cluster(positions[rows])
+        return changed
+
+    @staticmethod
+    def _light_clusters(positions):
+        """ Split the (n, 3) positions up into clusters that can be relit on their own - a sector's worth at a time,
+        with any whose boxes of light (LIGHT_RADIUS out from them) overlap merged together. Boxes that don't overlap
+        can't change each other's light. Returns a list of the rows of the positions in each cluster.
+        """
+        # [lo, hi, rows] - only x and z matter, since a relight takes in whole columns anyway
+        boxes = []
+        for _, rows in World.group_by_sector(positions):
+            p = positions[rows]
+            boxes.append([p.min(axis=0) - (LIGHT_RADIUS + 1), p.max(axis=0) + LIGHT_RADIUS + 2, [rows]])
+        merged = True
+        while merged:
+            merged = False
+            clusters = []
+            for lo, hi, rows in boxes:
+                for cluster in clusters:
+                    if (lo[[0, 2]] < cluster[1][[0, 2]]).all() and (cluster[0][[0, 2]] < hi[[0, 2]]).all():
+                        cluster[0] = np.minimum(cluster[0], lo)
+                        cluster[1] = np.maximum(cluster[1], hi)
+                        cluster[2] += rows
+                        merged = True
+                        break
+                else:
+                    clusters.append([lo, hi, rows])
+            boxes = clusters
+        return [np.concatenate(rows) for _, _, rows in boxes]
+
+    def _relight_cluster(self, positions):
+        """ Private implementation of _relight() - relight the one box around the (n, 3) positions """
+        lo, hi = self._light_box(positions.min(axis=0) - (LIGHT_RADIUS + 1), positions.max(axis=0) + LIGHT_RADIUS + 2)
+        blocks, light, fixed = self._light_window(lo, hi)
+        fixed = fix_edges(fixed).ravel()
+        solid = (blocks != 0).ravel()
+        changed = np.ravel_multi_index(tuple((positions - lo).T), light.shape)
+        changed = np.unique(changed[~fixed[changed]])
+        sky, block = split_light(light.ravel())
+        steps, down = face_steps(light.shape, FACES)
+        relight(sky, solid, fixed, changed, steps, down)
+        emission = self.registry.emission[blocks.ravel()]
+        if block.any() or emission.any():
+            relight(block, solid, fixed, changed, steps, emission=emission)
+        after = pack_light(sky, block).reshape(light.shape)
+        self._store_light(lo, hi, after)
+        return self._relit(lo, light, after)
+
+    @traced
+    def _light_chunk(self, sector):
+        """ Light a chunk that's only just turned up, from scratch: full sky light down every column as far as the
+        first block, every block's own light, and then all of it spread about, along with whatever shines in from
+        the chunks around it. If it lights any of them up in turn, that gets spread as far as it goes too.
+        Returns the sectors whose meshes the light changed.
+        """
+        chunk = self.chunks[sector]
+        x, _, z = sector
+        n = SECTOR_SIZE
+        lo = (x * n - 1, chunk.y0 - 1, z * n - 1)
+        hi = (x * n + n + 1, chunk.y0 + chunk.blocks.shape[1] + 1, z * n + n + 1)
+        blocks, light, fixed = self._light_window(lo, hi)
+        # The cells around the edge that belong to another chunk
+        held = ~fixed
+        fix_edges(fixed)
+        solid = blocks != 0
+        inside = (slice(1, -1),) * 3
+        sky, block = split_light(light)
+        # Anything with a block somewhere above it is in the shade
+        shaded = np.logical_or.accumulate(chunk.blocks[:, ::-1, :] != 0, axis=1)[:, ::-1, :]
+        sky[inside] = np.where(shaded, 0, MAX_LIGHT)
+        block[inside] = self.registry.emission[chunk.blocks]
+        channels = self._channels(sky, block)
+        self._spread(channels, solid, fixed)
+        chunk.light = np.ascontiguousarray(pack_light(sky, block)[inside])
+        changed = set()
+        # Now the chunks around it have come into it, does it have anything to give them?
+        if any(len(light_sources(level, solid, ~held, FACES, direction)) for level, direction in channels):
+            r = LIGHT_RADIUS + 1
+            changed = self._settle(*self._light_box((lo[0] - r, lo[1], lo[2] - r), (hi[0] + r, hi[1], hi[2] + r)))
+        return changed
+
+    @staticmethod
+    def _channels(sky, block):
+        """ The (level, down) light channels of a window worth spreading - there's no point going over the block
+        light when there isn't any, which is most of the time
+        """
+        channels = [(sky, FACES.index((0, -1, 0)))]
+        if block.any():
+            channels.append((block, None))
+        return channels
+
+    @staticmethod
+    def _spread(channels, solid, fixed):
+        """ Spread every one of the channels as far as it goes through a 3D window """
+        steps, _ = face_steps(solid.shape, FACES)
+        for level, down in channels:
+            seeds = light_sources(level, solid, fixed, FACES, down)
+            spread_light(level.ravel(), solid.ravel(), fixed.ravel(), seeds, steps, down)
+
+    def _settle(self, lo, hi):
+        """ Spread any light in the box from lo to hi that hasn't been spread yet. Returns the sectors whose meshes the
+        light changed.
+        """
+        blocks, light, fixed = self._light_window(lo, hi)
+        fix_edges(fixed)
+        solid = blocks != 0
+        sky, block = split_light(light)
+        self._spread(self._channels(sky, block), solid, fixed)
+        after = pack_light(sky, block)
+        self._store_light(lo, hi, after)
+        return self._relit(lo, light, after)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for chunk in list(self.chunks.values()):
+            for position in chunk.positions():
+                yield position
+
+    def items(self):
+        for position in self:
+            yield position, self[position]
+
+
+class TerrainGenerator(object):
+    """ Makes the terrain for any sector on its own, from nothing but the seed - so the world can be built lazily,
+    a sector at a time, and the same seed always gives you the same world. Hills belong to the sector their centre
+    falls in and are never wider than a sector, so only the eight sectors around one can reach into it.
+    """
+
+    def __init__(self, seed=None, n=80, hills_per_sector=1.5):
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.seed = seed
+        # approx. HALF the w/h of the entire world. None means it just keeps going
+        self.n = n
+        # Average number of hills centred in each sector
+        self.hills_per_sector = hills_per_sector
+
+    def _hills(self, sector):
+        """ Return the (a, b, c, h, s, t) hills centred in the sector - the same every time for the same seed """
+        x, _, z = sector
+        rng = np.random.default_rng([self.seed, x % 2 ** 32, z % 2 ** 32])
+        hills = []
+        for _ in xrange(rng.poisson(self.hills_per_sector)):
+            a = x * SECTOR_SIZE + int(rng.integers(SECTOR_SIZE))  # x position of the created hill
+            b = z * SECTOR_SIZE + int(rng.integers(SECTOR_SIZE))  # z position of the created hill
+            c = -1  # base of the created hill
+            h = int(rng.integers(1, 7))  # height
+            s = int(rng.integers(4, 9))  # side length of the hill. (2 * s)
+            t = (GRASS, SAND, BRICK)[int(rng.integers(3))]
+            if self.n is not None and max(abs(a), abs(b)) > self.n - 10:
+                continue
+            hills.append((a, b, c, h, s, t))
+        return hills
+
+    def generate(self, world, sector):
+        """ Return a Chunk holding the generated blocks for the sector, or None if there's nothing there """
+        x0, _, z0 = sector
+        x0, z0 = x0 * SECTOR_SIZE, z0 * SECTOR_SIZE
+        xs, zs = np.meshgrid(np.arange(x0, x0 + SECTOR_SIZE), np.arange(z0, z0 + SECTOR_SIZE), indexing='ij')
+        chunk = Chunk(sector)
+        chunk.reserve(-3)
+        chunk.reserve(CHUNK_HEIGHT - 1)
+        blocks = chunk.blocks
+        y0 = chunk.y0
+        if self.n is None:
+            inside = np.ones(xs.shape, dtype=bool)
+            walls = np.zeros(xs.shape, dtype=bool)
+        else:
+            n = self.n
+            inside = (np.abs(xs) <= n) & (np.abs(zs) <= n)
+            walls = inside & ((np.abs(xs) == n) | (np.abs(zs) == n))
+        if not inside.any():
+            return None
+        # A layer of stone and grass throughout. Then take a nap
+        blocks[:, -2 - y0, :][inside] = world.palette_id(GRASS)
+        blocks[:, -3 - y0, :][inside] = world.palette_id(STONE)
+        # Outer walls of the world. YAY FLAT EARTH
+        for y in xrange(-2, 3):
+            blocks[:, y - y0, :][walls] = world.palette_id(STONE)
+        # Hills. Ugh, so immersive. Neighbours go in a fixed order so the overlaps always come out the same way
+        spawn = xs ** 2 + zs ** 2 < 5 ** 2
+        sx, _, sz = sector
+        for dx in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                for a, b, c, h, s, t in self._hills((sx + dx, 0, sz + dz)):
+                    mask = ((xs - a) ** 2 + (zs - b) ** 2 <= (s + 1) ** 2) & ~spawn
+                    if not mask.any():
+                        continue
+                    block_id = world.palette_id(t)
+                    for y in xrange(c, c + h):
+                        blocks[:, y - y0, :][mask] = block_id
+        return chunk
+
+
+class GLRenderer(object):
+    """ Gets sector meshes onto the screen with pyglet. Needs a GL context. Every sector gets a vertex list
+    of its own rather than sharing a batch, so the ones out of view can be skipped.
+    """
+
+    def __init__(self):
         # A group to manage the OpenGL texture
         self.group = TextureGroup(image.load(TEXTURE_PATH).get_texture())
 
-        # A ObjRelMap from player position to the texture of the indicated block
-        # at that position - this holds all the blocks currently sitting in the world
-        self.world = {}
+    def upload(self, vertex_data, texture_data, colour_data):
+        """ Return a handle to the mesh made of the given arrays from mesh_blocks(), ready to draw """
+        count = len(vertex_data) // 3
+        # bring a vertex list to life, then copy the arrays straight into it
+        vertex_list = pyglet.graphics.vertex_list(count, 'v3f/static', 't2f/static', 'c3B/static')
+        ctypes.memmove(vertex_list.vertices, vertex_data.ctypes.data, vertex_data.nbytes)
+        ctypes.memmove(vertex_list.tex_coords, texture_data.ctypes.data, texture_data.nbytes)
+        ctypes.memmove(vertex_list.colors, colour_data.ctypes.data, colour_data.nbytes)
+        return vertex_list
+
+    def stream(self, handle, vertex_data, texture_data, colour_data):
+        """ upload() for a mesh that changes every frame. Writes the arrays over the handle from the last stream() in
+        place and hands it back. Only when they outgrow it does it get swapped for a new one, at least twice the size.
+        Whatever's left over past the end is squashed down to nothing, so it draws nothing.
+        """
+        count = len(vertex_data) // 3
+        if handle is None or handle.get_size() < count:
+            size = max(count, 2 * handle.get_size()) if handle is not None else count
+            if handle is not None:
+                handle.delete()
+            handle = pyglet.graphics.vertex_list(size, 'v3f/stream', 't2f/stream', 'c3B/stream')
+        vertices = handle.vertices
+        ctypes.memmove(vertices, vertex_data.ctypes.data, vertex_data.nbytes)
+        ctypes.memset(ctypes.addressof(vertices) + vertex_data.nbytes, 0, ctypes.sizeof(vertices) - vertex_data.nbytes)
+        ctypes.memmove(handle.tex_coords, texture_data.ctypes.data, texture_data.nbytes)
+        ctypes.memmove(handle.colors, colour_data.ctypes.data, colour_data.nbytes)
+        return handle
+
+    def delete(self, handle):
+        """ Free a mesh from upload() or stream() """
+        handle.delete()
+
+    @traced
+    def draw(self, handles):
+        """ Draw the meshes from upload() """
+        self.group.set_state()
+        for vertex_list in handles:
+            vertex_list.draw(GL_QUADS)
+        self.group.unset_state()
+
+
+class NullMesh(object):
+    """ What NullRenderer hands back instead of a vertex list """
+    __slots__ = ('count',)
+
+    def __init__(self, count):
+        self.count = count
+
+
+class NullRenderer(object):
+    """ A renderer that doesn't - for running the Model headless, without a display or GL context.
+    It keeps count of what it would have drawn so benchmarks can still see the vertex totals.
+    """
 
-        # Same as above - but only holds the blocks that are visible
-        self.shown = {}
+    def __init__(self):
+        self.vertices = 0
+        self.uploads = 0
+        # Meshes the last draw() was asked to draw
+        self.drawn = 0
+
+    def upload(self, vertex_data, texture_data, colour_data):
+        count = len(vertex_data) // 3
+        self.vertices += count
+        self.uploads += 1
+        return NullMesh(count)
+
+    def stream(self, handle, vertex_data, texture_data, colour_data):
+        count = len(vertex_data) // 3
+        if handle is not None and handle.count >= count:
+            return handle
+        size = max(count, 2 * handle.count) if handle is not None else count
+        if handle is not None:
+            self.delete(handle)
+        self.vertices += size
+        self.uploads += 1
+        return NullMesh(size)
+
+    def delete(self, handle):
+        self.vertices -= handle.count
+
+    def draw(self, handles):
+        self.drawn = len(handles)
+
+
+class Entities(object):
+    """ The things moving about the world on their own - thrown blocks now, mobs one day. Each is a box that falls,
+    gets stopped by solid blocks, slides to a halt on the ground and is drawn as a little cube of some block.
+
+    There can be thousands of them, so rather than an object apiece they're kept as a structure of arrays: row i of
+    every array is entity i, and only the first count rows are in use. A tick moves all of them with a handful of array
+    operations (see Model.sweep_many()), and they're drawn as the one mesh. Removing entities closes the gap behind
+    them, so an entity's row can change - hang on to rows no longer than a tick.
+    """
 
-        # ObjRelMap from player position to a pyglet VertexList for all visible blocks
+    # Every per-entity array, so growing and removing can see to all of them
+    FIELDS = ('position', 'previous', 'velocity', 'size', 'block_id', 'gravity', 'on_ground', 'life')
+
+    def __init__(self, capacity=ENTITY_CAPACITY):
+        self.count = 0
+        # Centre of each box, where it was at the end of the previous tick (drawing happens in between), and its
+        # velocity in blocks a second
+        self.position = np.zeros((capacity, 3))
+        self.previous = np.zeros((capacity, 3))
+        self.velocity = np.zeros((capacity, 3))
+        # Width, height and depth of each box
+        self.size = np.zeros((capacity, 3))
+        # The palette id of the block each one's drawn as
+        self.block_id = np.zeros(capacity, dtype=np.uint8)
+        # Whether it falls, and whether it's resting on something
+        self.gravity = np.zeros(capacity, dtype=bool)
+        self.on_ground = np.zeros(capacity, dtype=bool)
+        # Seconds each has left before it's gone
+        self.life = np.zeros(capacity)
+
+    def __len__(self):
+        return self.count
+
+    def _reserve(self, count):
+        """ Make room for count entities in all, doubling the arrays as many times as that takes """
+        capacity = len(self.position)
+        if count <= capacity:
+            return
+        while capacity < count:
+            capacity *= 2
+        for name in self.FIELDS:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def spawn(self, positions, velocities, size, block_id, gravity=True, life=ENTITY_LIFETIME):
+        """ Add entities at the (n, 3) positions with the (n, 3) velocities. size (a width, height, depth triple),
+        block_id, gravity and life go for all of them. Returns the rows they got.
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        start, end = self.count, self.count + len(positions)
+        self._reserve(end)
+        self.position[start:end] = positions
+        self.previous[start:end] = positions
+        self.velocity[start:end] = np.reshape(velocities, (-1, 3))
+        self.size[start:end] = size
+        self.block_id[start:end] = block_id
+        self.gravity[start:end] = gravity
+        self.on_ground[start:end] = False
+        self.life[start:end] = life
+        self.count = end
+        return np.arange(start, end)
+
+    def remove(self, rows):
+        """ Get rid of the entities in the rows. The ones after them move up to fill the gaps. """
+        keep = np.ones(self.count, dtype=bool)
+        keep[rows] = False
+        count = int(keep.sum())
+        for name in self.FIELDS:
+            array = getattr(self, name)
+            array[:count] = array[:self.count][keep]
+        self.count = count
+
+    def step(self, dt, sweep):
+        """ Move every entity on by a tick of dt seconds. sweep is Model.sweep_many(), or anything that moves boxes
+        through the world the same way.
+        """
+        n = self.count
+        if not n:
+            return
+        position, velocity = self.position[:n], self.velocity[:n]
+        self.previous[:n] = position
+        vy = velocity[:, 1]
+        vy -= np.where(self.gravity[:n], dt * GRAVITY, 0.0)
+        np.maximum(vy, -TERMINAL_VELOCITY, out=vy)
+        half = self.size[:n] / 2
+        motion, blocked = sweep(position - half, position + half, velocity * dt)
+        position += motion
+        # Landing on something, rather than bumping a ceiling
+        self.on_ground[:n] = blocked[:, 1] & (vy < 0)
+        velocity[blocked] = 0
+        velocity[self.on_ground[:n], 0::2] *= max(0.0, 1.0 - ENTITY_FRICTION * dt)
+        life = self.life[:n]
+        life -= dt
+        gone = np.flatnonzero((life <= 0) | (position[:, 1] < ENTITY_FLOOR))
+        if len(gone):
+            self.remove(gone)
+
+    def mesh(self, alpha, uvs, light_levels):
+        """ Build the one mesh for every entity, alpha of the way from where they were last tick to where they are now.
+        uvs is World.face_uvs(), and light_levels is World.light_levels() - each cube is as bright as the air it's in.
+        Returns the same (vertex data, texture data, colour data) as mesh_blocks().
+        """
+        n = self.count
+        if not n:
+            return empty_mesh()
+        centre = self.previous[:n] + (self.position[:n] - self.previous[:n]) * alpha
+        vertex_data = (centre.astype(np.float32)[:, None, None, :] +
+                       FACE_VERTICES[None] * self.size[:n, None, None, :].astype(np.float32))
+        texture_data = uvs[self.block_id[:n]]
+        sky, block = split_light(light_levels(np.floor(centre + 0.5)))
+        colour = BRIGHTNESS[np.maximum(sky, block)].astype(np.uint8)
+        colour_data = np.repeat(colour, 6 * 4 * 3)
+        return vertex_data.ravel(), texture_data.ravel(), colour_data
+
+
+class Model(object):
+
+    def __init__(self, seed=None, save_path=None, renderer=None, cache_path=None, lighting=True,
+                 ambient_occlusion=AMBIENT_OCCLUSION):
+
+        # What the sector meshes get uploaded to and drawn with. Pass a NullRenderer to run without a display.
+        self.renderer = renderer if renderer is not None else GLRenderer()
+
+        # A ObjRelMap from player position to the texture of the indicated block
+        # at that position - this holds all the blocks currently sitting in the world.
+        # Under the hood it's a World, which packs each sector into a Chunk array - and lights it, unless told not to.
+        self.world = World(lighting)
+
+        # Whether meshes get their corners shaded - see mesh_blocks()
+        self.ambient_occlusion = ambient_occlusion
+
+        # Where the world gets saved to and loaded from - None keeps it all in memory
+        self.store = RegionStore(save_path, SECTOR_SIZE) if save_path else None
+        level = self.store.load_level() if self.store else None
+        # How many palette ids level.json knows about - any sector saved with more than that needs it written again
+        # first, or the ids in it won't mean anything after a crash
+        self._level_palette = 0
+        if level is not None:
+            # Saved block ids only mean something with the palette they were saved with
+            seed = level['seed']
+            for texture in level['palette'][1:]:
+                self.world.palette_id(texture)
+            self._level_palette = len(level['palette'])
+
+        # Where the startup snapshot lives. A random seed is a new world every time, so there's no point keeping one.
+        self.cache_path = cache_path if seed is not None else None
+
+        # Builds sectors on demand the first time change_sector() comes near them
+        self.generator = TerrainGenerator(seed)
+
+        # The sectors whose blocks are in memory, either loaded from the store or generated
+        self.loaded = set()
+
+        # Loaded sectors that have been edited since they were loaded or saved
+        self.dirty = set()
+
+        # The sectors that are meant to be visible in full
+        self.shown = set()
+
+        # The sectors that are meant to be visible as low detail stand-ins, too far out to be worth the full mesh
+        self.far = set()
+
+        # ObjRelMap from sector to the renderer's handle (a pyglet VertexList) on its mesh. One per sector,
+        # and only the faces that aren't pressed up against another block - or the low detail mesh, for far sectors.
         self._shown = {}
 
-        # ObjRelMap from current sector to a list of coordinate positions
-        # within that sector.
-        self.sectors = {}
+        # ObjRelMap from sector to the (2, 3) array of its mesh's bounding box corners, for frustum culling
+        self._bounds = {}
+
+        # ObjRelMap from sector to what its mesh is: (detail - 'full' or 'far', world edit version it was made at,
+        # vertex count)
+        self._mesh_info = {}
+
+        # The meshes of sectors that have been hidden, least recently hidden first, in case they come back before
+        # they go stale: ObjRelMap from sector to (handle, bounds, mesh info). They hold on to mesh_cache_vertices
+        # vertices at most between them...
+        self._mesh_cache = OrderedDict()
+        self.mesh_cache_vertices = MESH_CACHE_VERTICES
+        self._cached_vertices = 0
+        # ... and this is how often a sector coming back found its mesh there, for tuning that
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # How many shown sectors the last draw() skipped for being out of view
+        self.culled = 0
+
+        # Occlusion culling (see occlusion.py). ObjRelMap from sector to (world edit version, face links)...
+        self._links = {}
+        # ... bumped whenever any of those change ...
+        self._links_changed = 0
+        # ... (sector, world edit version, connectivity()) of the sector the camera was last in ...
+        self._camera = None
+        # ... and (camera sector, camera faces, _links_changed, the sectors that could be in sight) from last time
+        self._visible = None
+
+        # How many shown sectors the last draw() skipped for being hidden behind something
+        self.occluded = 0
 
         # A simplistic function to queue implementation. This is populated with
-        # _show_block() and _hide_block() calls
-        self.queue = dequeue()
+        # _show_sector() and _hide_sector() calls, keyed by their arguments (the sector)
+        # so that newer work for a sector replaces older work for it.
+        self.queue = {}
+
+        # The sector the player is standing in - queued work nearest to it goes first
+        self.focus = None
+
+        # How far out (in sectors) sectors are shown in full, and as low detail stand-ins. See set_view_distance().
+        self.show_pad = SHOW_PAD
+        self.lod_pad = LOD_PAD
+
+        # Seconds process_queue() may spend per call when it isn't told otherwise
+        self.queue_budget = 1.0 / TICKS_PER_SEC
+
+        # Pool meshing sectors off the main thread, and the jobs it's working on:
+        # ObjRelMap from sector to (world edit version when snapshotted, future)
+        self.executor = ThreadPoolExecutor(MESH_WORKERS) if MESH_WORKERS else None
+        self.meshing = {}
+
+        # How much process_queue() got through last time, and how long it took (seconds)
+        self.queue_done = 0
+        self.queue_time = 0.0
+
+        # ((position, vector, max_distance, world edits), result) of the last hit_test()
+        self._hit_cache = None
+
+        # While a startup snapshot is waiting to be taken: ObjRelMap from sector to (world edit version, vertex data,
+        # texture data, colour data) of the last mesh uploaded for it. None the rest of the time.
+        self._snapshot_meshes = None
+
+        # Game ticks so far - update_blocks() counts them
+        self.ticks = 0
+
+        # Block updates waiting for their tick (see update_blocks()): a heap of (tick, y, x, z), so the ones due first,
+        # and then the lowest, come off the top...
+        self._updates = []
+        # ... ObjRelMap from position to the tick its update is due, so a block only ever has the one coming...
+        self._update_due = {}
+        # ... and the most of them a tick works through. The rest carry over to the next one.
+        self.update_budget = BLOCK_UPDATES_PER_TICK
+
+        # Everything moving about on its own (see Entities), and the renderer's handle on their mesh. They never stop
+        # moving, so draw_entities() streams it over the same handle every frame (see GLRenderer.stream()).
+        self.entities = Entities()
+        self._entity_mesh = None
 
         self._initialize()
 
     def _initialize(self):
-        """ Initialize the world, BY FILLING IT """
-        n = 80  # approx. HALF the w/h of the entire world.
-        s = 1  # step size
-        y = 0  # initial Y height
-        for x in range(-n, n + 1, s):
-            for z in xrange(-n, n + 1, s):
-                # Create a layer of stone and grass throughout. Then take a nap
-                self.add_block((x, y - 2, z), GRASS, immediate=False)
-                self.add_block((x, y - 3, z), STONE, immediate=False)
-                if x in (-n, n) or z in (-n, n):
-                    # create outer walls of the world. YAY FLAT EARTH
-                    for dy in xrange(-2, 3):
-                        self.add_block((x, y + dy, z), STONE, immediate=False)
-
-        # Generate hills in the world randomly. Ugh, so immersive
-        o = n - 10
-        for _ in xrange(120):
-            a = random.randint(-o, o)  # x position of the created hill
-            b = random.randint(-o, o)  # z position of the created hill
-            c = -1  # base of the created hill
-            h = random.randint(1, 6)  # height
-            s = random.randint(4, 8)  # side length of the hill. (2 * s)
-            d = 1  # taper off the hills or naw
-            t = random.choice([GRASS, SAND, BRICK])
-            for y in xrange(c, c + h):
-                for x in xrange(a - s, a + s + 1):
-                    for z in xrange(b - s, b + s + 1):
-                        if (x - a) ** 2 + (z - b) ** 2 > (s + 1) ** 2:
-                            continue
-                        if (x - 0) ** 2 + (z - 0) * 2 < 5 ** 2:
-                            continue
-                        self.add_block((x, y, z), t, immediate=False)
+        """ Initialize the world, BY FILLING IT. Well - just the bit around spawn. The rest gets generated as
+        change_sector() wanders into it (or loaded, if it was saved), so startup costs the same however big the world is.
+        Better still, when there's a startup snapshot the whole spawn area comes back already meshed.
+        """
+        if self._load_snapshot():
+            return
+        self.load_around(SPAWN_SECTOR, 1)
+
+    def _snapshot_file(self):
+        """ Path of the startup snapshot for this seed, or None when there's nowhere to keep one """
+        if self.cache_path is None:
+            return None
+        return os.path.join(self.cache_path, 'spawn.%d.snapshot' % self.generator.seed)
+
+    def _snapshot_key(self):
+        """ Everything the spawn area depends on. A snapshot taken under any other key is stale. """
+        # Any change to the code could change the terrain, the meshes or the light - better safe than sorry
+        source = hashlib.sha1()
+        for name in SNAPSHOT_SOURCES:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), 'rb') as f:
+                source.update(f.read())
+        source = source.hexdigest()
+        return {
+            'seed': self.generator.seed,
+            'n': self.generator.n,
+            'hills_per_sector': self.generator.hills_per_sector,
+            'sector_size': SECTOR_SIZE,
+            'chunk_height': CHUNK_HEIGHT,
+            'spawn': list(SPAWN_SECTOR),
+            'lighting': self.world.lighting,
+            'ambient_occlusion': self.ambient_occlusion,
+            'source': source,
+        }
+
+    @traced
+    def _load_snapshot(self):
+        """ Bring back the spawn area - blocks, exposure masks, light and meshes - from the startup snapshot, showing
+        it as if change_sector() had just moved the player there. Returns False when there's no good snapshot, and
+        arranges for a fresh one to be taken once the spawn area has been meshed the slow way.
+        """
+        path = self._snapshot_file()
+        if path is None:
+            return False
+        snapshot = read_snapshot(path, self._snapshot_key(), SECTOR_SIZE)
+        if snapshot is not None:
+            palette, sectors = snapshot
+            # The palette ids in the snapshot have to mean the same as ours (a saved world may have brought some along)
+            known = [list(texture) for texture in self.world.palette[1:]]
+            if palette[1:len(known) + 1] != known:
+                snapshot = None
+            # Anything saved in the spawn area wins over what was generated there
+            elif self.store is not None and any(self.store.saved(s.sector) for s in sectors):
+                snapshot = None
+        if snapshot is None:
+            self._snapshot_meshes = {}
+            return False
+        for texture in palette[1:]:
+            self.world.palette_id(texture)
+        for s in sectors:
+            self.loaded.add(s.sector)
+            if s.blocks is not None:
+                chunk = Chunk(s.sector)
+                chunk.y0 = s.y0
+                # Copies, so the rest of the snapshot (the meshes, mostly) isn't kept alive by them
+                chunk.blocks = s.blocks.copy()
+                chunk.masks = s.masks.copy()
+                chunk.light = s.light.copy()
+                self.world.set_chunk(s.sector, chunk, compute_masks=False)
+        for s in sectors:
+            if s.vertex_data is not None:
+                (self.far if s.far else self.shown).add(s.sector)
+                self._upload(s.sector, s.vertex_data, s.texture_data, s.colour_data, 'far' if s.far else 'full')
+        self.focus = SPAWN_SECTOR
+        return True
+
+    def _take_snapshot(self):
+        """ Write the startup snapshot, once the spawn area has finished meshing. If the player has already wandered
+        off or started building, the spawn area isn't what a fresh start would give - so no snapshot this time.
+        """
+        if self._snapshot_meshes is None or self.focus is None or self.queue or self.meshing:
+            return
+        meshes, self._snapshot_meshes = self._snapshot_meshes, None
+        if self.focus != SPAWN_SECTOR or self.dirty:
+            return
+        if self.store is not None and any(self.store.saved(sector) for sector in self.loaded):
+            return
+        sectors = []
+        for sector in sorted(self.loaded):
+            chunk = self.world.chunk(sector)
+            if chunk is None:
+                s = SnapshotSector(sector, 0, None, None, None)
+            else:
+                s = SnapshotSector(sector, chunk.y0, chunk.blocks, chunk.masks, chunk.light)
+            if sector in self.shown or sector in self.far:
+                mesh = meshes.get(sector)
+                # Low detail meshes only go by the sector's own blocks, so loading next door doesn't make them stale
+                if mesh is None or mesh[0] != self.world.version(sector) and sector in self.shown:
+                    return
+                _, s.vertex_data, s.texture_data, s.colour_data = mesh
+                s.far = sector in self.far
+            sectors.append(s)
+        palette = [None] + [list(texture) for texture in self.world.palette[1:]]
+        try:
+            if not os.path.isdir(self.cache_path):
+                os.makedirs(self.cache_path)
+            write_snapshot(self._snapshot_file(), self._snapshot_key(), palette, sectors)
+        except (IOError, OSError):
+            # No snapshot is no big deal - next launch just starts the slow way again
+            pass
+
+    def load_sector(self, sector):
+        """ Bring the sector's blocks into memory - off the disk if it was saved, otherwise freshly generated.
+        Does nothing if it's already loaded.
+        """
+        if sector in self.loaded:
+            return
+        self.loaded.add(sector)
+        saved = self.store.load(sector) if self.store else None
+        if saved is EMPTY_SECTOR:
+            return
+        if saved is not None:
+            y0, blocks = saved
+            if blocks.size and int(blocks.max()) >= len(self.world.registry):
+                raise ValueError('Sector %r of %s has block id %d, past the %d ids of the palette in level.json - the '
+                                 'save is damaged' % (sector, self.store.path, int(blocks.max()),
+                                                      len(self.world.registry)))
+            chunk = Chunk(sector)
+            chunk.y0, chunk.blocks = y0, blocks
+            chunk.masks = np.zeros_like(chunk.blocks)
+            chunk.light = np.zeros_like(chunk.blocks)
+        else:
+            chunk = self.generator.generate(self.world, sector)
+        if chunk is not None:
+            self.world.set_chunk(sector, chunk)
+
+    def load_around(self, sector, pad):
+        """ Load every sector within pad sectors of the given one """
+        x, _, z = sector
+        for dx in xrange(-pad, pad + 1):
+            for dz in xrange(-pad, pad + 1):
+                self.load_sector((x + dx, 0, z + dz))
+
+    def unload_sector(self, sector):
+        """ Drop the sector's blocks from memory, saving them first if they've changed. Edited sectors stay put when
+        there's nowhere to save them - they can't be generated back.
+        """
+        if sector not in self.loaded:
+            return
+        if sector in self.dirty:
+            if self.store is None:
+                return
+            self.save_sector(sector)
+        self.loaded.discard(sector)
+        self.world.set_chunk(sector, None)
+
+    def unload_beyond(self, sector, pad):
+        """ Unload every sector further than pad sectors from the given one """
+        x, _, z = sector
+        for other in list(self.loaded):
+            if max(abs(other[0] - x), abs(other[2] - z)) > pad:
+                self.unload_sector(other)
+
+    def save_sector(self, sector):
+        """ Write the sector out to the store - level.json first, if it's behind the palette the sector goes by """
+        if len(self.world.palette) > self._level_palette:
+            self._save_level()
+        chunk = self.world.chunk(sector)
+        if chunk is None:
+            self.store.save(sector, 0, None)
+        else:
+            self.store.save(sector, chunk.y0, chunk.blocks)
+        self.dirty.discard(sector)
+
+    def sector_digests(self):
+        """ Return an ObjRelMap from every loaded sector to a digest of its blocks. Two runs that did the same things
+        to the world agree on every sector they both have loaded, however far out each of them had streamed.
+        """
+        digests = {}
+        for sector in self.loaded:
+            chunk = self.world.chunk(sector)
+            digest = hashlib.sha1()
+            if chunk is not None:
+                digest.update(str(chunk.y0).encode('ascii'))
+                digest.update(np.ascontiguousarray(chunk.blocks).tobytes())
+            digests[sector] = digest.hexdigest()
+        return digests
+
+    def save(self):
+        """ Save every edited sector, along with the seed and palette needed to make sense of them """
+        if self.store is None:
+            return
+        for sector in list(self.dirty):
+            self.save_sector(sector)
+        self._save_level()
+
+    def _save_level(self):
+        """ Write level.json - the seed and palette needed to make sense of the saved sectors """
+        self.store.save_level({
+            'seed': self.generator.seed,
+            'palette': [None] + [list(texture) for texture in self.world.palette[1:]],
+        })
+        self._level_palette = len(self.world.palette)
 
     def hit_test(self, position, vector, max_distance=8):
         """ LOS search from player position. If block is hit and returned, along with the
-block previously in the LOS. If no block is found - return nothing. Nothing at all
+block previously in the LOS (the one sharing the face the ray came in through). If no block is found - return nothing.
+Nothing at all. The last answer is kept around, so asking again from the same spot in an unchanged world is free.
         """
-        m = 8
-        x, y, z = position
-        dx, dy, dz = vector
+        key = (tuple(position), tuple(vector), max_distance, self.world.edits)
+        if self._hit_cache is not None and self._hit_cache[0] == key:
+            return self._hit_cache[1]
+        result = self._hit_test(position, vector, max_distance)
+        self._hit_cache = (key, result)
+        return result
+
+    def _hit_test(self, position, vector, max_distance):
+        """ Private implementation of hit_test(). Walks the grid one block at a time (Amanatides & Woo), so every
+        block the ray passes through gets checked exactly once - corners included.
+        """
+        # Blocks are centred on whole numbers, so block k spans k - 0.5 to k + 0.5 on each axis
+        cell = [int(math.floor(p + 0.5)) for p in position]
+        step = [0, 0, 0]
+        t_max = [float('inf')] * 3  # how far along the ray the next boundary on each axis is
+        t_delta = [float('inf')] * 3  # how far along the ray one whole block on each axis is
+        for i in xrange(3):
+            if vector[i] > 0:
+                step[i] = 1
+                t_max[i] = (cell[i] + 0.5 - position[i]) / vector[i]
+                t_delta[i] = 1.0 / vector[i]
+            elif vector[i] < 0:
+                step[i] = -1
+                t_max[i] = (cell[i] - 0.5 - position[i]) / vector[i]
+                t_delta[i] = -1.0 / vector[i]
         previous = None
-        for _ in xrange(max_distance * m):
-            key = normalize((x, y, z))
-            if key != previous and key in self.world:
-                return key, previous  # here's where you'll get None/None
+        block_id = self.world.block_id
+        while True:
+            key = tuple(cell)
+            if block_id(key):
+                return key, previous
             previous = key
-            x, y, z = z + dx / m, y + dy / m, z + dz / m
-        return None, None  # told you
+            i = t_max.index(min(t_max))
+            if t_max[i] > max_distance:
+                return None, None  # here's where you'll get None/None
+            cell[i] += step[i]
+            t_max[i] += t_delta[i]
+
+    def hit_test_many(self, positions, vectors, max_distance=8):
+        """ hit_test() for a whole lot of rays at once - every ray steps through the grid together, with the
+        block lookups done as array operations. Handy for bots and tooling.
+
+        Params
+        -------
+        positions, vectors: (n, 3) arrays of ray origins and directions
+
+        then Returns:
+        -------
+        (hit, blocks, previous): an (n,) bool array saying which rays hit something, and (n, 3) int arrays of the
+        block each ray hit and the block before it. Rays starting inside a block get that block as previous.
+        """
+        position = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        vector = np.asarray(vectors, dtype=np.float64).reshape(-1, 3)
+        cell = np.floor(position + 0.5).astype(np.int64)
+        step = np.sign(vector).astype(np.int64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_max = np.where(step != 0, (cell + 0.5 * step - position) / vector, np.inf)
+            t_delta = np.where(step != 0, 1.0 / np.abs(vector), np.inf)
+        hit = np.zeros(len(cell), dtype=bool)
+        blocks = np.zeros_like(cell)
+        previous = cell.copy()
+        active = np.arange(len(cell))
+        while len(active):
+            solid = self.world.block_ids(cell[active]) != 0
+            found = active[solid]
+            hit[found] = True
+            blocks[found] = cell[found]
+            active = active[~solid]
+            previous[active] = cell[active]
+            axis = np.argmin(t_max[active], axis=1)
+            t = t_max[active, axis]
+            cell[active, axis] += step[active, axis]
+            t_max[active, axis] += t_delta[active, axis]
+            active = active[t <= max_distance]
+        return hit, blocks, previous
+
+    def sweep(self, lo, hi, motion):
+        """ Move the box with corners lo and hi by motion, stopping it flush against the first block in its way.
+        It moves one axis at a time - y, then x, then z - and checks every block the box sweeps through on the way, so
+        nothing can tunnel through the floor however fast it's falling.
+
+        Returns the motion that actually happened, and a list saying which axes got blocked.
+        """
+        lo = list(lo)
+        hi = list(hi)
+        motion = list(motion)
+        blocked = [False, False, False]
+        world = self.world
+        solid = world.registry.solid.tolist()
+
+        def is_solid(position):
+            # Only solid blocks get in the way
+            return solid[world.block_id(position)]
+
+        for axis in (1, 0, 2):
+            d = motion[axis]
+            if not d:
+                continue
+            # Blocks span k - 0.5 to k + 0.5. These are the ones the box overlaps on the other two axes -
+            # only just touching doesn't count.
+            spans = []
+            for other in (0, 1, 2):
+                if other != axis:
+                    spans.append(xrange(int(math.floor(lo[other] + COLLISION_EPSILON - 0.5)) + 1,
+                                        int(math.ceil(hi[other] - COLLISION_EPSILON + 0.5))))
+            if d > 0:
+                # From the first layer of blocks past the leading face, to the last one it reaches into
+                layers = xrange(int(math.ceil(hi[axis] - COLLISION_EPSILON + 0.5)),
+                                int(math.ceil(hi[axis] + d + 0.5)))
+            else:
+                layers = xrange(int(math.floor(lo[axis] + COLLISION_EPSILON - 0.5)),
+                                int(math.floor(lo[axis] + d - 0.5)), -1)
+            for k in layers:
+                if self._layer_solid(is_solid, axis, k, spans):
+                    d = (k - 0.5) - hi[axis] if d > 0 else (k + 0.5) - lo[axis]
+                    blocked[axis] = True
+                    break
+            motion[axis] = d
+            lo[axis] += d
+            hi[axis] += d
+        return tuple(motion), blocked
+
+    @staticmethod
+    def _layer_solid(is_solid, axis, k, spans):
+        """ Is there a solid block anywhere in layer k along axis, within the spans of the other two axes? """
+        first, second = spans
+        for a in first:
+            for b in second:
+                if axis == 0:
+                    position = (k, a, b)
+                elif axis == 1:
+                    position = (a, k, b)
+                else:
+                    position = (a, b, k)
+                if is_solid(position):
+                    return True
+        return False
+
+    def sweep_many(self, lo, hi, motion):
+        """ sweep() for a whole lot of boxes at once. Same rules, but each axis goes a layer of blocks at a time for
+        every box together, with the block lookups done as array operations - it's what moves the Entities.
+
+        Params
+        -------
+        lo, hi, motion: (n, 3) arrays of box corners, and how far each box is trying to move
+
+        then Returns:
+        -------
+        (motion, blocked): the (n, 3) motion that actually happened, and an (n, 3) bool array of the axes that got
+        blocked
+        """
+        lo = np.array(lo, dtype=np.float64).reshape(-1, 3)
+        hi = np.array(hi, dtype=np.float64).reshape(-1, 3)
+        motion = np.array(motion, dtype=np.float64).reshape(-1, 3)
+        blocked = np.zeros(motion.shape, dtype=bool)
+        solid = self.world.registry.solid
+        for axis in (1, 0, 2):
+            rows = np.flatnonzero(motion[:, axis])
+            if not len(rows):
+                continue
+            d = motion[rows, axis]
+            up = d > 0
+            start_hi = np.ceil(hi[rows, axis] - COLLISION_EPSILON + 0.5)
+            start_lo = np.floor(lo[rows, axis] + COLLISION_EPSILON - 0.5)
+            # The first layer of blocks past the leading face, which way to go from there, and how many to look at
+            start = np.where(up, start_hi, start_lo).astype(np.int64)
+            step = np.where(up, 1, -1)
+            layers = np.where(up, np.ceil(hi[rows, axis] + d + 0.5) - start_hi,
+                              start_lo - np.floor(lo[rows, axis] + d - 0.5)).astype(np.int64)
+            # The blocks each box overlaps on the other two axes, as a grid of offsets from the first of them - big
+            # enough for the biggest box, with the cells past the end of each smaller one masked off
+            others = [other for other in (0, 1, 2) if other != axis]
+            first = (np.floor(lo[rows][:, others] + COLLISION_EPSILON - 0.5) + 1).astype(np.int64)
+            width = np.ceil(hi[rows][:, others] - COLLISION_EPSILON + 0.5).astype(np.int64) - first
+            across = np.indices(tuple(np.maximum(width.max(axis=0), 0))).reshape(2, -1)
+            spans = (across[0] < width[:, 0, None]) & (across[1] < width[:, 1, None])
+            pending = np.arange(len(rows))
+            layer = 0
+            while True:
+                pending = pending[layers[pending] > layer]
+                if not len(pending):
+                    break
+                k = start[pending] + layer * step[pending]
+                cells = np.empty((len(pending), across.shape[1], 3), dtype=np.int64)
+                cells[:, :, axis] = k[:, None]
+                cells[:, :, others[0]] = first[pending, 0, None] + across[0]
+                cells[:, :, others[1]] = first[pending, 1, None] + across[1]
+                hit = solid[self.world.block_ids(cells.reshape(-1, 3))].reshape(cells.shape[:2])
+                hit = (hit & spans[pending]).any(axis=1)
+                stopped, k = pending[hit], k[hit]
+                r = rows[stopped]
+                d[stopped] = np.where(up[stopped], (k - 0.5) - hi[r, axis], (k + 0.5) - lo[r, axis])
+                blocked[r, axis] = True
+                pending = pending[~hit]
+                layer += 1
+            motion[rows, axis] = d
+            lo[rows, axis] += d
+            hi[rows, axis] += d
+        return motion, blocked
 
     def exposed(self, position):
-        """ Returns False if the given position is surrounded on all 6 sides. If not, is True
+        """ Returns False if the block at the given position is surrounded on all 6 sides. If not, is True.
+        It's just a read of the block's exposure mask - no poking around the neighbours.
         """
-        x, y, z = position
-        for dx, dy, dz in FACES:
-            if (x + dx, y + dy, z + dz) not in self.world:
-                return True
-            return False
-
-    def add_block(self, position, texture, immediate=True):
-        """ Add a block with the selected texture and placement to the world """
-        if position in self.world:
-            self.remove_block(position, immediate)
-        self.world[position] = texture
-        self.sectors.setdefault(sectorize(position), []).append(position)
+        return self.world.exposure(position) != 0
+
+    def add_block(self, position, block_id, immediate=True):
+        """ Add a block of the palette id (see World.palette_id()) to the world at position """
+        sector = sectorize(position)
+        self.load_sector(sector)
+        changed = self.world.set_block(position, block_id)
+        self.dirty.add(sector)
+        self._schedule_around([position])
         if immediate:
-            if self.exposed(position):
-                self.show_block(position)
-            self.check_neighbors(position)
+            self.check_neighbors(changed)
 
     def remove_block(self, position, immediate=True):
         """ The lord giveth, and the lord taketh """
-        del self.world[position]
-        self.sectors[sectorize(position)].remove(position)
+        if not self.world.block_id(position):
+            raise KeyError(position)
+        changed = self.world.set_block(position, 0)
+        self.dirty.add(sectorize(position))
+        self._schedule_around([position])
         if immediate:
-            if position in self.shown:
-                self.hide_block(position)
-            self.check_neighbors
+            self.check_neighbors(changed)
 
-    def check_neighbors(self, position):
-        """ Check for the sides of the current block, are they blocked? Do they have friends? I wish I had friends.
-    This means hiding blocks that aren't exposed, and exposed blocks are shown. Usually used after a block is added/removed
+    def add_blocks(self, blocks, immediate=True):
+        """ add_block() in bulk, for pasting whole structures - blocks is an iterable of (position, texture) pairs.
+        Every block goes in before anything gets recomputed, so each touched sector is re-meshed once rather than once
+        per block.
+        """
+        positions = []
+        block_ids = []
+        for position, texture in blocks:
+            positions.append(position)
+            block_ids.append(self.world.palette_id(texture))
+        self._set_blocks(positions, block_ids, immediate)
+
+    def remove_blocks(self, positions, immediate=True):
+        """ remove_block() in bulk. Positions without a block are skipped rather than complained about. """
+        self._set_blocks(list(positions), 0, immediate)
+
+    def fill_region(self, lo, hi, texture, immediate=True):
+        """ Fill the box from block lo to block hi (both included) with texture - or empty it, with texture None """
+        axes = [np.arange(min(a, b), max(a, b) + 1) for a, b in zip(lo, hi)]
+        positions = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+        block_id = 0 if texture is None else self.world.palette_id(texture)
+        self._set_blocks(positions, block_id, immediate)
+
+    def _set_blocks(self, positions, block_ids, immediate):
+        """ Private implementation of the bulk edits """
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+        for sector, _ in World.group_by_sector(positions):
+            self.load_sector(sector)
+            self.dirty.add(sector)
+        changed = self.world.set_blocks(positions, block_ids)
+        self._schedule_around(positions)
+        if immediate:
+            self.check_neighbors(changed)
+
+    def schedule_update(self, position, delay=FALL_TICKS):
+        """ Have update_blocks() look at the block at position again delay ticks from now. If it's already due
+        sooner than that, it stays that way.
         """
+        due = self.ticks + delay
+        if self._update_due.get(position, due + 1) <= due:
+            return
+        self._update_due[position] = due
         x, y, z = position
-        for dx, dy, dz in FACES:
-            key = (x + dx, y + dy, z + dz)
-            if key not in self.world:
+        heapq.heappush(self._updates, (due, y, x, z))
+
+    def _schedule_around(self, positions):
+        """ Schedule an update for every block that has any use for one, now the blocks at the positions have changed -
+        the blocks themselves, and the ones next to them
+        """
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+        near = (positions[:, None, :] + np.array([(0, 0, 0)] + FACES)).reshape(-1, 3)
+        # Only falling blocks do anything on an update so far
+        for position in near[self.world.registry.falls[self.world.block_ids(near)]].tolist():
+            self.schedule_update(tuple(position))
+
+    @traced
+    def update_blocks(self, immediate=True):
+        """ Move the world on a game tick: work through the block updates that are due, up to update_budget of them,
+        lowest first. Sand with nothing under it falls a block. Whatever moves goes into the world in one bulk edit at
+        the end - a whole column of sand coming down is one re-mesh, not one per block - and the bulk edit schedules
+        whatever updates come next. See _set_blocks() for immediate.
+
+        Returns the (n, 3) positions that changed and their palette ids now.
+        """
+        self.ticks += 1
+        # ObjRelMap from position to the palette id this tick has put there so far
+        changes = {}
+        done = 0
+        while self._updates and self._updates[0][0] <= self.ticks and done < self.update_budget:
+            due, y, x, z = heapq.heappop(self._updates)
+            position = (x, y, z)
+            if self._update_due.get(position) != due:
+                # It got brought forward, and that's been and gone
                 continue
-            if self.exposed(key):
-                if key not in self.shown:
-                    self.show_block
-            else:
-                if key in self.shown:
-                    self.hide_block(key)
+            del self._update_due[position]
+            done += 1
+            self._fall(position, changes)
+        positions = np.array(list(changes), dtype=np.int64).reshape(-1, 3)
+        block_ids = np.array(list(changes.values()), dtype=np.uint8)
+        if len(positions):
+            self._set_blocks(positions, block_ids, immediate)
+        return positions, block_ids
+
+    def _fall(self, position, changes):
+        """ The falling block rule: if the block at position falls and there's air under it, it moves down one. Goes by
+        the changes made so far this tick, so the block above one that just fell follows it straight down.
+        """
+        def block_id_at(p):
+            return changes[p] if p in changes else self.world.block_id(p)
 
-    def show_block(self, position, immediate=True):
-        """ Method to show the block given at the arbitrary position. This method is assuming the 
-    block as already been added with the previous class method - add_block()
+        block_id = block_id_at(position)
+        if not self.world.registry.falls[block_id]:
+            return
+        x, y, z = position
+        below = (x, y - 1, z)
+        chunk = self.world.chunk(sectorize(position))
+        # The bottom of a chunk is the bottom of the world, as far as falling goes
+        if chunk is None or y - 1 < chunk.y0 or block_id_at(below):
+            return
+        changes[position] = 0
+        changes[below] = block_id
+
+    @traced
+    def update_entities(self, dt):
+        """ Move the entities on a game tick of dt seconds """
+        self.entities.step(dt, self.sweep_many)
+
+    def draw_entities(self, alpha):
+        """ Draw every entity, alpha of the way between the last two ticks, as one mesh """
+        if not self.entities.count:
+            return
+        mesh = self.entities.mesh(alpha, self.world.face_uvs(), self.world.light_levels)
+        self._entity_mesh = self.renderer.stream(self._entity_mesh, *mesh)
+        self.renderer.draw([self._entity_mesh])
+
+    def check_neighbors(self, sectors):
+        """ Check for the sides of the current block, are they blocked? Do they have friends? I wish I had friends.
+    A block changing can expose or hide faces in its own sector and - when it sits on the edge - in the
+    sector next door, and it can cast shade or let light in further off than that. The World hands back every
+    sector that touches, and each one that's shown gets re-meshed.
         """
-        texture = self.world[position]
-        self.shown[position] = texture
+        for sector in sectors:
+            self._remesh(sector)
+
+    def show_sector(self, sector, immediate=False):
+        """ I make sure that all the blocks in the given sector that SHOULD be seen, are drawn to the canvas.
+        like little happy clouds.
+            that happy cloud will be our lil' secret.
+        """
+        self.shown.add(sector)
+        self.far.discard(sector)
+        if immediate:
+            self._show_sector(sector)
+        else:
+            self.enqueue(self._show_sector, sector)
+
+    def show_far(self, sector, immediate=False):
+        """ Like show_sector(), only the sector is drawn with a low detail mesh from mesh_far(). Whatever mesh it
+        has now stays up until the new one is ready, so switching detail never leaves a hole.
+        """
+        self.far.add(sector)
+        self.shown.discard(sector)
         if immediate:
-            self._show_block(position, texture)
+            self._show_far(sector)
         else:
-            self._enqueue(self._show_block, position, texture)
+            self.enqueue(self._show_far, sector)
 
-    def _show_block(self, position, texture):
-        """ Private method implementation of show_block() """
-        # I'm using texture_coordinates() to generate the block form
+    def _show_sector(self, sector):
+        """ Private method implementation of show_sector(). Snapshots the sector and hands it to the worker pool
+        to mesh - the finished mesh gets uploaded by _collect_meshes().
+        """
+        if sector not in self.shown or self._restore(sector, 'full'):
+            return
+        if self.executor is None:
+            self._mesh_sector(sector)
+            return
+        self._cancel_meshing(sector)
+        future = self.executor.submit(mesh_blocks, *self._mesh_args(sector))
+        self.meshing[sector] = (self.world.version(sector), future)
+
+    def _mesh_sector(self, sector):
+        """ Mesh the sector and upload it right here on the main thread """
+        self._cancel_meshing(sector)
+        self._upload(sector, *mesh_blocks(*self._mesh_args(sector)))
+
+    def _mesh_args(self, sector):
+        """ The arguments for mesh_blocks() to mesh the sector with """
+        return self.world.snapshot(sector) + (self.world.face_uvs(), self.ambient_occlusion)
+
+    def _show_far(self, sector):
+        """ Private implementation of show_far(). Low detail meshes are cheap enough to make right here. """
+        if sector not in self.far or self._restore(sector, 'far'):
+            return
+        self.load_sector(sector)
+        self._mesh_far(sector)
+
+    def _mesh_far(self, sector):
+        """ Build and upload the sector's low detail mesh """
+        self._cancel_meshing(sector)
+        chunk = self.world.chunk(sector)
+        if chunk is None:
+            self._upload(sector, *mesh_far(None, None, None), detail='far')
+        else:
+            self._upload(sector, *mesh_far(chunk.blocks, chunk.origin, self.world.face_uvs()), detail='far')
+
+    def _remesh(self, sector):
+        """ Bring the sector's mesh up to date straight away, at whatever detail it's shown at """
+        # Whatever's in the mesh cache for it is out of date now
+        self._forget_mesh(sector)
+        if sector in self.shown:
+            # Edits skip the pool - you want to see the block you just placed this frame
+            self._mesh_sector(sector)
+        elif sector in self.far:
+            self._mesh_far(sector)
+
+    def _cancel_meshing(self, sector):
+        """ Forget about any mesh the pool is building for the sector """
+        job = self.meshing.pop(sector, None)
+        if job is not None:
+            job[1].cancel()
+
+    def _collect_meshes(self, deadline=None):
+        """ Upload the meshes the pool has finished, nearest sector first, until the deadline. A mesh of a sector that
+        was edited after its snapshot was taken is thrown away and the sector goes back to the pool. One that didn't
+        get made at all goes to _mesh_failed().
+        """
+        done = [sector for sector, (_, future) in self.meshing.items() if future.done()]
+        for sector in sorted(done, key=lambda sector: self._queue_distance((sector,))):
+            version, future = self.meshing.pop(sector)
+            if future.cancelled() or sector not in self.shown:
+                continue
+            if version != self.world.version(sector):
+                self._show_sector(sector)
+                continue
+            error = future.exception()
+            if error is not None:
+                self._mesh_failed(sector, error)
+                continue
+            self._upload(sector, *future.result())
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+
+    def _mesh_failed(self, sector, error):
+        """ A worker fell over meshing the sector. Say so, and have another go right here on the main thread - if that
+        goes wrong too, the sector does without a mesh until it's shown or changed again, rather than taking the whole
+        frame down with it.
+        """
+        traceback.print_exception(type(error), error, error.__traceback__)
+        try:
+            self._mesh_sector(sector)
+        except Exception:
+            traceback.print_exc()
+
+    def _upload(self, sector, vertex_data, texture_data, colour_data, detail='full'):
+        """ Swap the sector's vertex list for one holding the given mesh, of the given detail """
+        version = self.world.version(sector)
+        if self._snapshot_meshes is not None:
+            self._snapshot_meshes[sector] = (version, vertex_data, texture_data, colour_data)
+        if self._mesh_info.get(sector, (detail,))[0] != detail:
+            # Switching detail - the other mesh may well be wanted again when the player turns back
+            self._retire(sector)
+        else:
+            self._drop_mesh(sector)
+        # An empty mesh is still worth knowing about - it's one sector the cache can spare having to mesh again
+        self._mesh_info[sector] = (detail, version, len(vertex_data) // 3)
+        if len(vertex_data):
+            self._shown[sector] = self.renderer.upload(vertex_data, texture_data, colour_data)
+            vertices = vertex_data.reshape(-1, 3)
+            self._bounds[sector] = np.array([vertices.min(axis=0), vertices.max(axis=0)])
+
+    def _drop_mesh(self, sector):
+        """ Throw the sector's mesh away """
+        handle = self._shown.pop(sector, None)
+        self._bounds.pop(sector, None)
+        self._mesh_info.pop(sector, None)
+        if handle is not None:
+            self.renderer.delete(handle)
+
+    def _retire(self, sector):
+        """ Take the sector's mesh off the screen and put it in the mesh cache, making room by throwing away the
+        meshes that have been in there longest
+        """
+        info = self._mesh_info.pop(sector, None)
+        if info is None:
+            return
+        self._forget_mesh(sector)
+        self._mesh_cache[sector] = (self._shown.pop(sector, None), self._bounds.pop(sector, None), info)
+        # Empty meshes count as a vertex, so there's never an endless pile of them
+        self._cached_vertices += info[2] or 1
+        while self._cached_vertices > self.mesh_cache_vertices:
+            self._forget_mesh(next(iter(self._mesh_cache)))
+
+    def _forget_mesh(self, sector):
+        """ Throw away the sector's mesh in the mesh cache, if there is one """
+        entry = self._mesh_cache.pop(sector, None)
+        if entry is not None:
+            self._cached_vertices -= entry[2][2] or 1
+            if entry[0] is not None:
+                self.renderer.delete(entry[0])
+
+    def _restore(self, sector, detail):
+        """ Put the sector's mesh back on the screen out of the mesh cache - so long as it's the detail wanted, and
+        nothing's changed since it was made. Returns whether it was.
+        """
+        entry = self._mesh_cache.get(sector)
+        if entry is None or entry[2][:2] != (detail, self.world.version(sector)):
+            self._forget_mesh(sector)
+            self.cache_misses += 1
+            return False
+        del self._mesh_cache[sector]
+        self._cached_vertices -= entry[2][2] or 1
+        self.cache_hits += 1
+        self._cancel_meshing(sector)
+        self._retire(sector)
+        handle, bounds, self._mesh_info[sector] = entry
+        if handle is not None:
+            self._shown[sector], self._bounds[sector] = handle, bounds
+        return True
+
+    def draw(self, planes=None, eye=None):
+        """ Draw the shown sectors - only the ones at least partly inside the frustum planes, if you pass some, and only
+        the ones there could be a line of sight to from the eye position, if you pass that
+        """
+        sectors = list(self._shown)
+        if eye is not None and sectors:
+            visible = self.visible_sectors(eye)
+            sectors = [sector for sector in sectors if sector in visible]
+        self.occluded = len(self._shown) - len(sectors)
+        if planes is not None and sectors:
+            bounds = np.array([self._bounds[sector] for sector in sectors])
+            visible = boxes_in_frustum(bounds[:, 0], bounds[:, 1], planes)
+            sectors = [sector for sector, inside in zip(sectors, visible.tolist()) if inside]
+        self.culled = len(self._shown) - self.occluded - len(sectors)
+        self.renderer.draw([self._shown[sector] for sector in sectors])
+
+    @traced
+    def visible_sectors(self, eye, budget=LINKS_PER_FRAME):
+        """ Return the shown sectors there could be a line of sight to from the eye position, going by the gaps
+        in the blocks (see occlusion.py). Face links out of date with the world get worked out again, up to budget of
+        them a call - until then the sector is taken to link everything to everything, so nothing goes missing.
+        """
+        links = {}
+        for sector in self._shown:
+            version = self.world.version(sector)
+            known = self._links.get(sector)
+            if known is None or known[0] != version:
+                if budget <= 0:
+                    links[sector] = None
+                    continue
+                budget -= 1
+                chunk = self.world.chunk(sector)
+                known = (version, face_links(chunk.blocks != 0, FACES) if chunk is not None else [ALL_FACES] * 6)
+                self._links[sector] = known
+                self._links_changed += 1
+            links[sector] = known[1]
+        for sector in list(self._links):
+            if sector not in self._shown:
+                del self._links[sector]
+                self._links_changed += 1
+        start = sectorize(eye)
+        faces = self._camera_faces(start, normalize(eye))
+        key = (start, faces, self._links_changed)
+        if self._visible is None or self._visible[0] != key or None in links.values():
+            self._visible = (key, visible_sectors(start, faces, links, FACES))
+        return self._visible[1]
+
+    def _camera_faces(self, sector, position):
+        """ The bit set of the sector's faces the air at position connects to - ALL_FACES when we can't tell """
+        chunk = self.world.chunk(sector)
+        if chunk is None:
+            return ALL_FACES
+        version = self.world.version(sector)
+        if self._camera is None or self._camera[:2] != (sector, version):
+            self._camera = (sector, version, connectivity(chunk.blocks != 0, FACES))
+        bits, sky = self._camera[2]
         x, y, z = position
-        vertex_data = cube_vertices(x, y, z, 0.5)
-        texture_data = list(texture)
-        # bring a vertex list to life
-        # TODO: Possibly look into add_indexed() method rather than the following method. *nervous laughs*
-        self._shown[position] = self.batch.add(24, GL_QUADS, self.group,
-                                               ('v3f/static', vertex_data)
-                                               ('t2f/static', texture_data))
-
-    def hide_block(self, position, immediate=True):
-        """ Hide the block from the given player position, and player view. Hiding the block doesn't
-    remove the block from the world. Nor remove it's feelings.
-    ha.
-        """
-        self.shown.pop(position)  # pops it off, then returns it
+        y -= chunk.y0
+        if y >= chunk.blocks.shape[1]:
+            # Up in the sky, where everything open to it is in sight
+            return 1 << FACES.index((0, 1, 0))
+        if y < 0 or chunk.blocks[x % SECTOR_SIZE, y, z % SECTOR_SIZE]:
+            return ALL_FACES
+        return int(bits[x % SECTOR_SIZE, y, z % SECTOR_SIZE])
+
+    def hide_sector(self, sector, immediate=False):
+        """ Byeeeee cloud """
+        self.shown.discard(sector)
+        self.far.discard(sector)
         if immediate:
-            self._hide_block(position)
+            self._hide_sector(sector)
         else:
-            self._enqueue(self._hide_block, position)
+            self.enqueue(self._hide_sector, sector)
 
     # Good lord, do I hate the word queue.
     # .... Queueeueueue?
 
-    def _hide_block(self, position):
-        """ Private implementation of hide_block() """
-        self._shown.pop(position).delete()
-
-    def show_sector(self, sector):
-        """ I make sure that all the blocks in the given sector that SHOULD be seen, are drawn to the canvas.
-        like little happy clouds.
-            that happy cloud will be our lil' secret.
+    def _hide_sector(self, sector):
+        """ Private implementation of hide_sector() """
+        if sector in self.shown or sector in self.far:
+            return
+        self._cancel_meshing(sector)
+        self._retire(sector)
+
+    @staticmethod
+    def _within(dx, dz, pad):
+        """ Whether a sector dx, dz sectors away is in reach of pad - inside the square, corners rounded off """
+        return max(abs(dx), abs(dz)) <= pad and dx ** 2 + dz ** 2 <= (pad + 1) ** 2
+
+    def _detail(self, sector, focus):
+        """ How the sector ought to be drawn with the player in focus: 'full', 'far' or None for not at all.
+        A sector holds on to the detail it has now until it's LOD_HYSTERESIS sectors past where it would change.
         """
-        for position in self.sectors.get(sector, []):
-            if position not in self.shown and self.exposed(position):
-                self.show_block(position, False)
-
-    def hide_sector(self, sector):
-        """ Byeeeee cloud """
-        for position in self.sectors.get(sector, []):
-            if position in self.shown:
-                self.hide_block(position, False)
-
+        x, _, z = sector
+        fx, _, fz = focus
+        dx, dz = x - fx, z - fz
+        slack = LOD_HYSTERESIS if sector in self.shown else 0
+        if self._within(dx, dz, self.show_pad + slack):
+            return 'full'
+        slack = LOD_HYSTERESIS if sector in self.shown or sector in self.far else 0
+        if self._within(dx, dz, self.lod_pad + slack):
+            return 'far'
+        return None
+
+    @traced
     def change_sector(self, before, after):
         """ Move from the previous sector of the world, to the 'after'. (So philosphical. is there an after?)
-    Anyway......... subdividing the world into sectors help render the world quicker.
+    Anyway......... subdividing the world into sectors help render the world quicker. Close by sectors get shown in
+    full, the ones further out as low detail stand-ins, and the rest hidden.
         """
-        before_set = set()
-        after_set = set()
-        pad = 4
+        self.focus = after
+        if not after:
+            for sector in list(self.shown | self.far):
+                self.hide_sector(sector)
+            return
+        # One sector further out than we show in full, since a sector's mesh needs to know about its neighbours' blocks.
+        # Far sectors get loaded as they're meshed. Then a bit of slack before anything gets unloaded, so pacing up and
+        # down a boundary doesn't thrash.
+        self.load_around(after, self.show_pad + 1)
+        self.unload_beyond(after, self.lod_pad + LOD_HYSTERESIS + 2)
+        x, _, z = after
+        pad = self.lod_pad + LOD_HYSTERESIS
+        sectors = self.shown | self.far
         for dx in xrange(-pad, pad + 1):
-            for dy in [0]:
-                for dz in xrange(-pad, pad + 1):  # thank god for google, math is hard
-                    if dx ** 2 + dy ** 2 + dz ** 2 > (pad + 1) ** 2:
-                        continue
-                    if before:
-                        x, y, z = before
-                        before_set.add((x + dx, y + dy, z + dz))
-                    if after:
-                        x, y, z = after
-                        after_set.add((x + dx, y + dy, z + dz))
-        show = after_set - before_set
-        hide = before_set - after_set
-        for sector in show:
-            self.show_sector(sector)
-        for sector in hide:
-            self.hide_sector(sector)
+            for dz in xrange(-pad, pad + 1):  # thank god for google, math is hard
+                sectors.add((x + dx, 0, z + dz))
+        for sector in sectors:
+            detail = self._detail(sector, after)
+            if detail == 'full':
+                if sector not in self.shown:
+                    self.show_sector(sector)
+            elif detail == 'far':
+                if sector not in self.far:
+                    self.show_far(sector)
+            elif sector in self.shown or sector in self.far:
+                self.hide_sector(sector)
+
+    def set_view_distance(self, pad):
+        """ See pad sectors out - in full detail for the nearest half of that (up to SHOW_PAD), low detail beyond -
+        and show or hide whatever that changes straight away
+        """
+        self.lod_pad = max(1, pad)
+        self.show_pad = max(1, min(SHOW_PAD, self.lod_pad // 2))
+        if self.focus:
+            self.change_sector(self.focus, self.focus)
+
+    @property
+    def far_plane(self):
+        """ Distance to the edge of the furthest shown sectors - nothing past it needs drawing """
+        return float((self.lod_pad + 1) * SECTOR_SIZE)
+
+    @property
+    def cache_hit_rate(self):
+        """ How often a sector being shown again found its mesh in the mesh cache, from 0 to 1 """
+        total = self.cache_hits + self.cache_misses
+        return self.cache_hits / total if total else 0.0
+
+    @property
+    def fog_start(self):
+        """ Where the fog ought to start - about where the full detail drops off """
+        return float(self.show_pad * SECTOR_SIZE)
 
     def enqueue(self, func, *args):
-        """ Add func to the internal queue. queuueue. queueueueueueue? """
-        self.queue.append((func, args))
-
-    def _dequeue(self):
-        """ Pop off the top function from the internal queueuueue and then call it. God I REALLY hate queue. """
-        func, args = self.queue.poplet()
+        """ Add func to the internal queue. queuueue. queueueueueueue?
+        If there's already work waiting for the same sector it gets replaced - and a hide landing on a
+        show for a sector that never made it to the screen just cancels the pair of them.
+        """
+        pending = self.queue.get(args)
+        if pending is not None and func == self._hide_sector and pending[0] in (self._show_sector, self._show_far):
+            if args[0] not in self._shown:
+                del self.queue[args]
+                return
+        self.queue[args] = (func, args)
+
+    def _queue_distance(self, key):
+        """ How far (squared, in sectors) the queued work for key is from the player """
+        if self.focus is None:
+            return 0
+        x, _, z = key[0]
+        fx, _, fz = self.focus
+        return (x - fx) ** 2 + (z - fz) ** 2
+
+    def _dequeue(self, key=None):
+        """ Pop off the function nearest to the player (or the one for key) from the internal queueuueue and
+        then call it. God I REALLY hate queue.
+        """
+        if key is None:
+            key = min(self.queue, key=self._queue_distance)
+        func, args = self.queue.pop(key)
         func(*args)
 
-    def process_queue(self):
-        """ Process the entire queue while taking periodic CPU breaks... Allowing the game to run smoothly. The queue contains calls to
-        _show_block() and hide_block(). This method should be called if add_block() or remove_block() was called with immediate=False
-            If those methods are returning false, that's not good. Like... really not good.
+    @traced
+    def process_queue(self, budget=None):
+        """ Process the queue while taking periodic CPU breaks... Allowing the game to run smoothly. The queue contains calls to
+        _show_sector() and _hide_sector(), worked through nearest-to-the-player first until the budget (seconds, defaults to
+        queue_budget) runs out. At least one item always gets done so the queue can't stall.
+            The queue depth and the time spent are left in len(queue) and queue_time for tuning.
         """
-
+        start = time.perf_counter()
+        deadline = start + (self.queue_budget if budget is None else budget)
+        self._collect_meshes(deadline)
+        done = 0
+        for key in sorted(self.queue, key=self._queue_distance):
+            if len(self.meshing) >= MESH_BACKLOG and self.queue[key][0] == self._show_sector:
+                continue
+            self._dequeue(key)
+            done += 1
+            if time.perf_counter() >= deadline:
+                break
+        self.queue_done = done
+        self.queue_time = time.perf_counter() - start
+        TRACER.counter('queue', len(self.queue) + len(self.meshing))
+        self._take_snapshot()
+
+    @traced
     def process_entire_queue(self):
         """ No CPU breaks. This method apparently endorses subpar working conditions. """
-        while self.queue:
-            self._dequeue()
+        while self.queue or self.meshing:
+            while self.queue:
+                self._dequeue()
+            wait([future for _, future in self.meshing.values()])
+            self._collect_meshes()
+        self._take_snapshot()
 
 
 # MARK: END OF MODEL CLASS
 
 
-# MARK: BEGINNING OF WINDOW CLASS
-class Window(pyglet.window.Window):
+class ViewDistance(object):
+    """ Grows and shrinks the view distance to hold a target frame rate. It watches the time between frames (the dt the
+    pyglet clock hands update()), how long drawing takes and how far behind the sector queue is, and moves the view
+    distance a sector at a time - waiting for a fresh window of frames after each move, so it can see what the last
+    one did before making another.
+    """
+
+    def __init__(self, pad=LOD_PAD, target_fps=TARGET_FPS, lo=MIN_VIEW_PAD, hi=MAX_VIEW_PAD, samples=VIEW_SAMPLES):
+        self.pad = pad
+        # Seconds a frame is allowed to take
+        self.target = 1.0 / target_fps
+        self.lo = lo
+        self.hi = hi
+        # Recent (frame interval, draw time) pairs
+        self.frames = deque(maxlen=samples)
+        # Why the view distance is what it is, for the HUD
+        self.status = 'holding'
+
+    @staticmethod
+    def _percentile(values, point):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * point / 100.0))]
+
+    def update(self, dt, draw_time, backlog):
+        """ Record a frame. Returns the new view distance when it should change, otherwise None. """
+        self.frames.append((dt, draw_time))
+        if len(self.frames) < self.frames.maxlen:
+            return None
+        frame = self._percentile([f[0] for f in self.frames], 90)
+        draw = self._percentile([f[1] for f in self.frames], 90)
+        self.frames.clear()
+        if frame > self.target * 1.25 and self.pad > self.lo:
+            # Stuttering - pull the view in
+            self.pad -= 1
+            self.status = 'shrank: p90 frame %.1f ms' % (frame * 1000)
+        elif frame <= self.target * 1.1 and draw < self.target * 0.5 and backlog <= VIEW_BACKLOG and self.pad < self.hi:
+            # Making the frame rate with time to spare - push it out
+            self.pad += 1
+            self.status = 'grew: p90 draw %.1f ms' % (draw * 1000)
+        else:
+            self.status = 'holding: p90 frame %.1f ms' % (frame * 1000)
+            return None
+        return self.pad
+
+
+RECORDING_VERSION = 1
+
+
+class Recorder(object):
+    """ Writes everything that steers a Game - input events, and the dt of every update - to a file, one JSON list per
+    line: [seconds since recording started, event, args...]. The first line says which world it all happened in, so
+    replay.py can play the whole thing back exactly, without a window.
+    """
+
+    def __init__(self, path, game):
+        self.file = open(path, 'w')
+        self.start = time.perf_counter()
+        self._write({
+            'version': RECORDING_VERSION,
+            'seed': game.model.generator.seed,
+            'position': list(game.position),
+            'rotation': list(game.rotation),
+            'view_pad': game.model.lod_pad,
+        })
+
+    def _write(self, line):
+        self.file.write(json.dumps(line) + '\n')
+
+    def record(self, event, *args):
+        self._write([time.perf_counter() - self.start, event] + list(args))
+
+    def close(self, game):
+        """ Finish off with where the player ended up, and what the loaded sectors held (see Model.sector_digests()),
+        so a replay can tell whether it went the same way
+        """
+        digests = [[x, z, digest] for (x, _, z), digest in sorted(game.model.sector_digests().items())]
+        self.record('end', list(game.position), list(game.rotation), digests)
+        self.file.close()
 
-    def __init__(self, *args, **kwargs):
-        super(Window, self).__init__(*args, **kwargs)
+
+def load_recording(path):
+    """ Return (header, events) from a Recorder file """
+    with open(path) as f:
+        header = json.loads(f.readline())
+        if header.get('version') != RECORDING_VERSION:
+            raise ValueError('%s is not a version %d recording' % (path, RECORDING_VERSION))
+        return header, [json.loads(line) for line in f if line.strip()]
+
+
+# MARK: BEGINNING OF GAME CLASS
+class Game(object):
+    """ Everything the Window does that doesn't need a window - the player, the physics, and what the keys and mouse
+    do to them. The Window draws it and feeds it events; replay.py feeds it the events from a recording instead.
+    """
+
+    def __init__(self, seed=None, save_path=None, cache_path=None, renderer=None, view_pad=None,
+                 ambient_occlusion=AMBIENT_OCCLUSION):
 
         # Whether or not the Pyglet window created captures the mouse
         self.exclusive = False
@@ -395,30 +2990,22 @@ class Window(pyglet.window.Window):
 
         # Current position in the world - specified with floats. ( Tenths, hundredths, Thousandths...)
         # unlike normal coordinate planes - the Y axis is the vertical one.
-        self.position(0, 0, 0)
+        self.position = (0, 0, 0)
         # you're breaking my balls here, position
         # First element is rotation of the player on the ground. ( Yeah - I googled this method.)
         # Rotation is in degrees.
         # Math is hard.
-        self.rotation(0, 0, 0)
+        self.rotation = (0, 0)
 
-        # What sector am I in?
-        self.sector = None
+        # Where the player was at the end of the previous physics step - drawing happens somewhere in between
+        self.previous_position = self.position
 
-        # The crosshair dead-center of the screen
-        self.reticle = None
+        # Real time that hasn't been turned into physics steps yet
+        self.accumulator = 0.0
 
         # Upward velocity initial value
         self.dy = 0
 
-        # Texture inventory
-        self.inventory = [BRICK, GRASS, SAND]
-
-        # The current block the user has in their selection
-        self.block = self.inventory[0]
-        # index 0 means the first in that list, 1 == 2, etc..
-        # use num keys to cycle through
-
         # Convenience list of the number keys
         self.num_keys = [
             key._1, key._2, key._3, key._4,
@@ -428,21 +3015,22 @@ class Window(pyglet.window.Window):
 
         # Instance of the model that handles the world.
         # ... Jesus is that you?
-        self.model = Model()
+        self.model = Model(seed, save_path, renderer, cache_path=cache_path, ambient_occlusion=ambient_occlusion)
 
-        # Label displayed in the top-left of the pyglet canvas
-        self.label = pyglet.text.Label('', font_name='Arial', font_size=18,
-                                       x=10, y=self.height - 10, anchor_x='left', anchor_y='top',
-                                       color=(0, 0, 0, 255))
+        # Block inventory, as palette ids - placing and throwing hand them straight to the world
+        self.inventory = [self.model.world.palette_id(texture) for texture in (BRICK, GRASS, SAND)]
 
-        # schedule the update() method to be called
-        # TICKS_PER_SEC - The main game event loop.
-        pyglet.clock.schedule_interval(self.update, 1.0 / TICKS_PER_SEC)
+        # The current block the user has in their selection
+        self.block = self.inventory[0]
+        # index 0 means the first in that list, 1 == 2, etc..
+        # use num keys to cycle through
 
-    def set_exclusive_mouse(self, exclusive):
-        """ If exclusive is True - the game will capture the mouse movement. If false, ignore the mouse. """
-        super(Window, self).set_exclusive_mouse(exclusive)
-        self.exclusive = exclusive
+        # What sector am I in? A start from the snapshot has already shown everything around spawn - no need to
+        # do it all again
+        self.sector = self.model.focus
+
+        if view_pad is not None:
+            self.model.set_view_distance(view_pad)
 
     def get_sight_vector(self):
         """ Return the player's current LOS - indicate the direction they're facing """
@@ -491,20 +3079,44 @@ class Window(pyglet.window.Window):
             dz = 0.0
         return (dx, dy, dz)
 
-    def update(self, dt):
-        """ This method is called repeatedly by the pyglet clock """
-        self.model.process_queue()
+    def update(self, dt, budget=None):
+        """ Move the game on by dt seconds - stream the world in around the player, then run the physics """
+        self.stream(budget)
+        self.simulate(dt)
+
+    def stream(self, budget=None):
+        """ Keep the world around the player loaded and meshed. Spends up to budget seconds on the model's queue -
+        or gets through all of it, when there's no budget.
+        """
+        if budget is None:
+            self.model.process_entire_queue()
+        else:
+            self.model.process_queue(budget)
         sector = sectorize(self.position)
         if sector != self.sector:
-            self.model.change_sectors(self.sector, sector)
-            if self.sector is None:
-                self.model.process_entire_queue()  # Because this was bad, remember?
+            # No more flushing the whole queue on the first sector - the nearest sectors get meshed first anyway
+            self.model.change_sector(self.sector, sector)
             self.sector = sector
-        m = 8
-        dt = min(dt, 0.2)
-        for _ in xrange(m):
-            self._update(dt / m)
 
+    @traced
+    def simulate(self, dt):
+        """ Run the physics for dt seconds of real time """
+        # Fixed steps, however long the frame took - same physics at any frame rate
+        step = 1.0 / PHYSICS_TICKS_PER_SEC
+        self.accumulator += min(dt, MAX_FRAME_TIME)
+        while self.accumulator >= step:
+            self.previous_position = self.position
+            self.model.update_blocks()
+            self.model.update_entities(step)
+            self._update(step)
+            self.accumulator -= step
+
+    def render_position(self):
+        """ Where to draw the camera - between the last two physics steps, by how far we are into the next one """
+        alpha = self.accumulator * PHYSICS_TICKS_PER_SEC
+        return tuple(a + (b - a) * alpha for a, b in zip(self.previous_position, self.position))
+
+    @traced
     def _update(self, dt):
         """ Private implementation of the update() method - this is the home
             of the motion logic, gravity, and collision detection. Dr. Strange,
@@ -530,51 +3142,20 @@ class Window(pyglet.window.Window):
 
         # Object collisions
         x, y, z = self.position
-        x, y, z = self.collide((x + dx, y + dy, z + dz), PLAYER_HEIGHT)
-        self.position = (x, y, z)
-
-    def collide(self, position, height):
-        """ Method to check if the player at the given vector is colliding with any
-            physical blocks within the world.
-        """
-        # I had to google this implementation - but essentially - you're checking
-        # whether or not you have overlap with the dimensions of a surrounding block
-        # at the player position - if it's 0: touching terrain even slightly, counts as
-        # collision - we don't want that. It's a real slippery scale. So - 0 == collision,
-        # .49 means you're sinking straight into the ground - similar to walking through tall
-        # grass. If it's anything greater than 50%.... you're falling through the ground.
-        pad = 0.25
-        p = list(position)
-        np = normalize(position)
-        for face in FACES:  # Check the surrounding blocks
-            for i in xrange(3):  # Check each dimension independently
-                # ...... Dr. Strange, I know you're here somewhere
-                if not face[i]:
-                    continue
-                # How much overlap with the current dimension
-                d = (p[i] - np[i]) * face[i]
-                if d < pad:
-                    continue
-                for dy in xrange(height):  # Check each height dimension
-                    op = list(np)
-                    op[1] -= dy
-                    op[i] += face[i]
-                    if tuple(op) not in self.model.world:  # If the tuple is NOT in the Modeling of the Minecraft world:
-                        continue
-                    p[i] -= (d - pad) * face[i]
-                    if face == (0, -1, 0) or face == (0, 1, 0):
-                        # You're colliding with the ground or world ceiling - knock that off.
-                        # you're not supposed to break out of your box, peasant.
-                        self.dy = 0
-                    break  # break out of the loop
-        return tuple(p)
+        lo, hi = player_box(self.position, PLAYER_HEIGHT)
+        (dx, dy, dz), blocked = self.model.sweep(lo, hi, (dx, dy, dz))
+        if blocked[1]:
+            # You're colliding with the ground or world ceiling - knock that off.
+            # you're not supposed to break out of your box, peasant.
+            self.dy = 0
+        self.position = (x + dx, y + dy, z + dz)
 
     def on_mouse_press(self, x, y, button, modifiers):
         """ Method is called when the mouse button is pressed. ( See Pyglet docs, because... docs.)
         """
         if self.exclusive:
             vector = self.get_sight_vector()
-            block, previous = self.model.hit_test(self, position, vector)
+            block, previous = self.model.hit_test(self.position, vector)
             if (button == mouse.RIGHT) or \
                     ((button == mouse.LEFT) and (modifiers & key.MOD_CTRL)):
                 # If you're using a mac, first, why,
@@ -583,11 +3164,8 @@ class Window(pyglet.window.Window):
                 if previous:
                     self.model.add_block(previous, self.block)
             elif button == pyglet.window.mouse.LEFT and block:
-                texture = self.model.world[block]  # Texture == the block texture
-                if texture != STONE:
+                if self.model.world.block_type(block).breakable:
                     self.model.remove_block(block)
-        else:
-            self.set_exclusive_mouse(True)
 
     def on_mouse_motion(self, x, y, dx, dy):
         """ Method call when user moves the mouse """
@@ -615,10 +3193,11 @@ class Window(pyglet.window.Window):
         elif symbol == key.SPACE:  # Jump
             if self.dy == 0:
                 self.dy = JUMP_SPEED  # Velocity of the Jump
-        elif symbol == key.ESCAPE:  # Escape the mouse exclusivity of the pyglet window
-            self.set_exclusive_mouse(False)
         elif symbol == key.TAB:  # Turn off Flying mode
             self.flying = not self.flying
+        elif symbol == key.E:  # Throw a bit of whatever block you're holding
+            vector = self.get_sight_vector()
+            self.model.entities.spawn(self.position, np.multiply(vector, THROW_SPEED), (THROWN_SIZE,) * 3, self.block)
         elif symbol in self.num_keys:  # texture inventory
             index = (symbol - self.num_keys[0]) % len(self.inventory)
             self.block = self.inventory[index]
@@ -635,23 +3214,133 @@ class Window(pyglet.window.Window):
         elif symbol == key.D:
             self.strafe[1] -= 1
 
+
+# MARK: BEGINNING OF WINDOW CLASS
+class Window(pyglet.window.Window, Game):
+    """ The Game, on screen. Input goes through to the Game (and the Recorder, when there is one) and the Game's world
+    gets drawn.
+    """
+
+    def __init__(self, *args, **kwargs):
+        seed = kwargs.pop('seed', None)
+        save_path = kwargs.pop('save_path', None)
+        cache_path = kwargs.pop('cache_path', None)
+        # A fixed view distance, in sectors - None lets it adapt to the frame rate
+        view_pad = kwargs.pop('view_pad', None)
+        target_fps = kwargs.pop('target_fps', TARGET_FPS)
+        ambient_occlusion = kwargs.pop('ambient_occlusion', AMBIENT_OCCLUSION)
+        # Where the trace goes on the way out, if anywhere
+        self.trace_path = kwargs.pop('trace_path', None)
+        # Where to record the input to, if anywhere
+        record_path = kwargs.pop('record_path', None)
+        # Writes down the input for replay.py, when asked to (set up once there's a Game to record)
+        self.recorder = None
+        pyglet.window.Window.__init__(self, *args, **kwargs)
+        Game.__init__(self, seed, save_path, cache_path, view_pad=view_pad, ambient_occlusion=ambient_occlusion)
+
+        # How long the last on_draw() took, in seconds. Whatever's left of the tick goes to the model's queue
+        self.draw_time = 0.0
+
+        # The crosshair dead-center of the screen
+        self.reticle = None
+
+        # Keeps the view distance where the frame rate can hold up - unless it's been pinned
+        self.view = ViewDistance(self.model.lod_pad, target_fps) if view_pad is None else None
+
+        if record_path:
+            self.recorder = Recorder(record_path, self)
+
+        # Label displayed in the top-left of the pyglet canvas
+        self.label = pyglet.text.Label('', font_name='Arial', font_size=18,
+                                       x=10, y=self.height - 10, anchor_x='left', anchor_y='top',
+                                       color=(0, 0, 0, 255))
+
+        # Frame timing overlay, under the label - only while tracing (F3)
+        self.trace_label = pyglet.text.Label('', font_name='Arial', font_size=12,
+                                             x=10, y=self.height - 40, anchor_x='left', anchor_y='top',
+                                             color=(0, 0, 0, 255))
+
+        # schedule the update() method to be called
+        # TICKS_PER_SEC - The main game event loop.
+        pyglet.clock.schedule_interval(self.update, 1.0 / TICKS_PER_SEC)
+
+    def record(self, event, *args):
+        if self.recorder is not None:
+            self.recorder.record(event, *args)
+
+    def on_close(self):
+        """ Save the world (and the trace and recording, if asked for) on the way out """
+        self.model.save()
+        if self.trace_path:
+            TRACER.dump(self.trace_path)
+        if self.recorder is not None:
+            self.recorder.close(self)
+        super(Window, self).on_close()
+
+    def set_exclusive_mouse(self, exclusive):
+        """ If exclusive is True - the game will capture the mouse movement. If false, ignore the mouse. """
+        super(Window, self).set_exclusive_mouse(exclusive)
+        self.record('exclusive', exclusive)
+        self.exclusive = exclusive
+
+    @traced
+    def update(self, dt):
+        """ This method is called repeatedly by the pyglet clock """
+        self.record('update', dt)
+        budget = max(QUEUE_MIN_BUDGET, 1.0 / TICKS_PER_SEC - self.draw_time)
+        Game.update(self, dt, budget)
+        if self.view is not None:
+            pad = self.view.update(dt, self.draw_time, len(self.model.queue) + len(self.model.meshing))
+            if pad is not None:
+                self.record('view', pad)
+                self.model.set_view_distance(pad)
+                setup_fog(self.model.fog_start, self.model.far_plane)
+
+    def on_mouse_press(self, x, y, button, modifiers):
+        if self.exclusive:
+            self.record('mouse_press', x, y, button, modifiers)
+            Game.on_mouse_press(self, x, y, button, modifiers)
+        else:
+            self.set_exclusive_mouse(True)
+
+    def on_mouse_motion(self, x, y, dx, dy):
+        if self.exclusive:
+            self.record('mouse_motion', x, y, dx, dy)
+            Game.on_mouse_motion(self, x, y, dx, dy)
+
+    def on_key_press(self, symbol, modifiers):
+        if symbol == key.ESCAPE:  # Escape the mouse exclusivity of the pyglet window
+            self.set_exclusive_mouse(False)
+        elif symbol == key.F3:  # Tracing, and the frame timing overlay that comes with it
+            TRACER.toggle()
+        elif symbol == key.F12:  # Dump the last few seconds of trace
+            path = self.trace_path or time.strftime('pycraft-trace-%Y%m%d-%H%M%S.json')
+            TRACER.dump(path)
+        else:
+            self.record('key_press', symbol, modifiers)
+            Game.on_key_press(self, symbol, modifiers)
+
+    def on_key_release(self, symbol, modifiers):
+        self.record('key_release', symbol, modifiers)
+        Game.on_key_release(self, symbol, modifiers)
+
     # cries softly
 
-    #    def on_resize(self, width, height):
-    #        """ Window resizing, because you're picky. """
-    #
-    #       # label
-    #        self.label.y = height - 10
-    #
-    #        # reticle
-    #
-    #        if self.reticle:
-    #            self.reticle.delete()
-    #        x, y = self.width // 2, self.height // 2
-    #        n = 10
-    #        self.reticle = pyglet.graphics.vertex_list(4,
-    #        ('v2i', (x - n, y, x + n, y, x, y- n, x, y + n)) # in google's name we pray, amen
-    #    )
+    def on_resize(self, width, height):
+        """ Window resizing, because you're picky. """
+
+        # label
+        self.label.y = height - 10
+        self.trace_label.y = height - 40
+
+        # reticle
+
+        if self.reticle:
+            self.reticle.delete()
+        x, y = self.width // 2, self.height // 2
+        n = 10
+        self.reticle = pyglet.graphics.vertex_list(
+            4, ('v2i', (x - n, y, x + n, y, x, y - n, x, y + n)))  # in google's name we pray, amen
 
     def set_2d(self):
         """ Config OpenGL to draw in 2d """
@@ -671,28 +3360,33 @@ class Window(pyglet.window.Window):
         glViewport(0, 0, width, height)
         glMatrixMode(GL_PROJECTION)
         glLoadIdentity()
-        gluPerspective(65.0, width / float(height), 0.1, 60.0)  # Float == decimals
+        gluPerspective(FIELD_OF_VIEW, width / float(height), NEAR_PLANE, self.model.far_plane)  # Float == decimals
         glMatrixMode(GL_MODELVIEW)
         glLoadIdentity()
         x, y = self.rotation
         glRotatef(x, 0, 1, 0)
         glRotatef(-y, math.cos(math.radians(x)), 0, math.sin(math.radians(x)))  # Google.com
-        x, y, z = self.position
+        x, y, z = self.render_position()
         glTranslatef(-x, -y, -z)
-   
+
+    @traced
     def on_draw(self):
         """ Pyglet calling to draw on it's canvas. Pyglet == Bob Ross """
 
-        window.clear()
-        label.draw()
-        fps.draw()
+        TRACER.frame()
+        start = time.perf_counter()
+        self.clear()
         self.set_3d()
         glColor3d(1, 1, 1)
-        self.model.batch.draw()
+        width, height = self.get_size()
+        self.model.draw(frustum_planes(self.render_position(), self.rotation, width / float(height),
+                                       far=self.model.far_plane), self.render_position())
+        self.model.draw_entities(self.accumulator * PHYSICS_TICKS_PER_SEC)
         self.draw_focused_block()
         self.set_2d()
         self.draw_label()
         self.draw_reticle()
+        self.draw_time = time.perf_counter() - start
 
     def draw_focused_block(self):
         """ Black edges around the block currently in the crosshairs. """
@@ -707,21 +3401,37 @@ class Window(pyglet.window.Window):
             pyglet.graphics.draw(24, GL_QUADS, ('v3f/static', vertex_data))
             glPolygonMode(GL_FRONT_AND_BACK, GL_FILL)  # My neck, my back
 
-
-def draw_label(self):
-    """ Label in the top left of the screen """
-    """ Somewhat unnecessary, but meh """
-    x, y, z = self.position
-    self.label.text = '%02d (%.2f, %.2f, %.2f) %d / %d' % (
-        pyglet.clock.get_fps(), x, y, z,
-        len(self.model._shown), len(self.model.world))  # String and digit concatenation
-    self.label.draw()
+    def draw_label(self):
+        """ Label in the top left of the screen """
+        """ Somewhat unnecessary, but meh """
+        x, y, z = self.position
+        self.label.text = ('%02d (%.2f, %.2f, %.2f) %d / %d  culled %d+%d  entities %d  queue %d+%d (%.1f ms)  '
+                           'cache %d%%  view %d/%d %s') % (
+            pyglet.clock.get_fps(), x, y, z,
+            len(self.model._shown), len(self.model.world), self.model.culled, self.model.occluded,
+            len(self.model.entities),
+            len(self.model.queue), len(self.model.meshing), self.model.queue_time * 1000,
+            self.model.cache_hit_rate * 100,
+            self.model.show_pad, self.model.lod_pad,
+            self.view.status if self.view else 'fixed')  # String and digit concatenation
+        self.label.draw()
+        if TRACER.enabled:
+            p50, p95, p99 = TRACER.percentiles(50, 95, 99)
+            self.trace_label.text = 'frame p50 %.1f  p95 %.1f  p99 %.1f ms   queue %d   draw %.1f ms' % (
+                p50 * 1000, p95 * 1000, p99 * 1000,
+                len(self.model.queue) + len(self.model.meshing), self.draw_time * 1000)
+            self.trace_label.draw()
+
+    def draw_reticle(self):
+        """ The crosshair """
+        glColor3d(0, 0, 0)
+        self.reticle.draw(GL_LINES)
 
 
 # Almost there
 
-def setup_fog():
-    """ OpenGL Fog props """
+def setup_fog(start=FOG_START, end=FAR_PLANE):
+    """ OpenGL Fog props. Call again with a new start and end whenever the view distance changes. """
     """ ugh - so immersive, amirite? """
 
     # Enable fog - this blends a fog color with pixel fragments
@@ -739,13 +3449,13 @@ def setup_fog():
     glFogi(GL_FOG_MODE, GL_LINEAR)
 
     # How close/distant the fog starts and ends. Closer the start and end = denser fog
-    glFogf(GL_FOG_START, 20.0)
-    glFogf(GL_FOG_END, 60.0)
+    glFogf(GL_FOG_START, start)
+    glFogf(GL_FOG_END, end)
 
 
 # almost there praise jeebus
 
-def setup():
+def setup(fog_start=FOG_START, fog_end=FAR_PLANE):
     """ OpenGL config """
 
     # Color of the sky = clear
@@ -755,16 +3465,38 @@ def setup():
     glEnable(GL_CULL_FACE)  # roll face
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-    setup_fog()  # Call previous fog method
+    setup_fog(fog_start, fog_end)  # Call previous fog method
 
 
 def main():
-    window = pyglet.window.Window()
+    parser = argparse.ArgumentParser(description='Pycraft - the Pythonic version of Minecraft')
+    parser.add_argument('--seed', type=int, help='world seed (default: random)')
+    parser.add_argument('--save', help='directory to save the world in, and load it from')
+    parser.add_argument('--cache', default=CACHE_PATH,
+                        help='directory for startup snapshots, which make relaunching a seed quicker ("" for none)')
+    parser.add_argument('--view', type=int, help='fixed view distance in sectors (default: adapt to the frame rate)')
+    parser.add_argument('--fps', type=float, default=TARGET_FPS, help='frame rate the view distance adapts to hold')
+    parser.add_argument('--no-ao', action='store_true', help='don\'t shade the corners where blocks meet')
+    parser.add_argument('--record', help='record the input to this file, for replay.py')
+    parser.add_argument('--trace', action='store_true', help='trace from the start (F3 toggles it in game)')
+    parser.add_argument('--trace-seconds', type=float, default=TRACE_SECONDS,
+                        help='how many seconds of trace to keep for a dump')
+    parser.add_argument('--trace-out', help='dump the trace here on exit, and on F12')
+    args = parser.parse_args()
+    if args.record and args.save:
+        # A replay starts from a freshly generated world - a saved one won't be the same by then
+        parser.error('--record needs a fresh world, so it can\'t be used with --save')
+    TRACER.seconds = args.trace_seconds
+    if args.trace:
+        TRACER.toggle()
+
+    window = Window(width=800, height=600, caption='Pycraft', resizable=True,
+                    seed=args.seed, save_path=args.save, cache_path=args.cache or None,
+                    view_pad=args.view, target_fps=args.fps, ambient_occlusion=not args.no_ao,
+                    trace_path=args.trace_out, record_path=args.record)
     # Hide the mouse for invis reticle - and then prevent the cursor from leaving window boundaries
     # window.set_exclusive_mouse(True)
-    setup()
-    window.clear()
-    window.flip()
+    setup(window.model.fog_start, window.model.far_plane)
     pyglet.app.run()
 
 
@@ -0,0 +1,135 @@
+""" Pycraft occlusion - which sectors could be seen from where the camera is, going by the gaps between them """
+
+# The idea (it's the one Minecraft uses for caves) is to work out, once per sector, which of its faces are linked to
+# which through the air inside it. A sector you can only get into through its left face, and whose left face
+# only leads on to its right face, is only any use for seeing through to the sector on its right - and if its left
+# face leads nowhere at all, nothing past it can be seen through it. Starting from the camera's sector, a search
+# through the sectors that only ever steps through linked faces finds everything there's a line of sight to. Or
+# rather a bit more than that - the search doesn't care which way anything is facing, so it never hides anything
+# that can be seen, it just misses some things that can't.
+#
+# Sectors here are whole columns of the world, so they've no neighbours above or below: below a column there's
+# only the dark, and above it the open sky - which every column with air open to the sky shares. The sky is one
+# more place the search can go, and from it every column with a view of the sky is in sight.
+#
+# Face links are kept as a bit set per face, in FACES order - bit g of links[f] is set when face f leads on to
+# face g. A face that has any air on it at all leads on to itself.
+from __future__ import division
+
+from collections import deque
+
+import numpy as np
+
+ALL_FACES = 0x3f
+# Every bit of a links entry - what a face of a sector we know nothing about links to
+
+
+def connectivity(solid, faces):
+    """ Flood the air in a column's (x, y, z) solid array in from each of its faces. Returns the bit set of the faces
+    every cell is linked to through the air (0 for the solid ones), and which cells have nothing but air above them.
+    """
+    air = ~solid
+    # Anything with no block above it is open to the sky - one big space with the top of the column
+    sky = ~np.logical_or.accumulate(solid[:, ::-1, :], axis=1)[:, ::-1, :]
+    bits = np.zeros(solid.shape, dtype=np.uint8)
+    for face, (dx, dy, dz) in enumerate(faces):
+        if dy > 0:
+            bits[sky] |= 1 << face
+        elif not dy:
+            side = (0 if dx < 0 else -1 if dx else slice(None), slice(None), 0 if dz < 0 else -1 if dz else slice(None))
+            bits[side] |= air[side].astype(np.uint8) << face
+    keep = np.where(air, 0xff, 0).astype(np.uint8)
+    while True:
+        grown = bits.copy()
+        grown[1:] |= bits[:-1]
+        grown[:-1] |= bits[1:]
+        grown[:, 1:] |= bits[:, :-1]
+        grown[:, :-1] |= bits[:, 1:]
+        grown[:, :, 1:] |= bits[:, :, :-1]
+        grown[:, :, :-1] |= bits[:, :, 1:]
+        grown &= keep
+        if sky.any():
+            # All the open sky in the column is the same place, however far apart the cells are
+            grown[sky] |= np.bitwise_or.reduce(grown[sky])
+        if np.array_equal(grown, bits):
+            return bits, sky
+        bits = grown
+
+
+def face_links(solid, faces):
+    """ Return the links of a column with the (x, y, z) solid array - a list of the bit set of faces each face, in faces
+    order, leads on to through the air in the column
+    """
+    bits, sky = connectivity(solid, faces)
+    links = []
+    for face, (dx, dy, dz) in enumerate(faces):
+        if dy > 0:
+            cells = bits[sky]
+        elif dy < 0:
+            cells = bits[:0, 0, 0]
+        else:
+            cells = bits[0 if dx < 0 else -1 if dx else slice(None), :, 0 if dz < 0 else -1 if dz else slice(None)]
+        links.append(int(np.bitwise_or.reduce(cells.ravel())) if cells.size else 0)
+    return links
+
+
+def visible_sectors(start, start_faces, links, faces):
+    """ Search out from the camera's sector for every sector there could be a line of sight to.
+
+    Params
+    -------
+    start: the sector the camera's in
+    start_faces: the bit set of the start sector's faces the camera can get to through the air
+    links: ObjRelMap from sector to its face_links(). Only the sectors in it are searched. None as the links means
+        a sector we know nothing about, which might link anything to anything. The start sector doesn't have to be in
+        it - with no mesh there (past the edge of the world, say) there are no walls either, so the search just goes
+        out through start_faces.
+    faces: FACES - which face is which
+
+    then Returns:
+    -------
+    the set of sectors that could be in sight
+    """
+    top = faces.index((0, 1, 0))
+    opposite = [faces.index((-dx, -dy, -dz)) for dx, dy, dz in faces]
+    # ObjRelMap from sector to the bit set of its faces the search has come in through - each is only followed once
+    reached = {}
+    queue = deque()
+
+    def enter(sector, face):
+        seen = reached.get(sector, 0)
+        if sector in links and not seen & (1 << face):
+            reached[sector] = seen | (1 << face)
+            queue.append((sector, face))
+
+    visible = set([start])
+    exits = start_faces
+    sector = start
+    sky = False
+    while True:
+        x, _, z = sector
+        for face in _bits(exits):
+            dx, dy, dz = faces[face]
+            if dy > 0 and not sky:
+                # In sight of the sky, so in sight of every column that is
+                sky = True
+                for other, other_links in links.items():
+                    if other_links is None or other_links[top] & (1 << top):
+                        enter(other, top)
+            elif not dy:
+                enter((x + dx, 0, z + dz), opposite[face])
+        if not queue:
+            return visible
+        sector, face = queue.popleft()
+        visible.add(sector)
+        exits = ALL_FACES if links[sector] is None else links[sector][face]
+
+
+def _bits(bits):
+    """ Yield the indices of the bits set in bits """
+    index = 0
+    while bits:
+        if bits & 1:
+            yield index
+        bits >>= 1
+        index += 1
@@ -0,0 +1,201 @@
+""" Pycraft region files - where the world goes when you quit """
+
+# A region file holds REGION_SIZE x REGION_SIZE sectors. It starts with a fixed size table saying
+# where each sector lives in the file, so finding one is a single lookup - and since the file is
+# mmap'd, only the sectors you actually ask for ever get read off the disk and decoded.
+#
+#   header   MAGIC, format version, REGION_SIZE
+#   table    REGION_SIZE ** 2 entries of (offset, length, flags), in sector x-major order
+#   payload  per sector: y0, height, then the block ids - zlib'd when that makes them smaller
+from __future__ import division
+
+import json
+
+import mmap
+
+import os
+
+import struct
+
+import zlib
+
+import numpy as np
+
+MAGIC = b'PYCR'
+
+VERSION = 1
+
+REGION_SIZE = 32
+
+HEADER = struct.Struct('<4sHH')
+
+ENTRY = struct.Struct('<QII')
+
+PAYLOAD = struct.Struct('<iH')
+
+TABLE_OFFSET = HEADER.size
+
+DATA_OFFSET = TABLE_OFFSET + ENTRY.size * REGION_SIZE ** 2
+
+# Entry flags
+PRESENT = 1  # The sector has been saved - without this it's never been touched
+COMPRESSED = 2  # The payload's block ids are zlib'd
+EMPTY = 4  # Saved with nothing in it, so don't go generating it again
+
+# Saved sectors come back as this when there are no blocks in them
+EMPTY_SECTOR = object()
+
+
+class RegionFile(object):
+    """ One region file on disk. Reads come out of an mmap of the file, writes go through a plain file handle. """
+
+    def __init__(self, path, sector_size):
+        self.path = path
+        self.sector_size = sector_size
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, REGION_SIZE))
+                f.write(b'\0' * (DATA_OFFSET - TABLE_OFFSET))
+        self.file = open(path, 'r+b')
+        self._map = None
+        magic, version, size = HEADER.unpack(self._mapped()[:HEADER.size])
+        if magic != MAGIC or version != VERSION or size != REGION_SIZE:
+            self.close()
+            raise ValueError('%s is not a version %d region file' % (path, VERSION))
+
+    def _mapped(self):
+        """ Return the mmap of the file, (re)mapping it if the file has changed since """
+        if self._map is None:
+            self._map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _entry(self, index):
+        return ENTRY.unpack_from(self._mapped(), TABLE_OFFSET + index * ENTRY.size)
+
+    def saved(self, index):
+        """ Whether the sector at the index has ever been saved """
+        return bool(self._entry(index)[2] & PRESENT)
+
+    def read(self, index):
+        """ Return (y0, blocks) for the sector at the index, EMPTY_SECTOR if it was saved empty, or None if it
+        has never been saved
+        """
+        offset, length, flags = self._entry(index)
+        if not flags & PRESENT:
+            return None
+        if flags & EMPTY:
+            return EMPTY_SECTOR
+        data = self._mapped()[offset:offset + length]
+        y0, height = PAYLOAD.unpack_from(data)
+        data = data[PAYLOAD.size:]
+        if flags & COMPRESSED:
+            data = zlib.decompress(data)
+        n = self.sector_size
+        blocks = np.frombuffer(data, dtype=np.uint8).reshape(n, height, n).copy()
+        return y0, blocks
+
+    def write(self, index, y0, blocks, compress=True):
+        """ Save the sector at the index. Pass blocks=None to save it as empty. """
+        offset, length, _ = self._entry(index)
+        if blocks is None:
+            self._write_entry(index, offset, length, PRESENT | EMPTY)
+            return
+        flags = PRESENT
+        data = np.ascontiguousarray(blocks, dtype=np.uint8).tobytes()
+        if compress:
+            packed = zlib.compress(data)
+            if len(packed) < len(data):
+                data = packed
+                flags |= COMPRESSED
+        data = PAYLOAD.pack(y0, blocks.shape[1]) + data
+        if len(data) > length:
+            # Doesn't fit where it was - tack it on the end instead
+            self.file.seek(0, os.SEEK_END)
+            offset = self.file.tell()
+        else:
+            self.file.seek(offset)
+        self.file.write(data)
+        self._write_entry(index, offset, len(data), flags)
+
+    def _write_entry(self, index, offset, length, flags):
+        self.file.seek(TABLE_OFFSET + index * ENTRY.size)
+        self.file.write(ENTRY.pack(offset, length, flags))
+        self.file.flush()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self.file.close()
+
+
+class RegionStore(object):
+    """ A saved world - a directory of region files, plus level.json for the seed and block palette """
+
+    def __init__(self, path, sector_size, max_open=16):
+        self.path = path
+        self.sector_size = sector_size
+        # Most region files kept open at once
+        self.max_open = max_open
+        # ObjRelMap from (region x, region z) to its open RegionFile, least recently used first
+        self.regions = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _region(self, sector, create):
+        """ Return (RegionFile, table index) for the sector. The RegionFile is None if it doesn't exist yet
+        and create is False.
+        """
+        x, _, z = sector
+        key = (x // REGION_SIZE, z // REGION_SIZE)
+        index = (x % REGION_SIZE) * REGION_SIZE + z % REGION_SIZE
+        region = self.regions.pop(key, None)
+        if region is None:
+            path = os.path.join(self.path, 'r.%d.%d.region' % key)
+            if not create and not os.path.exists(path):
+                return None, index
+            if len(self.regions) >= self.max_open:
+                oldest = next(iter(self.regions))
+                self.regions.pop(oldest).close()
+            region = RegionFile(path, self.sector_size)
+        self.regions[key] = region
+        return region, index
+
+    def load(self, sector):
+        """ Return (y0, blocks), EMPTY_SECTOR, or None if the sector was never saved """
+        region, index = self._region(sector, False)
+        if region is None:
+            return None
+        return region.read(index)
+
+    def saved(self, sector):
+        """ Whether the sector has ever been saved - without reading it in """
+        region, index = self._region(sector, False)
+        return region is not None and region.saved(index)
+
+    def save(self, sector, y0, blocks):
+        """ Save the sector's blocks, or blocks=None when it's empty """
+        region, index = self._region(sector, True)
+        region.write(index, y0, blocks)
+
+    def load_level(self):
+        """ Return the level.json contents, or None for a brand new world """
+        path = os.path.join(self.path, 'level.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def save_level(self, level):
+        path = os.path.join(self.path, 'level.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(level, f)
+        os.replace(path + '.tmp', path)
+
+    def close(self):
+        for region in self.regions.values():
+            region.close()
+        self.regions = {}
@@ -0,0 +1,164 @@
+#! python3
+""" Pycraft replay - plays back a recording from main.py --record without a window, as fast as it'll go """
+
+# The recording holds the seed, and every input event and update dt in the order they happened, so the Game
+# goes through exactly the same motions every time - which makes it a fixed workload for timing movement,
+# streaming and editing. Every update gets the whole sector queue done rather than a slice of it, so the
+# streaming work doesn't depend on how fast the machine is either.
+#
+#   python main.py --seed 3 --record walk.rec
+#   python replay.py walk.rec --out before.json
+#
+# No display to record on? --demo writes a scripted recording - a walk, some jumps, a bit of building.
+from __future__ import division
+
+import argparse
+
+import json
+
+import random
+
+import sys
+
+import time
+
+import pyglet
+
+# No display needed - and don't go making a hidden GL window on import either
+pyglet.options['shadow_window'] = False
+
+from pyglet.window import key, mouse
+
+import main
+from main import Game, NullRenderer, Recorder, load_recording
+
+PHASES = ('input', 'edit', 'stream', 'physics')
+
+
+def replay(path):
+    """ Play the recording back. Returns the timings, and whether the player ended up where they did when recording,
+    with the same blocks in the sectors both runs had loaded.
+    """
+    header, events = load_recording(path)
+    game = Game(header['seed'], renderer=NullRenderer(), view_pad=header['view_pad'])
+    game.position = game.previous_position = tuple(header['position'])
+    game.rotation = tuple(header['rotation'])
+    phases = dict((phase, 0.0) for phase in PHASES)
+    ticks = []
+    end = None
+    start = time.perf_counter()
+    for event in events:
+        name, args = event[1], event[2:]
+        before = time.perf_counter()
+        if name == 'update':
+            game.stream()
+            middle = time.perf_counter()
+            game.simulate(args[0])
+            after = time.perf_counter()
+            phases['stream'] += middle - before
+            phases['physics'] += after - middle
+            ticks.append(after - before)
+        elif name == 'mouse_press':
+            game.on_mouse_press(*args)
+            phases['edit'] += time.perf_counter() - before
+        elif name in ('mouse_motion', 'key_press', 'key_release'):
+            getattr(game, 'on_' + name)(*args)
+            phases['input'] += time.perf_counter() - before
+        elif name == 'exclusive':
+            game.exclusive = args[0]
+        elif name == 'view':
+            game.model.set_view_distance(args[0])
+        elif name == 'end':
+            end = args
+    seconds = time.perf_counter() - start
+    game.model.executor.shutdown()
+    matched = None
+    if end is not None:
+        position, rotation, digests = end
+        matched = (all(abs(a - b) < 1e-9 for a, b in zip(position, game.position)) and
+                   all(abs(a - b) < 1e-9 for a, b in zip(rotation, game.rotation)))
+        if isinstance(digests, list):
+            # Only the sectors both runs had loaded - how far out streaming got depends on how fast it went live
+            mine = game.model.sector_digests()
+            matched = matched and all(mine.get((x, 0, z), digest) == digest for x, z, digest in digests)
+    ticks.sort()
+    return {
+        'seconds': seconds,
+        'ticks': len(ticks),
+        'ticks_per_sec': len(ticks) / seconds if seconds else None,
+        'recorded_seconds': sum(event[2] for event in events if event[1] == 'update'),
+        'tick_p50_ms': ticks[len(ticks) // 2] * 1000 if ticks else 0.0,
+        'tick_p99_ms': ticks[min(len(ticks) - 1, int(len(ticks) * 0.99))] * 1000 if ticks else 0.0,
+        'phases_ms': dict((phase, phases[phase] * 1000) for phase in PHASES),
+        'position': list(game.position),
+        'matched': matched,
+    }
+
+
+def demo(path, seed, seconds):
+    """ Write a scripted recording: wander about at 60 updates a second, jumping now and then, and building and
+    digging as we go
+    """
+    rng = random.Random(seed)
+    game = Game(seed, renderer=NullRenderer(), view_pad=main.LOD_PAD)
+    recorder = Recorder(path, game)
+
+    def send(name, *args):
+        recorder.record(name, *args)
+        if name == 'update':
+            game.update(*args)
+        elif name == 'exclusive':
+            game.exclusive = args[0]
+        else:
+            getattr(game, 'on_' + name)(*args)
+
+    send('exclusive', True)
+    send('key_press', key.W, 0)
+    dt = 1.0 / main.TICKS_PER_SEC
+    for tick in range(int(seconds * main.TICKS_PER_SEC)):
+        if rng.random() < 0.05:
+            send('mouse_motion', 400, 300, rng.randint(-60, 60), rng.randint(-20, 20))
+        if rng.random() < 0.02:
+            send('key_press', key.SPACE, 0)
+        if rng.random() < 0.03:
+            send('key_press', rng.choice(game.num_keys[:3]), 0)
+            send('mouse_press', 400, 300, rng.choice([mouse.LEFT, mouse.RIGHT]), 0)
+        # Vary the frame times a little, like a real run would
+        send('update', dt * rng.uniform(0.8, 1.3))
+    send('key_release', key.W, 0)
+    recorder.close(game)
+    game.model.executor.shutdown()
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('recording')
+    parser.add_argument('--demo', action='store_true', help='write a scripted recording to the path first')
+    parser.add_argument('--seed', type=int, default=1, help='seed for --demo')
+    parser.add_argument('--seconds', type=float, default=30, help='length of the --demo recording')
+    parser.add_argument('--repeat', type=int, default=1, help='replays to run - the fastest one counts')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    if args.demo:
+        demo(args.recording, args.seed, args.seconds)
+    best = None
+    for _ in range(args.repeat):
+        result = replay(args.recording)
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    print('%d ticks (%.1f s of play) in %.2f s - %.0f ticks/s, tick p50 %.2f ms  p99 %.2f ms' % (
+        best['ticks'], best['recorded_seconds'], best['seconds'], best['ticks_per_sec'] or 0,
+        best['tick_p50_ms'], best['tick_p99_ms']))
+    for phase in PHASES:
+        print('  %-8s %9.1f ms' % (phase, best['phases_ms'][phase]))
+    if best['matched'] is not None:
+        print('  ended %s the recording' % ('where' if best['matched'] else 'NOT where'))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(best, f, indent=2, sort_keys=True)
+    return 0 if best['matched'] is not False else 1
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
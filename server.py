@@ -0,0 +1,395 @@
+#! python3
+""" Pycraft server - one world, many players, no window in sight """
+
+# The server owns the Model and is the only one allowed to change it. Clients say where they are and which
+# blocks they'd like changed; once a tick the server applies every edit that came in, then sends each client
+# the changes that landed in the sectors it knows about. Sectors come into a client's view as whole snapshots
+# and drop out of it again as the player moves, so nobody is ever sent the entire world.
+#
+# Every message is a FRAME - kind and payload length - and then the payload:
+#
+#   client -> server
+#     MOVE      <fff      where the player is
+#     EDIT      <iiiB...  (x, y, z, palette id) per block - id 0 removes it
+#   server -> client
+#     WELCOME   json      client id, tick rate, sector size, interest radius
+#     PALETTE   json      the palette, sent again whenever it grows
+#     SECTOR    <ii<iH    sector x, z, then y0, height and the zlib'd palette ids (none when height is 0)
+#     FORGET    <ii       the sector's out of range - drop it
+#     DELTA     <Id...    tick, server time, then (x, y, z, palette id) per changed block
+#
+#   python server.py --port 7777 --seed 3
+from __future__ import division
+
+import argparse
+
+import asyncio
+
+import json
+
+import struct
+
+import math
+
+import time
+
+import traceback
+
+import zlib
+
+import pyglet
+
+# No display needed - and don't go making a hidden GL window on import either
+pyglet.options['shadow_window'] = False
+
+import numpy as np
+
+from main import NullRenderer, Model, PHYSICS_TICKS_PER_SEC, SECTOR_SIZE, World, sectorize
+
+# Message kinds
+MOVE = 1
+EDIT = 2
+WELCOME = 16
+PALETTE = 17
+SECTOR = 18
+FORGET = 19
+DELTA = 20
+
+FRAME = struct.Struct('<BI')
+
+POSITION = struct.Struct('<fff')
+
+SECTOR_HEADER = struct.Struct('<ii')
+
+SECTOR_PAYLOAD = struct.Struct('<iH')
+
+TICK = struct.Struct('<Id')
+
+# One changed block, as it goes over the wire
+BLOCK = np.dtype([('x', '<i4'), ('y', '<i4'), ('z', '<i4'), ('id', 'u1')])
+
+SERVER_TICKS_PER_SEC = 20
+
+GAME_TICKS = PHYSICS_TICKS_PER_SEC // SERVER_TICKS_PER_SEC
+# Game ticks (see Model.update_blocks()) per server tick, so sand falls as fast here as it does in the game
+
+INTEREST_PAD = 4
+# Sectors each client is sent, out from the one it's standing in
+
+SECTORS_PER_TICK = 8
+# Most new sectors sent to any one client per tick, nearest first, so a join doesn't stall everyone else
+
+MAX_CLIENT_BUFFER = 1 << 20
+# Bytes waiting to go out to a client past which it gets no new sectors until it catches up
+
+MAX_MESSAGE = 1 << 20
+# Longest message a client may send
+
+EDIT_HEIGHT = (-64, 256)
+# Lowest and highest (not included) y a client may edit at - chunks grow to fit, so this is not optional
+
+MAX_COORDINATE = 1 << 24
+# Furthest from the origin (in blocks, on any axis) a client may say it is, in a world with no walls round it. Past
+# this a float32 can't tell one block from the next anyway.
+
+
+def pack(kind, payload=b''):
+    """ Frame a message for the wire """
+    return FRAME.pack(kind, len(payload)) + payload
+
+
+async def read_message(reader, limit=None):
+    """ Read one message. Returns (kind, payload). """
+    kind, length = FRAME.unpack(await reader.readexactly(FRAME.size))
+    if limit is not None and length > limit:
+        raise ValueError('%d byte message is too long' % length)
+    return kind, await reader.readexactly(length)
+
+
+def encode_sector(sector, chunk):
+    """ A SECTOR message for the chunk (None when the sector is empty) """
+    x, _, z = sector
+    if chunk is None:
+        return pack(SECTOR, SECTOR_HEADER.pack(x, z) + SECTOR_PAYLOAD.pack(0, 0))
+    data = zlib.compress(np.ascontiguousarray(chunk.blocks).tobytes())
+    return pack(SECTOR, SECTOR_HEADER.pack(x, z) + SECTOR_PAYLOAD.pack(chunk.y0, chunk.blocks.shape[1]) + data)
+
+
+def decode_sector(payload, sector_size):
+    """ Return (sector, y0, blocks) from a SECTOR payload - blocks is None for an empty sector """
+    x, z = SECTOR_HEADER.unpack_from(payload)
+    y0, height = SECTOR_PAYLOAD.unpack_from(payload, SECTOR_HEADER.size)
+    if not height:
+        return (x, 0, z), y0, None
+    data = zlib.decompress(payload[SECTOR_HEADER.size + SECTOR_PAYLOAD.size:])
+    n = sector_size
+    return (x, 0, z), y0, np.frombuffer(data, dtype=np.uint8).reshape(n, height, n)
+
+
+def in_range(sector, centre, pad):
+    """ Whether the sector is within pad sectors of centre """
+    return max(abs(sector[0] - centre[0]), abs(sector[2] - centre[2])) <= pad
+
+
+class Session(object):
+    """ The server's side of one connected client """
+
+    def __init__(self, client_id, writer):
+        self.client_id = client_id
+        self.writer = writer
+        # The sector the player's in. None until the first MOVE.
+        self.sector = None
+        # Where the player was when the known sectors were last brought up to date, and whether some in range
+        # still haven't been sent
+        self.centre = None
+        self.missing = False
+        # Sectors the client has been sent a snapshot of, and hasn't been told to forget
+        self.known = set()
+        # How much of the palette the client's been sent
+        self.palette_size = 0
+
+    def send(self, data):
+        self.writer.write(data)
+
+    def backed_up(self):
+        return self.writer.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER
+
+
+class WorldServer(object):
+    """ Owns the world, and keeps every client's view of it in sync """
+
+    def __init__(self, model, tick_rate=SERVER_TICKS_PER_SEC, interest=INTEREST_PAD):
+        self.model = model
+        self.tick_rate = tick_rate
+        self.interest = interest
+        self.sessions = {}
+        self._next_id = 1
+        # ObjRelMap from position to the palette id a client asked for since the last tick - the last one wins
+        self.pending = {}
+        self.tick_count = 0
+        # ObjRelMap from sector to (world version, SECTOR message), so one snapshot serves everyone who needs it
+        self._encoded = {}
+        # How long recent ticks took (seconds) and what they sent (bytes), for the stats line
+        self.tick_times = []
+        self.bytes_sent = 0
+
+    async def handle(self, reader, writer):
+        """ Serve one connection until it goes away """
+        session = Session(self._next_id, writer)
+        self._next_id += 1
+        self.sessions[session.client_id] = session
+        session.send(pack(WELCOME, json.dumps({
+            'client_id': session.client_id,
+            'tick_rate': self.tick_rate,
+            'sector_size': SECTOR_SIZE,
+            'interest': self.interest,
+        }).encode('utf-8')))
+        try:
+            while True:
+                kind, payload = await read_message(reader, MAX_MESSAGE)
+                if kind == MOVE:
+                    session.sector = sectorize(self.position(payload))
+                elif kind == EDIT:
+                    self.edit(session, np.frombuffer(payload, dtype=BLOCK))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            # Gone, or talking nonsense - either way that's the end of this client
+            pass
+        finally:
+            self.sessions.pop(session.client_id, None)
+            writer.close()
+
+    def position(self, payload):
+        """ The position out of a MOVE payload. Raises ValueError for one that's the wrong size, not a number, or out
+        of the world - in a walled world, more than a sector past the walls.
+        """
+        if len(payload) != POSITION.size:
+            raise ValueError('%d byte MOVE' % len(payload))
+        position = POSITION.unpack(payload)
+        n = self.model.generator.n
+        limit = MAX_COORDINATE if n is None else n + SECTOR_SIZE
+        x, y, z = position
+        if not all(math.isfinite(p) for p in position) or max(abs(x), abs(z)) > limit or abs(y) > MAX_COORDINATE:
+            raise ValueError('MOVE to %r is out of the world' % (position,))
+        return position
+
+    def edit(self, session, blocks):
+        """ Queue up a client's edits for the next tick. Edits outside the sectors the client knows about, or with ids
+        that aren't in the palette, are ignored.
+        """
+        palette_size = len(self.model.world.palette)
+        lo, hi = EDIT_HEIGHT
+        for x, y, z, block_id in blocks.tolist():
+            if block_id < palette_size and lo <= y < hi and (x // SECTOR_SIZE, 0, z // SECTOR_SIZE) in session.known:
+                self.pending[(x, y, z)] = block_id
+
+    def _apply_edits(self):
+        """ Apply the edits queued since the last tick. Returns them as a BLOCK array. Edits to blocks that can't be
+        broken - the floor and walls of the world - are dropped, same as the Game won't let the player dig them out.
+        """
+        pending, self.pending = self.pending, {}
+        positions = np.array(list(pending), dtype=np.int64).reshape(-1, 3)
+        world = self.model.world
+        for sector, _ in World.group_by_sector(positions):
+            # So what's there gets read off the real blocks, not taken for air
+            self.model.load_sector(sector)
+        current = world.block_ids(positions)
+        allowed = (current == 0) | world.registry.breakable[current]
+        pending = dict((p, i) for (p, i), ok in zip(pending.items(), allowed.tolist()) if ok)
+        edits = np.zeros(len(pending), dtype=BLOCK)
+        if not pending:
+            return edits
+        edits['x'], edits['y'], edits['z'] = np.array(list(pending), dtype=np.int32).T
+        edits['id'] = list(pending.values())
+        palette = self.model.world.palette
+        self.model.add_blocks([(p, palette[i]) for p, i in pending.items() if i], immediate=False)
+        self.model.remove_blocks([p for p, i in pending.items() if not i], immediate=False)
+        return edits
+
+    def _update_blocks(self):
+        """ Run a game tick of block updates. Returns what they changed as a BLOCK array, in with the edits. """
+        positions, block_ids = self.model.update_blocks(immediate=False)
+        changes = np.zeros(len(positions), dtype=BLOCK)
+        changes['x'], changes['y'], changes['z'] = positions.T
+        changes['id'] = block_ids
+        return changes
+
+    def _sector_message(self, sector):
+        """ The SECTOR message for the sector as it stands, loading it if need be """
+        self.model.load_sector(sector)
+        version = self.model.world.version(sector)
+        cached = self._encoded.get(sector)
+        if cached is None or cached[0] != version:
+            cached = self._encoded[sector] = (version, encode_sector(sector, self.model.world.chunk(sector)))
+        return cached[1]
+
+    def tick(self):
+        """ Apply the edits and run the block updates, then bring every client up to date """
+        start = time.perf_counter()
+        self.tick_count += 1
+        edits = np.concatenate([self._apply_edits()] + [self._update_blocks() for _ in range(GAME_TICKS)])
+        # The edits packed up a sector at a time, so each client's delta is just the pieces for the sectors it knows
+        positions = np.stack((edits['x'], edits['y'], edits['z']), axis=1)
+        by_sector = dict((sector, edits[rows].tobytes()) for sector, rows in World.group_by_sector(positions))
+        header = TICK.pack(self.tick_count, time.time())
+        palette = self.model.world.palette
+        sent = 0
+        for session in list(self.sessions.values()):
+            try:
+                sent += self._update_session(session, header, by_sector, palette)
+            except Exception:
+                # Whatever went wrong, it's this client's problem - the rest still get their tick
+                traceback.print_exc()
+                self.sessions.pop(session.client_id, None)
+                session.writer.close()
+        self._unload()
+        self.bytes_sent += sent
+        self.tick_times.append(time.perf_counter() - start)
+
+    def _update_session(self, session, header, by_sector, palette):
+        """ Send the client its tick - the delta for the sectors it knows, then any sectors and palette it's missing.
+        Returns the bytes sent.
+        """
+        # Deltas first, for the sectors the client has already - anything new is sent after the edits went in
+        mine = b''.join(by_sector[sector] for sector in session.known.intersection(by_sector))
+        data = pack(DELTA, header + mine)
+        if session.sector != session.centre or session.missing:
+            data += self._update_interest(session)
+        if session.palette_size != len(palette):
+            # Goes ahead of the sectors that might use the new ids
+            data = pack(PALETTE, json.dumps(palette).encode('utf-8')) + data
+            session.palette_size = len(palette)
+        session.send(data)
+        return len(data)
+
+    def _update_interest(self, session):
+        """ The SECTOR and FORGET messages that bring the client's known sectors in line with where it is """
+        x, _, z = session.sector
+        session.centre = session.sector
+        data = []
+        # A sector of slack before forgetting, so walking up and down a boundary doesn't resend it every time
+        for sector in [s for s in session.known if not in_range(s, session.sector, self.interest + 1)]:
+            session.known.discard(sector)
+            data.append(pack(FORGET, SECTOR_HEADER.pack(sector[0], sector[2])))
+        if not session.backed_up():
+            wanted = []
+            pad = self.interest
+            for dx in range(-pad, pad + 1):
+                for dz in range(-pad, pad + 1):
+                    sector = (x + dx, 0, z + dz)
+                    if sector not in session.known:
+                        wanted.append((dx * dx + dz * dz, sector))
+            for _, sector in sorted(wanted)[:SECTORS_PER_TICK]:
+                session.known.add(sector)
+                data.append(self._sector_message(sector))
+            session.missing = len(wanted) > SECTORS_PER_TICK
+        return b''.join(data)
+
+    def _unload(self):
+        """ Let go of sectors nobody's near any more """
+        if self.tick_count % self.tick_rate:
+            return
+        keep = set()
+        pad = self.interest + 2
+        for x, _, z in set(session.sector for session in self.sessions.values() if session.sector is not None):
+            keep.update((x + dx, 0, z + dz) for dx in range(-pad, pad + 1) for dz in range(-pad, pad + 1))
+        for sector in self.model.loaded - keep:
+            self.model.unload_sector(sector)
+            self._encoded.pop(sector, None)
+
+    async def run(self, stats=False):
+        """ Tick forever, at tick_rate """
+        step = 1.0 / self.tick_rate
+        deadline = time.perf_counter()
+        last_stats = deadline
+        while True:
+            self.tick()
+            deadline += step
+            now = time.perf_counter()
+            if stats and now - last_stats >= 1:
+                times = sorted(self.tick_times)
+                print('%d clients  tick p50 %.2f ms  max %.2f ms  %.1f KB/s out  %d sectors loaded' % (
+                    len(self.sessions), times[len(times) // 2] * 1000, times[-1] * 1000,
+                    self.bytes_sent / (now - last_stats) / 1024, len(self.model.loaded)))
+                self.tick_times = []
+                self.bytes_sent = 0
+                last_stats = now
+            if deadline < now:
+                # Fell behind - don't try to make the lost ticks up all at once
+                deadline = now
+            await asyncio.sleep(deadline - now)
+
+
+async def serve(host, port, seed=None, save_path=None, tick_rate=SERVER_TICKS_PER_SEC, interest=INTEREST_PAD,
+                stats=False):
+    # Nothing here gets drawn, so there's no need to light it either
+    model = Model(seed, save_path, renderer=NullRenderer(), lighting=False)
+    world_server = WorldServer(model, tick_rate, interest)
+    server = await asyncio.start_server(world_server.handle, host, port)
+    print('Serving seed %d on %s' % (model.generator.seed, ', '.join(
+        '%s:%d' % sock.getsockname()[:2] for sock in server.sockets)), flush=True)
+    try:
+        await world_server.run(stats)
+    finally:
+        server.close()
+        model.save()
+        model.executor.shutdown()
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('--seed', type=int, help='world seed (default: random)')
+    parser.add_argument('--save', help='directory to save the world in, and load it from')
+    parser.add_argument('--ticks', type=int, default=SERVER_TICKS_PER_SEC, help='ticks per second')
+    parser.add_argument('--interest', type=int, default=INTEREST_PAD, help='sectors sent out from each player')
+    parser.add_argument('--stats', action='store_true', help='print a line of tick stats every second')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.seed, args.save, args.ticks, args.interest, args.stats))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    cli()
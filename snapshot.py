@@ -0,0 +1,139 @@
+""" Pycraft startup snapshots - the spawn area, generated and meshed, ready to go """
+
+# Generating and meshing the sectors around spawn is the same work every time a seed is launched, so the
+# result gets written down once and read back on the next launch in a single read. The key in the header
+# says exactly what the snapshot was built from - if anything in it no longer matches, it's stale, and it
+# gets ignored (and rebuilt).
+#
+#   header   MAGIC, format version, length of the JSON that follows
+#   json     {"key": ..., "palette": ...}, padded with spaces to a multiple of 4 bytes
+#   table    sector count, then (x, z, y0, height, vertex count, flags) per sector
+#   payload  per sector: blocks, masks, light, then its vertex and texture coordinate floats and vertex colour
+#            bytes (padded to a multiple of 4) if it has a mesh
+from __future__ import division
+
+import json
+
+import os
+
+import struct
+
+import numpy as np
+
+MAGIC = b'PYSN'
+
+VERSION = 2
+
+HEADER = struct.Struct('<4sHI')
+
+COUNT = struct.Struct('<I')
+
+ENTRY = struct.Struct('<iiiIII')
+
+# Entry flags
+SHOWN = 1  # The sector was shown, so a mesh follows its blocks
+FAR = 2  # ... and it's the low detail mesh of a far away sector
+
+FLOAT_SIZE = np.dtype(np.float32).itemsize
+
+
+class SnapshotSector(object):
+    """ One sector out of a snapshot. blocks, masks and light are None when the sector was empty, and vertex_data,
+    texture_data and colour_data are None when it wasn't shown. far is set when the mesh is a low detail one.
+    """
+    __slots__ = ('sector', 'y0', 'blocks', 'masks', 'light', 'vertex_data', 'texture_data', 'colour_data', 'far')
+
+    def __init__(self, sector, y0, blocks, masks, light, vertex_data=None, texture_data=None, colour_data=None,
+                 far=False):
+        self.sector = sector
+        self.y0 = y0
+        self.blocks = blocks
+        self.masks = masks
+        self.light = light
+        self.vertex_data = vertex_data
+        self.texture_data = texture_data
+        self.colour_data = colour_data
+        self.far = far
+
+
+def write_snapshot(path, key, palette, sectors):
+    """ Write the SnapshotSectors out to path, under the key. It goes to a temporary file first, so a crash part
+    of the way through can't leave a broken snapshot behind.
+    """
+    meta = json.dumps({'key': key, 'palette': palette}, sort_keys=True).encode('utf-8')
+    meta += b' ' * (-len(meta) % 4)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(meta)))
+        f.write(meta)
+        f.write(COUNT.pack(len(sectors)))
+        for s in sectors:
+            x, _, z = s.sector
+            height = 0 if s.blocks is None else s.blocks.shape[1]
+            count = 0 if s.vertex_data is None else len(s.vertex_data) // 3
+            flags = 0
+            if s.vertex_data is not None:
+                flags = SHOWN | (FAR if s.far else 0)
+            f.write(ENTRY.pack(x, z, s.y0, height, count, flags))
+        for s in sectors:
+            if s.blocks is not None:
+                f.write(np.ascontiguousarray(s.blocks, dtype=np.uint8).tobytes())
+                f.write(np.ascontiguousarray(s.masks, dtype=np.uint8).tobytes())
+                f.write(np.ascontiguousarray(s.light, dtype=np.uint8).tobytes())
+            if s.vertex_data is not None:
+                f.write(np.ascontiguousarray(s.vertex_data, dtype=np.float32).tobytes())
+                f.write(np.ascontiguousarray(s.texture_data, dtype=np.float32).tobytes())
+                colours = np.ascontiguousarray(s.colour_data, dtype=np.uint8).tobytes()
+                f.write(colours + b'\0' * (-len(colours) % 4))
+    os.replace(path + '.tmp', path)
+
+
+def read_snapshot(path, key, sector_size):
+    """ Return (palette, SnapshotSectors) from the snapshot at path - or None if there isn't one, it's damaged,
+    or it was made under a different key. The whole file comes in with one read, and the arrays handed back
+    are views straight into it.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = bytearray(os.fstat(f.fileno()).st_size)
+            if f.readinto(data) != len(data):
+                return None
+    except (IOError, OSError):
+        return None
+    try:
+        magic, version, length = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            return None
+        offset = HEADER.size
+        meta = json.loads(bytes(data[offset:offset + length]).decode('utf-8'))
+        if meta['key'] != key:
+            return None
+        offset += length
+        count, = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        entries = [ENTRY.unpack_from(data, offset + i * ENTRY.size) for i in range(count)]
+        offset += count * ENTRY.size
+        n = sector_size
+        sectors = []
+        for x, z, y0, height, vertices, flags in entries:
+            s = SnapshotSector((x, 0, z), y0, None, None, None)
+            if height:
+                size = n * height * n
+                s.blocks = np.frombuffer(data, np.uint8, size, offset).reshape(n, height, n)
+                s.masks = np.frombuffer(data, np.uint8, size, offset + size).reshape(n, height, n)
+                s.light = np.frombuffer(data, np.uint8, size, offset + 2 * size).reshape(n, height, n)
+                offset += 3 * size
+            if flags & SHOWN:
+                s.far = bool(flags & FAR)
+                s.vertex_data = np.frombuffer(data, np.float32, vertices * 3, offset)
+                offset += vertices * 3 * FLOAT_SIZE
+                s.texture_data = np.frombuffer(data, np.float32, vertices * 2, offset)
+                offset += vertices * 2 * FLOAT_SIZE
+                s.colour_data = np.frombuffer(data, np.uint8, vertices * 3, offset)
+                offset += vertices * 3 + (-vertices * 3) % 4
+            sectors.append(s)
+        if offset != len(data):
+            return None
+    except (ValueError, KeyError, struct.error):
+        # Cut short, or scribbled on - either way it's no good
+        return None
+    return meta['palette'], sectors
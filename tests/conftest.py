@@ -0,0 +1,11 @@
+""" Shared setup for the tests - they run headless, against the modules in the directory above """
+import os
+
+import sys
+
+import pyglet
+
+# No display needed - and don't go making a hidden GL window on import either
+pyglet.options['shadow_window'] = False
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
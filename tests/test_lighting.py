@@ -0,0 +1,81 @@
+""" The incremental lighting has to come out the same as lighting everything from scratch """
+import numpy as np
+
+from lighting import MAX_LIGHT, SKY_SHIFT, split_light
+from main import BRICK, FACES, SECTOR_SIZE, Model, NullRenderer, World, texture_coordinates
+
+LAMP = texture_coordinates((3, 0), (3, 0), (3, 0))
+
+
+def from_scratch(world):
+    """ The light every chunk ought to have, worked out the slow way - full sky light down every column to the first
+    block, then both channels spread a step at a time over the whole world until nothing changes
+    """
+    n = SECTOR_SIZE
+    xs = [x for x, _, _ in world.chunks]
+    zs = [z for _, _, z in world.chunks]
+    y0 = min(chunk.y0 for chunk in world.chunks.values())
+    y1 = max(chunk.y0 + chunk.blocks.shape[1] for chunk in world.chunks.values())
+    lo = (min(xs) * n - 1, y0 - 1, min(zs) * n - 1)
+    hi = ((max(xs) + 1) * n + 1, y1 + 1, (max(zs) + 1) * n + 1)
+    blocks, light, fixed = world._light_window(lo, hi)
+    fixed[[0, -1]] = True
+    fixed[:, [0, -1]] = True
+    fixed[:, :, [0, -1]] = True
+    sky = np.where(fixed, split_light(light)[0], 0).astype(np.int16)
+    block = np.where(fixed, 0, world.registry.emission[blocks]).astype(np.int16)
+    for (x, _, z), chunk in world.chunks.items():
+        shaded = np.logical_or.accumulate(chunk.blocks[:, ::-1, :] != 0, axis=1)[:, ::-1, :]
+        ox, oy, oz = x * n - lo[0], chunk.y0 - lo[1], z * n - lo[2]
+        sky[ox:ox + n, oy:oy + chunk.blocks.shape[1], oz:oz + n] = np.where(shaded, 0, MAX_LIGHT)
+    open_ = (blocks == 0) & ~fixed
+    down = FACES.index((0, -1, 0))
+
+    def spread(level, sky_rule):
+        while True:
+            new = level.copy()
+            for face, delta in enumerate(FACES):
+                src = tuple(slice(max(0, -k), size - max(0, k)) for k, size in zip(delta, level.shape))
+                dst = tuple(slice(max(0, k), size + min(0, k)) for k, size in zip(delta, level.shape))
+                value = level[src] - 1
+                if sky_rule and face == down:
+                    value = np.where(level[src] == MAX_LIGHT, MAX_LIGHT, value)
+                new[dst] = np.where(open_[dst], np.maximum(new[dst], value), new[dst])
+            if (new == level).all():
+                return level
+            level = new
+
+    packed = spread(sky, True) << SKY_SHIFT | spread(block, False)
+    result = {}
+    for (x, _, z), chunk in world.chunks.items():
+        ox, oy, oz = x * n - lo[0], chunk.y0 - lo[1], z * n - lo[2]
+        result[(x, 0, z)] = packed[ox:ox + n, oy:oy + chunk.blocks.shape[1], oz:oz + n]
+    return result
+
+
+def assert_lit(world):
+    for sector, light in from_scratch(world).items():
+        assert (world.chunks[sector].light == light).all(), sector
+
+
+def test_scattered_edits_cluster_apart():
+    near = np.array([(0, 0, 0), (20, 3, 5), (40, 0, 0)])
+    assert len(World._light_clusters(near)) == 1
+    far = np.array([(0, 0, 0), (400, 0, 0), (3, 5, 400), (401, 9, 2)])
+    clusters = World._light_clusters(far)
+    assert sorted(sorted(rows.tolist()) for rows in clusters) == [[0], [1, 3], [2]]
+
+
+def test_scattered_bulk_edits_light_like_from_scratch():
+    model = Model(seed=3, renderer=NullRenderer())
+    model.world.set_emission(LAMP, 14)
+    spots = [(0, 0), (120, 0), (0, 130), (60, 60)]
+    # Some ground at every spot first, so the edits after that are relighting chunks that are already lit
+    model.fill_region((-20, -3, -20), (20, -3, 20), BRICK)
+    for x, z in spots[1:]:
+        model.fill_region((x - 8, -3, z - 8), (x + 8, -3, z + 8), BRICK)
+    model.add_blocks([((x, 2, z), LAMP) for x, z in spots] + [((x + 1, 4, z), BRICK) for x, z in spots])
+    assert_lit(model.world)
+    model.remove_blocks([(x, 2, z) for x, z in spots[::2]] + [(x + 1, 4, z) for x, z in spots[1::2]])
+    assert_lit(model.world)
+    model.executor.shutdown()
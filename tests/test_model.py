@@ -0,0 +1,47 @@
+""" The Model keeps going when meshing a sector goes wrong """
+import main
+from main import Model, NullRenderer
+
+
+def make_model():
+    model = Model(seed=3, renderer=NullRenderer())
+    model.set_view_distance(2)
+    return model
+
+
+def test_worker_failure_meshes_on_the_main_thread(monkeypatch):
+    if main.MESH_WORKERS == 0:
+        return
+    model = make_model()
+    real = main.mesh_blocks
+    failed = []
+
+    def flaky(*args):
+        # Only the pool's calls fall over
+        if main.threading.current_thread() is not main.threading.main_thread():
+            failed.append(args[3])
+            raise RuntimeError('worker fell over')
+        return real(*args)
+
+    monkeypatch.setattr(main, 'mesh_blocks', flaky)
+    model.change_sector(None, (0, 0, 0))
+    model.process_entire_queue()
+    assert failed
+    assert not model.meshing
+    assert model.shown <= set(model._shown)
+    model.executor.shutdown()
+
+
+def test_meshing_that_always_fails_does_not_escape(monkeypatch):
+    model = make_model()
+
+    def broken(*args):
+        raise RuntimeError('meshing is broken')
+
+    monkeypatch.setattr(main, 'mesh_blocks', broken)
+    model.change_sector(None, (0, 0, 0))
+    model.process_entire_queue()
+    assert not model.meshing
+    assert not model.shown & set(model._shown)
+    if model.executor is not None:
+        model.executor.shutdown()
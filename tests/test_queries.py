@@ -0,0 +1,56 @@
+""" The World's spatial queries, against the slow way of working the same things out """
+import json
+
+import random
+
+from main import BRICK, SAND, Model, NullRenderer
+
+
+def make_model():
+    """ The spawn area, with a few edits about it """
+    model = Model(seed=3, renderer=NullRenderer())
+    model.load_around((0, 0, 0), 2)
+    rng = random.Random(3)
+    model.add_blocks([((rng.randint(-30, 30), rng.randint(0, 20), rng.randint(-30, 30)), SAND) for _ in range(100)])
+    model.remove_blocks([(rng.randint(-30, 30), -2, rng.randint(-30, 30)) for _ in range(100)])
+    model.add_block((5, 9, 5), model.world.palette_id(BRICK))
+    return model
+
+
+def every_block(world):
+    return dict((position, world.block_id(position)) for position in world)
+
+
+def test_count_by_type():
+    model = make_model()
+    world = model.world
+    blocks = every_block(world)
+    lo, hi = (-20, -3, -25), (17, 10, 3)
+    expected = {}
+    for position, block_id in blocks.items():
+        if all(a <= p <= b for a, p, b in zip(lo, position, hi)):
+            expected[block_id] = expected.get(block_id, 0) + 1
+    counts = world.count_by_type(lo, hi)
+    assert counts == expected
+    assert all(type(block_id) is int and type(count) is int for block_id, count in counts.items())
+    # Straight into JSON, with the same ids as the rest of the API
+    assert json.loads(json.dumps(counts)) == dict((str(k), v) for k, v in expected.items())
+    total = world.count_by_type()
+    assert sum(total.values()) == len(blocks)
+    assert all(type(block_id) is int for block_id in total)
+    model.executor.shutdown()
+
+
+def test_highest_block_and_nearest():
+    model = make_model()
+    world = model.world
+    blocks = every_block(world)
+    assert world.highest_block(5, 5) == max(y for x, y, z in blocks if (x, z) == (5, 5))
+    assert world.highest_block(10000, 10000) is None
+    sand = world.palette_id(SAND)
+    position = (0.3, 4.0, -2.7)
+    found = world.nearest(position, lambda block_type: block_type.falls, radius=40)
+    distance = min(sum((a - b) ** 2 for a, b in zip(p, position)) for p, i in blocks.items() if i == sand)
+    assert blocks[found] == sand
+    assert abs(sum((a - b) ** 2 for a, b in zip(found, position)) - distance) < 1e-9
+    model.executor.shutdown()
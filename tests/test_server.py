@@ -0,0 +1,101 @@
+""" The server has to keep going for everyone else, whatever one client sends it """
+import asyncio
+
+import math
+
+from main import Model, NullRenderer
+from server import DELTA, MOVE, POSITION, Session, WorldServer, pack, read_message
+
+
+def make_server():
+    """ A WorldServer over a small headless world """
+    model = Model(seed=3, renderer=NullRenderer(), lighting=False)
+    return WorldServer(model, tick_rate=50, interest=1)
+
+
+async def count_ticks(reader, seconds):
+    """ How many DELTAs come in over the next few seconds """
+    ticks = 0
+    loop = asyncio.get_running_loop()
+    end = loop.time() + seconds
+    while True:
+        try:
+            kind, _ = await asyncio.wait_for(read_message(reader), end - loop.time())
+        except asyncio.TimeoutError:
+            return ticks
+        ticks += kind == DELTA
+
+
+async def hung_up(reader):
+    """ Read until the server closes the connection """
+    while True:
+        try:
+            await read_message(reader)
+        except asyncio.IncompleteReadError:
+            return
+
+
+def test_bad_moves_only_drop_their_own_client():
+    async def run():
+        world_server = make_server()
+        server = await asyncio.start_server(world_server.handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        ticking = asyncio.ensure_future(world_server.run())
+        try:
+            good_reader, good_writer = await asyncio.open_connection('127.0.0.1', port)
+            good_writer.write(pack(MOVE, POSITION.pack(0.0, 0.0, 0.0)))
+            for payload in (POSITION.pack(1e30, 0.0, 0.0), POSITION.pack(math.inf, 0.0, 0.0),
+                            POSITION.pack(math.nan, 0.0, 0.0), b'\0\0\0'):
+                bad_reader, bad_writer = await asyncio.open_connection('127.0.0.1', port)
+                bad_writer.write(pack(MOVE, payload))
+                # The server hangs up on it
+                await asyncio.wait_for(hung_up(bad_reader), 5)
+                bad_writer.close()
+            assert await count_ticks(good_reader, 0.5) > 5
+            assert not ticking.done()
+            assert len(world_server.sessions) == 1
+            good_writer.close()
+        finally:
+            ticking.cancel()
+            server.close()
+            world_server.model.executor.shutdown()
+
+    asyncio.run(run())
+
+
+class FakeTransport(object):
+
+    def get_write_buffer_size(self):
+        return 0
+
+
+class FakeWriter(object):
+
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.data = []
+        self.closed = False
+
+    def write(self, data):
+        self.data.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+def test_tick_survives_a_session_failing():
+    world_server = make_server()
+    good = Session(1, FakeWriter())
+    good.sector = (0, 0, 0)
+    bad = Session(2, FakeWriter())
+    bad.sector = (0, 0, 0)
+    # Something only this client has, that falls over when the tick gets to it
+    bad.known = None
+    world_server.sessions = {1: good, 2: bad}
+    for _ in range(3):
+        world_server.tick()
+    assert list(world_server.sessions) == [1]
+    assert bad.writer.closed
+    # One send a tick, all three of them
+    assert len(good.writer.data) == 3
+    world_server.model.executor.shutdown()